@@ -6,3 +6,7 @@ HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
     "Referer": "https://www.bilibili.com/",
 }
+
+# 请求的超时时间：(连接超时, 读取超时)，秒
+API_TIMEOUT = (5, 20)
+CDN_TIMEOUT = (10, 30)
@@ -1,5 +1,6 @@
 from typing import Any, Optional
 from threading import Lock
+from urllib.parse import urlparse
 
 from requests import Session, adapters
 
@@ -7,10 +8,10 @@ from .wbi import CachedWbiManager
 from .template import APITemplate
 
 # collect components
-from .constants import HEADERS, VERSION
+from .constants import HEADERS, VERSION, API_TIMEOUT, CDN_TIMEOUT
 from . import apis
 
-__all__ = ["APIContainer", "default_session", "new_apis"]
+__all__ = ["APIContainer", "default_session", "new_apis", "configure_pools"]
 
 components = [v for k, v in vars(apis).items() if k.endswith("APIs")]
 
@@ -59,16 +60,93 @@ class APIContainer:
                 comp.allow_cache = value
 
 
-def default_session():
-    # 加一些，默认的优化选项，像 Retry Adapter？
-    session = Session()
+# 这些域名下的是 API，其余的（bilivideo、hdslb 之类）都当作 CDN
+API_HOST_SUFFIXES = ("bilibili.com", "b23.tv")
+
+
+class RoutingAdapter(adapters.BaseAdapter):
+    """按主机把请求分给 API 和 CDN 两组连接池
+
+    API 请求小而频繁，CDN 传输大而持久，分开之后大量下载连接不会把 API 的长连接挤出池子；
+    没指定超时的请求按所属的池子加上默认的超时，免得一条死掉的连接永远卡住"""
+
+    def __init__(
+        self,
+        api_adapter: adapters.HTTPAdapter,
+        cdn_adapter: adapters.HTTPAdapter,
+        api_host_suffixes: tuple[str, ...] = API_HOST_SUFFIXES,
+        api_timeout: tuple[float, float] = API_TIMEOUT,
+        cdn_timeout: tuple[float, float] = CDN_TIMEOUT,
+    ) -> None:
+        super().__init__()
+        self.api_adapter = api_adapter
+        self.cdn_adapter = cdn_adapter
+        self.api_host_suffixes = api_host_suffixes
+        self.api_timeout = api_timeout
+        self.cdn_timeout = cdn_timeout
+
+    def route(self, url: str) -> adapters.HTTPAdapter:
+        host = urlparse(url).hostname or ""
+        if any(
+            host == suffix or host.endswith("." + suffix)
+            for suffix in self.api_host_suffixes
+        ):
+            return self.api_adapter
+        return self.cdn_adapter
+
+    def send(self, request, **kwargs):  # pylint: disable=W0221
+        adapter = self.route(request.url)
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = (
+                self.api_timeout if adapter is self.api_adapter else self.cdn_timeout
+            )
+        return adapter.send(request, **kwargs)
+
+    def close(self):
+        self.api_adapter.close()
+        self.cdn_adapter.close()
+
+
+def configure_pools(
+    session: Session,
+    api_connections: int = 10,
+    cdn_connections: int = 10,
+    per_host: Optional[int] = None,
+):
+    """按并发数重新设定 session 的连接池
+
+    *_connections 是同时可能发往同一主机的请求数，池子按这个大小留连接，
+    避免并发高时连接用完就被丢掉、下次又要重新握手；
+    给了 per_host 时单个 CDN 主机的连接数不超过它，多出来的请求会等待空闲连接"""
     retry = adapters.Retry(total=2, backoff_factor=0.5, backoff_max=10)
-    adp = adapters.HTTPAdapter(max_retries=retry)
+    adp = RoutingAdapter(
+        adapters.HTTPAdapter(
+            max_retries=retry,
+            pool_connections=len(API_HOST_SUFFIXES) * 4,
+            pool_maxsize=max(api_connections, 1),
+        ),
+        adapters.HTTPAdapter(
+            max_retries=retry,
+            # CDN 主机多，多缓存一些主机的池子
+            pool_connections=32,
+            pool_maxsize=max(per_host or cdn_connections, 1),
+            pool_block=per_host is not None,
+        ),
+    )
+    for prefix, old in list(session.adapters.items()):
+        if prefix in ("https://", "http://"):
+            old.close()
     session.mount("https://", adp)
     session.mount("http://", adp)
     return session
 
 
+def default_session():
+    session = Session()
+    configure_pools(session)
+    return session
+
+
 def new_apis(
     session: Optional[Session] = None, wbimanager: Optional[CachedWbiManager] = None, extra_data: Optional[dict[str, Any]] = None
 ) -> APIContainer:
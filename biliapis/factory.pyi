@@ -1,6 +1,6 @@
 from typing import Optional, Any
 
-from requests import Session
+from requests import PreparedRequest, Response, Session, adapters
 
 from .wbi import CachedWbiManager
 from . import apis
@@ -27,6 +27,34 @@ class APIContainer:
     media: apis.MediaAPIs
     video: apis.VideoAPIs
 
+API_HOST_SUFFIXES: tuple[str, ...]
+
+class RoutingAdapter(adapters.BaseAdapter):
+    api_adapter: adapters.HTTPAdapter
+    cdn_adapter: adapters.HTTPAdapter
+    api_host_suffixes: tuple[str, ...]
+    api_timeout: tuple[float, float]
+    cdn_timeout: tuple[float, float]
+
+    def __init__(
+        self,
+        api_adapter: adapters.HTTPAdapter,
+        cdn_adapter: adapters.HTTPAdapter,
+        api_host_suffixes: tuple[str, ...] = ...,
+        api_timeout: tuple[float, float] = ...,
+        cdn_timeout: tuple[float, float] = ...,
+    ) -> None: ...
+    def route(self, url: str) -> adapters.HTTPAdapter: ...
+    def send(self, request: PreparedRequest, **kwargs: Any) -> Response: ...  # type: ignore[override]
+    def close(self) -> None: ...
+
+def configure_pools(
+    session: Session,
+    api_connections: int = 10,
+    cdn_connections: int = 10,
+    per_host: Optional[int] = None,
+) -> Session: ...
+def default_session() -> Session: ...
 def new_apis(
     session: Optional[Session] = None,
     wbimanager: Optional[CachedWbiManager] = None,
@@ -7,7 +7,7 @@ import logging
 import requests
 
 from .wbi import CachedWbiManager
-from .constants import HEADERS as DEFAULT_HEADERS
+from .constants import HEADERS as DEFAULT_HEADERS, API_TIMEOUT
 from .error import BiliError
 from .utils import get_csrf
 from . import reqcache
@@ -100,7 +100,10 @@ def request_template(
                 if (result := reqcache.cache.get(cacheparams)) is not None:
                     logging.debug("Use cache: %s %s", mod.upper(), url)
                     return result
-            with self._session.request(mod, url, **reqparams) as resp:
+            # 没指定超时就用默认的，不放进 reqparams 是为了不影响缓存的键
+            with self._session.request(
+                mod, url, **({"timeout": API_TIMEOUT} | reqparams)
+            ) as resp:
                 resp.raise_for_status()
                 match handle:
                     case "str":
@@ -2,21 +2,32 @@ import argparse
 import logging
 import os
 import atexit
-from typing import Optional
+from typing import Any, Optional
 
 from biliapis import APIContainer, init_cache
 from biliapis.utils import remove_none
+from biliapis.factory import configure_pools
 import bilicore
 from bilicore.parser import extract_ids
 from bilicore.utils import check_ffmpeg
-from . import printers, login, utils, svld
-from .core import CliCore
+from bilicore import hostrank, jobstore
+from bilicore.ratelimit import limiter
+from bilicore.postproc import processor
+from . import printers, login, utils, svld, daemon
+from .core import CliCore, check_exceptions
+
+
+class SourceError(ValueError):
+    """认不出或者还不支持的输入"""
 
 
 class App(CliCore):
     DEFAULT_DATADIR_PATH = os.path.join(os.path.expanduser("~"), ".bilitools")
     DEFAULT_DATA_FILENAME = "bilidata.json"
     DEFAULT_CACHE_FILENAME = "bilicache.db"
+    DEFAULT_HOSTRANK_FILENAME = "hostrank.json"
+    DEFAULT_JOBSTORE_FILENAME = "bilijobs.db"
+    DEFAULT_DAEMON_TOKEN_FILENAME = "daemon-{port}.token"
     VERSION = "1.0.0"
 
     def __init__(self, args: argparse.Namespace) -> None:
@@ -34,6 +45,16 @@ class App(CliCore):
 
         super().__init__(self._load_all(self._data_filepath))
         atexit.register(self._save_all)
+        # 每个任务同时下音频和视频，每条流 max_connections 条连接；漫画每章 8 个线程
+        # 准备阶段的任务也在同时调 API
+        configure_pools(
+            self._apis.session,
+            api_connections=max(
+                10, (args.max_worker + (args.max_prepare or args.max_worker)) * 2
+            ),
+            cdn_connections=args.max_worker * max(2 * (args.max_connections or 8), 8),
+            per_host=args.max_host_connections,
+        )
 
         if args.version:
             print("\nBiliTools - Remake")
@@ -47,13 +68,32 @@ class App(CliCore):
                 args.cache_expire,
             )
 
+        hostrank.init(
+            os.path.join(self.DEFAULT_DATADIR_PATH, self.DEFAULT_HOSTRANK_FILENAME)
+        )
+
+        jobstore.init(
+            os.path.join(self.DEFAULT_DATADIR_PATH, self.DEFAULT_JOBSTORE_FILENAME)
+        )
+
+        processor.configure(args.max_postproc, args.postproc_nice)
+        limiter.set_rate(args.limit_rate)
+        for host, rate in args.limit_host_rate or []:
+            limiter.set_host_rate(host, rate)
+
         if not check_ffmpeg():
             print("\nFFmpeg not found!!")
             print(
-                "Program cannot function normally without FFmpeg, consider install it.\n"
+                "Videos can still be merged into MP4, but audio conversion, FLAC,\n"
+                "covers and --stream-merge need FFmpeg, consider install it.\n"
             )
             utils.ask_confirm(args.yes)
 
+    @classmethod
+    def daemon_token_file(cls, port: int) -> str:
+        filename = cls.DEFAULT_DAEMON_TOKEN_FILENAME.format(port=port)
+        return os.path.join(cls.DEFAULT_DATADIR_PATH, filename)
+
     def _load_all(self, data_path: str) -> APIContainer:
         return svld.load_data(data_path)
 
@@ -86,32 +126,97 @@ class App(CliCore):
         else:
             print("Not logged in. Some resources will be unavailable.\n")
 
+        if args.resume:
+            self._resume_process(**remove_none(vars(args)))
+            return
+
+        if args.daemon:
+            daemon.Daemon(
+                self._process_source,
+                port=args.daemon_port,
+                token_file=self.daemon_token_file(args.daemon_port),
+            ).serve()
+            return
+
         source: Optional[str] = args.input
         savedir: Optional[str] = args.output
         if source is None:
             print("give an input to do actual things!")
             return
 
-        if ids := extract_ids(source=source, session=apis.session):
+        if args.dry_run:
+            savedir = None
+
+        if source.startswith("@"):
+            self._batch_process(
+                utils.read_sources(source), savedir, remove_none(vars(args))
+            )
+            return
+
+        try:
+            self._process_source(source, savedir, remove_none(vars(args)))
+        except SourceError as e:
+            print(e)
+
+    def _batch_process(
+        self, sources: list[str], savedir: Optional[str], options: dict[str, Any]
+    ):
+        """一次处理多个输入：先挨个列出任务，去重后放进同一个线程池下载，
+        一个输入的收尾可以和下一个输入的开始重叠"""
+        with self._collect() as batch:
+            for source in sources:
+                print(f"\n>>> {source}")
+                try:
+                    # 每个输入不再单独确认，最后一起确认
+                    self._process_source(source, savedir, options | {"yes": True})
+                except SourceError as e:
+                    print(e)
+                except Exception as e:
+                    logging.error("failed to list %s: %s", source, e, exc_info=True)
+                    print(f"failed: {e}")
+            duplicates = self._batch_duplicates
+        if savedir is None:
+            return
+        total = sum(len(threads) for threads, _ in batch.values())
+        print(
+            f"\n{total} job(s) from {len(sources)} source(s)"
+            + (f", {duplicates} duplicate(s) skipped" if duplicates else "")
+        )
+        if not total or not utils.ask_confirm(yes=options.get("yes")):
+            return
+        self._run_batches(batch, savedir, options)
+
+    @check_exceptions
+    def _run_batches(
+        self,
+        batch: dict[str, tuple[list[Any], dict[str, Any]]],
+        savedir: str,
+        options: dict[str, Any],
+    ):
+        excs: list[Exception] = []
+        for threads, kwargs in batch.values():
+            kwargs = kwargs | {"max_worker": options.get("max_worker", 4)}
+            excs += self._run_batch(threads, savedir, options, **kwargs) or []
+        return excs
+
+    def _process_source(
+        self, source: str, savedir: Optional[str], options: dict[str, Any]
+    ) -> Optional[list[Exception]]:
+        """处理一个输入，savedir 为 None 时只看不下；返回出错的异常，
+        认不出的输入抛出 SourceError"""
+        if ids := extract_ids(source=source, session=self._apis.session):
             logging.debug("extract ids: %s", ids)
             idname = list(ids.keys())[0]
             idcontent = ids[idname]
         else:
-            print("unknown source...")
-            return
-
-        if args.dry_run:
-            savedir = None
+            raise SourceError("unknown source...")
 
         if savedir is None:
             print("- dry run -")
 
-        options = remove_none(vars(args))
         for i, func, need_all_ids in self._idname_to_procmethod_map:
             if idname in i:
                 if need_all_ids:
-                    func(savedir, **{idname: idcontent}, **options, all_ids=ids)
-                else:
-                    func(savedir, **{idname: idcontent}, **options)
-                return
-        print(f"source type <{idname}> not supported yet")
+                    return func(savedir, **{idname: idcontent}, **options, all_ids=ids)
+                return func(savedir, **{idname: idcontent}, **options)
+        raise SourceError(f"source type <{idname}> not supported yet")
@@ -1,7 +1,10 @@
 import argparse
 import logging
 
+from bilicore.ratelimit import parse_rate, parse_host_rate, parse_size
+from bilicore.jobstore import JobStore
 from .app import App
+from . import daemon
 
 LOGFILE_PATH = "./run.log"
 
@@ -35,6 +38,94 @@ def parse_arguments():
         help="Specify the number of max concurrent worker threads, default to 4",
     )
 
+    parser.add_argument(
+        "--max-prepare",
+        type=int,
+        help="Specify the number of jobs fetching info and streams ahead of downloading at the same time, default to --max-worker",
+    )
+
+    parser.add_argument(
+        "--job-order",
+        type=str,
+        choices=["fifo", "shortest", "longest"],
+        default="fifo",
+        help="Choose the order to start jobs in a batch by their estimated size, `shortest` gets files done early, `longest` finishes the whole batch sooner, default to `fifo`",
+    )
+
+    parser.add_argument(
+        "--max-postproc",
+        type=int,
+        help="Specify the number of concurrent FFmpeg post-processing jobs, default to the number of CPU cores",
+    )
+
+    parser.add_argument(
+        "--postproc-nice",
+        type=int,
+        help="Specify the nice value of FFmpeg post-processing and stream merge jobs, 0 to keep normal priority, default to 10",
+    )
+
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="Specify the number of max connections for downloading one stream, default to 8",
+    )
+
+    parser.add_argument(
+        "--max-host-connections",
+        type=int,
+        help="Limit the number of connections to one CDN host, extra requests wait for a free one",
+    )
+
+    parser.add_argument(
+        "--multi-mirror",
+        action="store_true",
+        help="Download different parts of one stream from all its mirrors at the same time",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=["thread", "asyncio"],
+        help="Specify the download engine, `asyncio` runs all transfers on one event loop instead of a thread per connection, default to thread",
+    )
+
+    parser.add_argument(
+        "--buffer-size",
+        type=parse_size,
+        help="Specify the max receive buffer size of one connection, like `4M`, default to 2M",
+    )
+
+    parser.add_argument(
+        "--verify-etag",
+        action="store_true",
+        help="Also treat md5/sha1-like ETags from CDN as file digests when verifying downloads",
+    )
+
+    parser.add_argument(
+        "--stall-speed",
+        type=parse_rate,
+        help="Reconnect a connection that stays below this speed for the stall timeout, like `16K`, 0 to disable, default to 16K",
+    )
+
+    parser.add_argument(
+        "--stall-timeout",
+        type=float,
+        help="Specify how many seconds a connection may stay below the stall speed, default to 20",
+    )
+
+    parser.add_argument(
+        "--limit-rate",
+        type=parse_rate,
+        help="Limit total download speed of all workers, like `20M` or `512K` (bytes/s)",
+    )
+
+    parser.add_argument(
+        "--limit-host-rate",
+        type=parse_host_rate,
+        action="append",
+        metavar="HOST=RATE",
+        help="Limit download speed from one host, like `upos-sz-mirrorcos.bilivideo.com=5M`. Can be given multiple times",
+    )
+
     parser.add_argument("--login", action="store_true", help="Do login and exit")
 
     parser.add_argument("--logout", action="store_true", help="Do logout and exit")
@@ -58,7 +149,37 @@ def parse_arguments():
         "-y", "--yes", action="store_true", help="Just do it without confirmation"
     )
 
-    parser.add_argument("-i", "--input", type=str, help="Specify media source")
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        help="Specify media source, or `@FILE` / `@-` to read many sources from a file / stdin, one per line",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Stay running and take jobs from --client over a local HTTP port, so each job skips the startup work. Jobs run one at a time, each with --max-worker workers; rate limits and post-processing options are fixed when the daemon starts",
+    )
+
+    parser.add_argument(
+        "--client",
+        action="store_true",
+        help="Hand this input and options to the running daemon instead of downloading here, `@FILE` queues one job per line, list its jobs if no input is given",
+    )
+
+    parser.add_argument(
+        "--daemon-port",
+        type=int,
+        default=daemon.DEFAULT_PORT,
+        help=f"Specify the local port the daemon listens on, default to {daemon.DEFAULT_PORT}",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=f"Continue unfinished jobs from last runs instead of reading an input, skipping jobs still running in another process. A job failed {JobStore.MAX_ATTEMPTS} times is dropped",
+    )
 
     parser.add_argument(
         "--audio-only",
@@ -128,6 +249,18 @@ def parse_arguments():
         help="Don't write metadata into output file",
     )
 
+    parser.add_argument(
+        "--stream-merge",
+        action="store_true",
+        help="For videos, feed streams into FFmpeg while downloading, so the output is ready right after the last byte",
+    )
+
+    parser.add_argument(
+        "--no-preflight",
+        action="store_true",
+        help="Skip estimating total size and checking free space before downloading",
+    )
+
     parser.add_argument(
         "-o",
         "--output",
@@ -140,6 +273,9 @@ def parse_arguments():
 
 def boot():
     args = parse_arguments()
+    if args.client:
+        daemon.client_main(args, App.daemon_token_file(args.daemon_port))
+        return
     logger = logging.getLogger()
     handler = logging.FileHandler(LOGFILE_PATH, mode="w+", encoding="utf-8")
     handler.setFormatter(
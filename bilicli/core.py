@@ -1,23 +1,41 @@
 from typing import Optional, Any, Callable
 import functools
+import contextlib
 import math
 
 from biliapis import APIContainer
+from bilicore import jobstore
 from bilicore.threads import (
     SingleVideoThread,
     SingleAudioThread,
     SingleMangaChapterThread,
 )
 from . import printers, utils
+from .hints import WorkerThread
+
+
+# 记录里的任务类型 -> 任务类
+JOB_KINDS: dict[str, type[WorkerThread]] = {
+    cls.__name__: cls
+    for cls in (SingleVideoThread, SingleAudioThread, SingleMangaChapterThread)
+}
+
+
+# 进度条单位 -> (任务, 交给 run_threads 的参数)
+_Batch = dict[str, tuple[list[WorkerThread], dict[str, Any]]]
 
 
 def check_exceptions(func: Callable[..., Optional[list[Exception]]]):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         excs = func(*args, **kwargs)
+        if args and getattr(args[0], "_batch", None) is not None:
+            # 批量输入时任务只是收集起来，最后一起下载、一起汇报
+            return excs
         print("\nall done!")
         if excs:
             print(f"{len(excs)} exception(s) occurred, plz check log")
+        return excs
 
     return wrapped
 
@@ -34,11 +52,126 @@ class CliCore:
             (("series_id",), self._video_series_process, True),
             (("season_id",), self._video_season_process, True),
         ]
+        # 批量输入时收集起来的任务
+        self._batch: Optional[_Batch] = None
+        self._batch_keys: set[tuple] = set()
+        self._batch_duplicates = 0
 
     @property
     def _apis(self):
         return self.__apis
 
+    @contextlib.contextmanager
+    def _collect(self):
+        """这期间 _run_batch 不下载，只把任务按 job_key 去重后收集起来，
+        得到 {进度条单位: (任务, 交给 run_threads 的参数)}"""
+        self._batch, self._batch_keys, self._batch_duplicates = {}, set(), 0
+        try:
+            yield self._batch
+        finally:
+            self._batch = None
+
+    def _run_batch(
+        self,
+        threads: list[WorkerThread],
+        savedir: str,
+        options: dict[str, Any],
+        job_ids: Optional[list[int]] = None,
+        **kwargs,
+    ):
+        """先预检再下载，kwargs 交给 run_threads
+
+        开了任务记录（bilicore.jobstore）的话，下载的任务都会记下来，中断了可以 --resume；
+        job_ids 是已经记下来的任务（--resume 时），和 threads 一一对应"""
+        if self._batch is not None:
+            collected, _ = self._batch.setdefault(kwargs.get("unit", "B"), ([], kwargs))
+            for thread in threads:
+                if thread.job_key in self._batch_keys:
+                    self._batch_duplicates += 1
+                    continue
+                self._batch_keys.add(thread.job_key)
+                collected.append(thread)
+            return None
+        kwargs.setdefault("max_prepare", options.get("max_prepare"))
+        kwargs.setdefault("order", options.get("job_order", "fifo"))
+        ids = dict(zip(map(id, threads), job_ids or []))
+        if not options.get("no_preflight"):
+            threads = utils.preflight(
+                threads,
+                savedir,
+                max_worker=kwargs.get("max_worker", 4),
+                yes=options.get("yes"),
+            )
+            if not threads:
+                return None
+        if (store := jobstore.store) is None:
+            return utils.run_threads(threads, **kwargs)
+        if job_ids is None:
+            # 预检时取到的信息一起记下来
+            ids = dict(
+                zip(
+                    map(id, threads),
+                    store.add_batch(
+                        options.get("input", ""),
+                        [(type(t).__name__, t.job_args) for t in threads],
+                    ),
+                )
+            )
+
+        def record(i: int, stage: str):
+            thread = threads[i]
+            store.update(
+                ids[id(thread)],
+                stage,
+                args=thread.job_args,
+                files=thread.temp_files,
+                error="; ".join(map(str, thread.exceptions)) or None,
+            )
+
+        try:
+            return utils.run_threads(threads, on_stage=record, **kwargs)
+        finally:
+            # 被打断了的话没做完的任务要能马上 --resume
+            store.release(list(ids.values()))
+            store.clear_done()
+
+    @check_exceptions
+    def _resume_process(self, **options):
+        if (store := jobstore.store) is None or not (jobs := store.unfinished()):
+            print("No unfinished job")
+            return
+        printers.print_unfinished_jobs(jobs)
+        if options.get("dry_run"):
+            return
+        if not utils.ask_confirm(yes=options.get("yes")):
+            return
+        # 列出来之后可能被别的进程拿走了，只下拿到的
+        claimed = set(store.claim([job["id"] for job in jobs]))
+        if len(claimed) < len(jobs):
+            print(f"{len(jobs) - len(claimed)} job(s) taken by another process")
+        # 预检按各自的保存目录来
+        groups: dict[str, list[dict[str, Any]]] = {}
+        for job in jobs:
+            if job["id"] in claimed:
+                groups.setdefault(job["args"]["savedir"], []).append(job)
+        print("\nstarting download...\n")
+        excs: list[Exception] = []
+        for savedir, group in groups.items():
+            threads = [
+                JOB_KINDS[job["kind"]](self._apis, **job["args"]) for job in group
+            ]
+            excs += (
+                self._run_batch(
+                    threads,
+                    savedir,
+                    options,
+                    job_ids=[job["id"] for job in group],
+                    max_worker=options.get("max_worker", 4),
+                )
+                or []
+            )
+        return excs
+
     @check_exceptions
     def _common_video_process(
         self, savedir: Optional[str], *, avid=None, bvid=None, **options
@@ -60,7 +193,7 @@ class CliCore:
         if not pages:
             print("No episode to handle")
             return
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleVideoThread(
                     self._apis,
@@ -72,6 +205,8 @@ class CliCore:
                 )
                 for page in pages
             ],
+            savedir,
+            options,
             max_worker=options.get("max_worker", 4),
         )
 
@@ -104,7 +239,7 @@ class CliCore:
         if not eps_to_handle:
             print("No episode to handle")
             return
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleVideoThread(
                     self._apis,
@@ -118,6 +253,8 @@ class CliCore:
                 )
                 for i, ep in eps_to_handle
             ],
+            savedir,
+            options,
             max_worker=options.get("max_worker", 4),
         )
 
@@ -144,13 +281,15 @@ class CliCore:
         if not eps_to_handle:
             print("No episode to handle")
             return
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleMangaChapterThread(
                     apis=self._apis, epid=ep["id"], savedir=savedir
                 )
                 for ep in eps_to_handle
             ],
+            savedir,
+            options,
             max_worker=options.get("max_worker", 4),
             unit="it",
         )
@@ -165,7 +304,7 @@ class CliCore:
         if not utils.ask_confirm(yes=options.get("yes")):
             return
         print("\nstarting download...\n")
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleAudioThread(
                     self._apis,
@@ -174,7 +313,9 @@ class CliCore:
                     **options,
                     audio_data=audio_info,
                 )
-            ]
+            ],
+            savedir,
+            options,
         )
 
     @check_exceptions
@@ -196,7 +337,7 @@ class CliCore:
             return
         print("\nstarting download...\n")
         pindexs = utils.parse_index_option(options.get("index"))
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleAudioThread(
                     self._apis,
@@ -207,7 +348,9 @@ class CliCore:
                 )
                 for i, song in enumerate(songlist)
                 if i + 1 in pindexs or not pindexs
-            ]
+            ],
+            savedir,
+            options,
         )
 
     @check_exceptions
@@ -240,19 +383,21 @@ class CliCore:
         if not utils.ask_confirm(yes=options.get("yes")):
             return
         pindexs = utils.parse_index_option(options.get("index"))
-        videos_to_handle = videos_to_handle = utils.process_videolist_to_pagelist(
+        videos_to_handle = utils.process_videolist_to_pagelist(
             self._apis, videos, pindexs
         )
         if not videos_to_handle:
             print("No episode to handle")
             return
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleVideoThread(
                     self._apis, cid=cid, bvid=bvid, savedir=savedir, **options
                 )
                 for bvid, cid in videos_to_handle
-            ]
+            ],
+            savedir,
+            options,
         )
 
     @check_exceptions
@@ -291,11 +436,13 @@ class CliCore:
         if not videos_to_handle:
             print("No episode to handle")
             return
-        return utils.run_threads(
+        return self._run_batch(
             [
                 SingleVideoThread(
                     self._apis, cid=cid, bvid=bvid, savedir=savedir, **options
                 )
                 for bvid, cid in videos_to_handle
-            ]
+            ],
+            savedir,
+            options,
         )
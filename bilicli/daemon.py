@@ -0,0 +1,285 @@
+import os
+import hmac
+import json
+import secrets
+import logging
+import argparse
+import threading
+import contextlib
+from queue import Queue
+from typing import Any, Callable, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from biliapis.utils import remove_none
+from . import utils
+
+__all__ = ["Daemon", "DEFAULT_PORT", "client_main"]
+
+DEFAULT_PORT = 19198
+# 只在本机监听
+HOST = "127.0.0.1"
+TOKEN_HEADER = "X-Daemon-Token"
+# 客户端的这些参数是给客户端自己用的，不发给常驻进程
+CLIENT_ONLY_OPTIONS = (
+    "client",
+    "daemon",
+    "daemon_port",
+    "debug",
+    "data_filepath",
+    "version",
+    "login",
+    "logout",
+    "resume",
+)
+# 这些在常驻进程启动时就定下了，一个任务改不了
+PROCESS_OPTIONS = (
+    "limit_rate",
+    "limit_host_rate",
+    "max_host_connections",
+    "max_postproc",
+    "postproc_nice",
+)
+
+# (输入, 保存目录, 选项) -> 出错的异常
+SourceRunner = Callable[[str, Optional[str], dict[str, Any]], Optional[list[Exception]]]
+
+
+class Daemon:
+    """常驻进程：登录状态、WBI 密钥、缓存、连接池和收尾队列都一直留着，
+    从本机的 HTTP 端口接收任务，一个接一个地做，省掉每次启动的准备工作
+
+    - POST /jobs      提交任务，内容是命令行选项组成的 JSON，至少要有 input 和 output
+    - GET  /jobs      所有任务的状态
+    - GET  /jobs/<id> 一个任务的状态
+
+    浏览器里的网页也能往本机端口发请求，所以每个请求都要带上 token，
+    Host 必须是本机地址（防 DNS rebinding），POST 的内容必须是 application/json；
+    token 写在只有当前用户能读的 token_file 里，给 --client 用"""
+
+    # 最多记住这么多个做完的任务
+    MAX_HISTORY = 500
+
+    def __init__(
+        self,
+        run: SourceRunner,
+        port: int = DEFAULT_PORT,
+        token_file: Optional[str] = None,
+    ) -> None:
+        self._run = run
+        self.token = secrets.token_urlsafe(32)
+        self._token_file = token_file
+        self._queue: Queue[int] = Queue()
+        self._lock = threading.Lock()
+        self._jobs: dict[int, dict[str, Any]] = {}
+        self._options: dict[int, dict[str, Any]] = {}
+        self._next_id = 1
+        self._server = ThreadingHTTPServer((HOST, port), _Handler)
+        self._server.owner = self  # type: ignore[attr-defined]
+        if token_file:
+            self._write_token(token_file)
+
+    def _write_token(self, path: str):
+        # 先删掉旧的，新建时就是只有自己能读写，不留能被别人读到的空档
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(self.token)
+
+    def allowed_hosts(self) -> tuple[str, ...]:
+        return (f"{HOST}:{self.port}", f"localhost:{self.port}")
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def submit(self, options: Any) -> dict[str, Any]:
+        """排进一个任务，返回它的状态；选项不对时抛出 ValueError"""
+        if not isinstance(options, dict):
+            raise ValueError("options should be a JSON object")
+        for key in ("input", "output"):
+            if not isinstance(options.get(key), str):
+                raise ValueError(f"{key} is required")
+        if fixed := [k for k in PROCESS_OPTIONS if options.get(k) is not None]:
+            raise ValueError(
+                "set these when starting the daemon instead: "
+                + ", ".join("--" + k.replace("_", "-") for k in fixed)
+            )
+        # 常驻进程没人回答确认
+        options = options | {"yes": True}
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            self._jobs[job_id] = {
+                "id": job_id,
+                "input": options["input"],
+                "output": options["output"],
+                "state": "queued",
+                "errors": [],
+            }
+            self._options[job_id] = options
+            job = self._jobs[job_id].copy()
+        self._queue.put(job_id)
+        logging.info("job %d queued: %s", job_id, options["input"])
+        return job
+
+    def jobs(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [job.copy() for job in self._jobs.values()]
+
+    def job(self, job_id: int) -> Optional[dict[str, Any]]:
+        with self._lock:
+            return job.copy() if (job := self._jobs.get(job_id)) else None
+
+    def serve(self):
+        """开始接收任务，直到 shutdown 或者 Ctrl-C"""
+        threading.Thread(target=self._worker, daemon=True).start()
+        print(f"daemon listening on http://{HOST}:{self.port}")
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+            if self._token_file:
+                with contextlib.suppress(OSError):
+                    os.remove(self._token_file)
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def _set(self, job_id: int, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _worker(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                options = self._options.pop(job_id)
+            self._set(job_id, state="running")
+            try:
+                excs = self._run(options["input"], options["output"], options)
+            except Exception as e:
+                logging.error("job %d failed: %s", job_id, e, exc_info=True)
+                excs = [e]
+            self._set(
+                job_id,
+                state="failed" if excs else "done",
+                errors=[str(e) for e in excs or []],
+            )
+            self._forget()
+
+    def _forget(self):
+        with self._lock:
+            finished = [
+                i for i, job in self._jobs.items() if job["state"] in ("done", "failed")
+            ]
+            for i in finished[: max(len(finished) - self.MAX_HISTORY, 0)]:
+                del self._jobs[i]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _check(self, daemon: Daemon) -> bool:
+        """不是本机客户端发来的请求回复错误，返回 False"""
+        if self.headers.get("Host") not in daemon.allowed_hosts():
+            self._reply(403, {"error": "bad host"})
+            return False
+        if not hmac.compare_digest(
+            self.headers.get(TOKEN_HEADER, "").encode(), daemon.token.encode()
+        ):
+            self._reply(403, {"error": "bad token"})
+            return False
+        return True
+
+    def _reply(self, code: int, data: Any):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # pylint: disable=C0103
+        daemon: Daemon = self.server.owner  # type: ignore[attr-defined]
+        if not self._check(daemon):
+            return
+        if self.headers.get_content_type() != "application/json":
+            self._reply(415, {"error": "content type should be application/json"})
+            return
+        if self.path.rstrip("/") != "/jobs":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = daemon.submit(json.loads(self.rfile.read(length) or b"null"))
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        self._reply(202, job)
+
+    def do_GET(self):  # pylint: disable=C0103
+        daemon: Daemon = self.server.owner  # type: ignore[attr-defined]
+        if not self._check(daemon):
+            return
+        path = self.path.rstrip("/")
+        if path == "/jobs":
+            self._reply(200, daemon.jobs())
+            return
+        _, _, job_id = path.rpartition("/jobs/")
+        if job_id.isdigit() and (job := daemon.job(int(job_id))):
+            self._reply(200, job)
+            return
+        self._reply(404, {"error": "not found"})
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        logging.debug("daemon: " + format, *args)
+
+
+def client_main(args: argparse.Namespace, token_file: str):
+    """客户端：把这次的输入和选项交给常驻进程，不给输入的话列出常驻进程里的任务；
+    `@FILE` 在这边读出来，每个输入交一个任务"""
+    url = f"http://{HOST}:{args.daemon_port}/jobs"
+    not_running = (
+        f"daemon not running on port {args.daemon_port}, start one with --daemon"
+    )
+    try:
+        with open(token_file, encoding="utf-8") as fp:
+            headers = {TOKEN_HEADER: fp.read().strip()}
+    except FileNotFoundError:
+        print(not_running)
+        return
+    if args.input is not None and (args.output is None or args.dry_run):
+        print("the daemon only downloads, give an output folder with -o")
+        return
+    sources: list[Optional[str]] = [args.input]
+    if args.input is not None and args.input.startswith("@"):
+        sources = list(utils.read_sources(args.input))
+    options = {
+        k: v for k, v in remove_none(vars(args)).items() if k not in CLIENT_ONLY_OPTIONS
+    }
+    if args.output is not None:
+        # 常驻进程的工作目录不一定和这里一样
+        options["output"] = os.path.abspath(args.output)
+    for source in sources:
+        try:
+            if source is None:
+                resp = requests.get(url, headers=headers, timeout=10)
+            else:
+                resp = requests.post(
+                    url, json=options | {"input": source}, headers=headers, timeout=10
+                )
+        except requests.ConnectionError:
+            print(not_running)
+            return
+        data = resp.json()
+        if not resp.ok:
+            print(f"rejected: {data.get('error')}")
+            return
+        for job in data if isinstance(data, list) else [data]:
+            print(
+                "#{id:<5d} {state:<7s} {input} -> {output}".format(**job)
+                + (f" ({len(job['errors'])} error(s))" if job["errors"] else "")
+            )
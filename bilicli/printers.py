@@ -186,3 +186,19 @@ def print_index_option(index_s: Optional[str]):
             print(f"{int(part)}", end="")
         fr_flag = True
     print("\nNote: out-of-range index(s) will be ignored")
+
+
+def print_unfinished_jobs(jobs: list[dict[str, Any]]):
+    batches: dict[str, list[dict[str, Any]]] = {}
+    for job in jobs:
+        batches.setdefault(job["batch"], []).append(job)
+    print(f"\n{len(jobs)} unfinished job(s) in {len(batches)} batch(es)")
+    for batch, batch_jobs in batches.items():
+        stages: dict[str, int] = {}
+        for job in batch_jobs:
+            stages[job["stage"]] = stages.get(job["stage"], 0) + 1
+        print(
+            f"{batch or '(unknown source)'}: "
+            + ", ".join(f"{count} {stage}" for stage, count in stages.items())
+        )
+    print()
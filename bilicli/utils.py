@@ -1,13 +1,18 @@
-from typing import Sequence, Optional, Callable, Any, NewType, Protocol
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Sequence, Optional, Callable, Any, NewType, Protocol, Literal
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import shutil
 import logging
-import time
-from queue import Queue
+from queue import Queue, PriorityQueue
 from threading import Lock
 
 from tqdm import tqdm
 
 from biliapis import APIContainer
+from bilicore.utils import ProgressNotifier
+from bilicore.postproc import processor
+from bilicore.ratelimit import limiter
 from .hints import WorkerThread
 
 
@@ -32,54 +37,323 @@ class BarPosAssigner:
 
 def update_progress(pgrbar: tqdm, thread: WorkerThread):
     curr, total, text = thread.observe()
-    pgrbar.set_description(text)
+    pgrbar.set_description(text, refresh=False)
     pgrbar.n = curr
     pgrbar.total = total
+    pgrbar.refresh()
 
 
-def run_thread_with_tqdm(
+def _run_thread(thread: WorkerThread, notifier: ProgressNotifier):
+    thread.start()
+    thread.join()
+    notifier.notify()
+    return thread
+
+
+def schedule(
+    threads: Sequence[WorkerThread],
+    order: Literal["fifo", "shortest", "longest"] = "fifo",
+    priorities: Optional[Sequence[float]] = None,
+) -> list[int]:
+    """排出任务开始的顺序，返回下标
+
+    给了 priorities 的按它从大到小排；否则按预检估出来的大小（estimated_size）排，
+    shortest 先下小的，早点有下好的文件，longest 先下大的，免得大任务拖在最后。
+    估不出大小的排在最后，一样大的保持原来的顺序"""
+    indexes = list(range(len(threads)))
+    if priorities is not None:
+        return sorted(indexes, key=lambda i: -priorities[i])
+    if order == "fifo":
+        return indexes
+    sizes = [getattr(thread, "estimated_size", None) for thread in threads]
+    if all(size is None for size in sizes):
+        logging.info("job sizes unknown, run jobs in the given order")
+    sign = 1 if order == "shortest" else -1
+    return sorted(indexes, key=lambda i: (sizes[i] is None, sign * (sizes[i] or 0)))
+
+
+class _Pipeline:
+    """准备 -> 传输两段，中间是有界的优先队列；收尾在 bilicore.postproc 的队列里
+
+    准备阶段最多领先传输阶段 queue_size 个任务，不会把整个合集的流地址都提前取好放到过期；
+    任务按 order 的顺序开始准备，准备好的按同样的顺序先后下载"""
+
+    def __init__(
+        self,
+        threads: Sequence[WorkerThread],
+        notifier: ProgressNotifier,
+        max_prepare: int,
+        max_worker: int,
+        queue_size: int,
+        order: list[int],
+    ) -> None:
+        self._threads = threads
+        self._notifier = notifier
+        self._max_prepare = max_prepare
+        self._max_worker = max_worker
+        self._todo = iter(order)
+        self._rank = {i: rank for rank, i in enumerate(order)}
+        # (名次, 下标)，下标为 -1 的是让传输线程退出的标记，排在所有任务后面
+        self._prepared: PriorityQueue[tuple[int, int]] = PriorityQueue(
+            maxsize=queue_size
+        )
+        self._lock = Lock()
+        self._preparers_left = max_prepare
+        self._started: set[int] = set()
+        self._transferring: set[int] = set()
+        self._finished: set[int] = set()
+
+    def start(self, preparers: ThreadPoolExecutor, transferers: ThreadPoolExecutor):
+        for _ in range(self._max_prepare):
+            preparers.submit(self._prepare_worker)
+        for _ in range(self._max_worker):
+            transferers.submit(self._transfer_worker)
+
+    def state(self) -> tuple[set[int], set[int], set[int]]:
+        """(进入流水线的任务, 开始下载的任务, 下载结束的任务)"""
+        with self._lock:
+            return (
+                self._started.copy(),
+                self._transferring.copy(),
+                self._finished.copy(),
+            )
+
+    def _prepare_worker(self):
+        try:
+            while True:
+                with self._lock:
+                    i = next(self._todo, None)
+                    if i is None:
+                        break
+                    self._started.add(i)
+                if self._threads[i].prepare():
+                    self._prepared.put((self._rank[i], i))
+                else:
+                    # 出错了或者不需要下载的，不占传输的位置
+                    with self._lock:
+                        self._finished.add(i)
+                    self._notifier.notify()
+        finally:
+            with self._lock:
+                self._preparers_left -= 1
+                last = not self._preparers_left
+            if last:
+                for _ in range(self._max_worker):
+                    self._prepared.put((len(self._threads), -1))
+
+    def _transfer_worker(self):
+        while (i := self._prepared.get()[1]) >= 0:
+            with self._lock:
+                self._transferring.add(i)
+            try:
+                _run_thread(self._threads[i], self._notifier)
+            finally:
+                with self._lock:
+                    self._finished.add(i)
+
+
+def _stage_of(
     thread: WorkerThread,
-    pos_assigner: Optional[BarPosAssigner] = None,
-    interval=0.05,
+    i: int,
+    started: set[int],
+    transferring: set[int],
+    finished: set[int],
+) -> str:
+    if i in finished:
+        if thread.post_pending:
+            return "post"
+        return "failed" if thread.exceptions else "done"
+    if i in transferring:
+        return "transferring"
+    return "preparing" if i in started else "pending"
+
+
+def run_threads(
+    threads: Sequence[WorkerThread],
+    max_worker=4,
     unit="B",
+    refresh_interval=0.1,
+    heartbeat_interval=1.0,
+    max_prepare: Optional[int] = None,
+    queue_size: Optional[int] = None,
+    order: Literal["fifo", "shortest", "longest"] = "fifo",
+    priorities: Optional[Sequence[float]] = None,
+    on_stage: Optional[Callable[[int, str], Any]] = None,
 ):
-    pos = pos_assigner.get() if pos_assigner else None
-    with tqdm(unit=unit, unit_scale=True, position=pos, leave=False) as pgrbar:
-        thread.start()
-        while thread.is_alive():
-            update_progress(pgrbar, thread)
-            time.sleep(interval)
-        update_progress(pgrbar, thread)
-        if thread.exceptions:
-            pgrbar.leave = True
-        elif pos_assigner:
-            pos_assigner.put(pos)
-    return thread
+    """用三段流水线跑一批任务线程，显示进度条
 
+    1. 准备：取信息、选流、下字幕封面，等的是 API，max_prepare 个同时进行，默认同 max_worker
+    2. 传输：下载，max_worker 个同时进行；准备好的任务在长度为 queue_size 的队列里等着，
+       默认同 max_worker
+    3. 收尾：ffmpeg 交给 bilicore.postproc 的队列，下载部分结束后就让出传输的位置，
+       收尾也做完才算完成
 
-def run_threads(threads: Sequence[WorkerThread], max_worker=4, unit="B"):
+    任务的先后见 schedule；任务进入新的阶段时调用 on_stage(下标, 阶段)，
+    阶段见 bilicore.jobstore.STAGES
+
+    任务有进度时会通知过来，所有进度条都由这一个循环刷新：有变化时醒来，
+    最快每 refresh_interval 秒刷新一次，没有变化时每 heartbeat_interval 秒刷新一次"""
     exceptions: list[Exception] = []
-    assigner = BarPosAssigner(max_worker)
-    with ThreadPoolExecutor(max_workers=max_worker) as executor:
-        futures = [
-            executor.submit(run_thread_with_tqdm, thread, assigner, unit=unit)
-            for thread in threads
-        ]
-        for future in tqdm(
-            as_completed(futures),
-            total=len(threads),
-            desc="Overall",
-            leave=True,
-            position=0,
-        ):
-            thread = future.result()
-            if _ := thread.exceptions:
-                exceptions += _
-                for e in _:
-                    logging.error("exception from child thread: %s", e, exc_info=True)
+    max_prepare = max_prepare or max_worker
+    assigner = BarPosAssigner(max_worker + max_prepare)
+    notifier = ProgressNotifier(min_interval=refresh_interval)
+    for thread in threads:
+        thread.set_notifier(notifier)
+        thread.set_postproc(processor)
+    pipeline = _Pipeline(
+        threads,
+        notifier,
+        max_prepare,
+        max_worker,
+        queue_size or max_worker,
+        schedule(threads, order, priorities),
+    )
+    bars: dict[int, tuple[tqdm, int]] = {}
+    with ThreadPoolExecutor(
+        max_workers=max_prepare, thread_name_prefix="bilicli-prepare"
+    ) as preparers, ThreadPoolExecutor(
+        max_workers=max_worker, thread_name_prefix="bilicli-transfer"
+    ) as transferers, tqdm(
+        total=len(threads), desc="Overall", leave=True, position=0
+    ) as overall:
+        pipeline.start(preparers, transferers)
+        pending = set(range(len(threads)))
+        stages = ["pending"] * len(threads)
+        while pending:
+            notifier.wait(heartbeat_interval)
+            started, transferring, finished = pipeline.state()
+            for i in sorted(pending):
+                thread = threads[i]
+                done = i in finished and not thread.post_pending
+                if on_stage is not None:
+                    stage = _stage_of(thread, i, started, transferring, finished)
+                    if stage != stages[i]:
+                        stages[i] = stage
+                        on_stage(i, stage)
+                if i not in bars and i in started and not done:
+                    pos = assigner.get()
+                    bars[i] = (
+                        tqdm(unit=unit, unit_scale=True, position=pos, leave=False),
+                        pos,
+                    )
+                if i in bars:
+                    update_progress(bars[i][0], thread)
+                if not done:
+                    continue
+                pending.remove(i)
+                overall.update(1)
+                if i in bars:
+                    pgrbar, pos = bars.pop(i)
+                    if thread.exceptions:
+                        pgrbar.leave = True
+                    else:
+                        assigner.put(pos)
+                    pgrbar.close()
+                if _ := thread.exceptions:
+                    exceptions += _
+                    for e in _:
+                        logging.error(
+                            "exception from child thread: %s", e, exc_info=True
+                        )
     return exceptions
 
 
+def free_space(path: str) -> int:
+    """path 所在分区的剩余空间，path 还没创建的话看它最近的已存在的上级目录"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def _estimate(thread: WorkerThread) -> tuple[Optional[int], Optional[float]]:
+    try:
+        return thread.estimate()
+    except Exception as e:
+        # 估不出来就算了，真下载的时候再报错
+        logging.warning("preflight failed: %s", e, exc_info=True)
+        return None, None
+
+
+def preflight(
+    threads: Sequence[WorkerThread],
+    savedir: str,
+    max_worker=4,
+    yes=False,
+    show_progress=True,
+) -> list[WorkerThread]:
+    """开始下载前同时估计每个任务的大小，显示总大小和预计耗时，检查 savedir 的剩余空间
+
+    临时文件也写在 savedir 里，合流时临时文件和成品同时存在，所以要在总大小之外
+    再留出最大的那个任务的空间；放不下时从前往后留下放得下的任务，确认后只下载这些，
+    一个都放不下就放弃。返回要下载的任务"""
+    threads = list(threads)
+    if not all(hasattr(t, "estimate") for t in threads):
+        return threads
+    with ThreadPoolExecutor(max_workers=min(len(threads), 8) or 1) as executor, tqdm(
+        desc="Preflight", total=len(threads), leave=False, disable=not show_progress
+    ) as pgrbar:
+        futures = [executor.submit(_estimate, thread) for thread in threads]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            pgrbar.update(1)
+    sizes = [size or 0 for size, _ in results]
+    total = sum(sizes)
+    unknown = sum(1 for size, _ in results if size is None)
+    # 没有速度记录的任务按有记录的平均速度算，同时跑 max_worker 个
+    speeds = [speed for size, speed in results if speed and size]
+    eta: Optional[float] = None
+    if speeds:
+        average = sum(speeds) / len(speeds)
+        eta = sum(
+            size / (speed or average) for size, (_, speed) in zip(sizes, results)
+        ) / max(min(max_worker, sum(1 for size in sizes if size)), 1)
+    if limiter.rate:
+        eta = max(eta or 0, total / limiter.rate)
+    space = free_space(savedir)
+    print(
+        f"{len(threads)} job(s), about {tqdm.format_sizeof(total, 'B', 1024)}"
+        + (f", {unknown} of unknown size" if unknown else "")
+        + ", ETA "
+        + ("unknown" if eta is None else tqdm.format_interval(eta))
+    )
+    print(f"free space: {tqdm.format_sizeof(space, 'B', 1024)}")
+    if total + max(sizes, default=0) <= space:
+        return threads
+    kept: list[WorkerThread] = []
+    used = largest = 0
+    for thread, size in zip(threads, sizes):
+        if used + size + max(largest, size) <= space:
+            kept.append(thread)
+            used += size
+            largest = max(largest, size)
+    if not used:
+        print("not enough space for any of the jobs, abort")
+        return []
+    print(f"not enough space, only {len(kept)} of {len(threads)} job(s) fit")
+    if not ask_confirm(yes=yes, prompt="Download these only? (Y/N): "):
+        return []
+    return kept
+
+
+def read_sources(arg: str) -> list[str]:
+    """-i @文件 给出的一批输入，@- 为从标准输入读；一行一个，跳过空行和 # 开头的行，
+    重复的只留第一个"""
+    if arg == "@-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(arg[1:], "r", encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+    return list(
+        dict.fromkeys(
+            line.strip()
+            for line in lines
+            if line.strip() and not line.strip().startswith("#")
+        )
+    )
+
+
 def parse_index_option(index_s: Optional[str]) -> set[int]:
     result: set[int] = set()
     if not index_s:
@@ -133,27 +407,51 @@ def query_all_pages(
     return data, pages
 
 
-def process_videolist_to_pagelist(
+def _pages_of(apis: APIContainer, video: dict[str, Any]) -> list[tuple[str, int]]:
+    bvid = video["bvid"]
+    # 列表里已经带了分P信息的就不用再查
+    if pages := video.get("pages"):
+        return [(bvid, page["cid"]) for page in pages]
+    if video.get("cid") and video.get("videos") == 1:
+        return [(bvid, video["cid"])]
+    return [(bvid, page["cid"]) for page in apis.video.get_pagelist(bvid=bvid)]
+
+
+def iter_videolist_pages(
     apis: APIContainer,
     videolist: list[dict[str, Any]],
     pindexs: set[int],
     show_progress: bool = True,
-) -> list[tuple[str, int]]:
-    result = []
-    with tqdm(
+    max_workers: int = 8,
+):
+    """同时查最多 max_workers 个视频的分P，按列表的顺序边查边给出 (bvid, cid)"""
+    videos = [v for i, v in enumerate(videolist) if i + 1 in pindexs or not pindexs]
+    with ThreadPoolExecutor(
+        max_workers=min(len(videos), max_workers) or 1
+    ) as executor, tqdm(
         desc="Processing video list",
         leave=False,
         disable=not show_progress,
-        total=len(videolist),
+        total=len(videos),
     ) as pgrbar:
-        for i, video in enumerate(videolist):
-            if i + 1 in pindexs or not pindexs:
-                bvid = video["bvid"]
-                pagelist = apis.video.get_pagelist(bvid=bvid)
-                result.extend([(bvid, page["cid"]) for page in pagelist])
-            pgrbar.n = i + 1
-            pgrbar.refresh()
-    return result
+        futures = [executor.submit(_pages_of, apis, video) for video in videos]
+        try:
+            for future in futures:
+                yield from future.result()
+                pgrbar.update(1)
+        finally:
+            # 中途出错或者不要了，还没开始的就不查了
+            for future in futures:
+                future.cancel()
+
+
+def process_videolist_to_pagelist(
+    apis: APIContainer,
+    videolist: list[dict[str, Any]],
+    pindexs: set[int],
+    show_progress: bool = True,
+) -> list[tuple[str, int]]:
+    return list(iter_videolist_pages(apis, videolist, pindexs, show_progress))
 
 
 def ask_confirm(yes=False, prompt="Continue? (Y/N): "):
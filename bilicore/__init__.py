@@ -1,3 +1,5 @@
 from bilicore import threads, utils, downloader, parser
+from bilicore import hostrank, ratelimit, integrity, watchdog, aio
+from bilicore import pipemerge, postproc, mp4mux, jobstore
 
-VERSION = "1.0.0-beta"
\ No newline at end of file
+VERSION = "1.0.0-beta"
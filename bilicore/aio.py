@@ -0,0 +1,890 @@
+"""基于 asyncio 的下载引擎
+
+所有传输都作为协程跑在同一个后台事件循环上，一条连接不再需要一个线程，
+用法和 bilicore.downloader.download_common 一致，调用方的线程阻塞等待结果即可
+
+HTTP 部分是直接在 asyncio 的流上实现的一个最小的 HTTP/1.1 客户端，
+只支持下载需要的那些功能：GET/HEAD、重定向、Content-Length 和 chunked、连接复用
+
+写文件放在每个下载自己的写线程里，事件循环只管收数据"""
+
+import os
+import ssl
+import time
+import zlib
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Coroutine, Iterable, Optional
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from biliapis.constants import CDN_TIMEOUT
+from bilicore import hostrank
+from bilicore.ratelimit import limiter
+from bilicore.watchdog import StallError, ThroughputMeter, watchdog
+from bilicore.integrity import (
+    IntegrityError,
+    StreamDigest,
+    expected_digests,
+    validator_of,
+)
+from bilicore.downloader import (
+    Backoff,
+    MirrorPool,
+    MultiThreadDownloader,
+    RangeJournal,
+    RangeSegment,
+    RangeSplitter,
+    ReceiveBuffer,
+    content_encoded,
+    contiguous_size,
+    load_done_ranges,
+    media_headers,
+    plan_ranges,
+    verify_file,
+    write_all,
+)
+
+__all__ = ["AsyncHTTPClient", "AsyncResponse", "AsyncEngine", "get_engine"]
+
+_ConnKey = tuple[str, str, int]
+
+# 连接中途断掉时可能抛出的异常，这些情况可以重新连接接着下载
+RESET_ERRORS = (ConnectionError, TimeoutError, asyncio.IncompleteReadError)
+
+
+class AsyncResponse:
+    """AsyncHTTPClient.request 返回的响应，响应体需要自己 read，用完要 aclose"""
+
+    def __init__(
+        self,
+        client: "AsyncHTTPClient",
+        key: _ConnKey,
+        url: str,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        status: int,
+        headers: CaseInsensitiveDict,
+        has_body: bool = True,
+    ) -> None:
+        self._client = client
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self._chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+        self._keepalive = headers.get("Connection", "").lower() != "close"
+        self._remaining: Optional[int] = None  # None 表示读到连接关闭为止
+        if not has_body:
+            self._remaining = 0
+        elif self._chunked:
+            self._remaining = 0
+            self._chunk_eof = False
+        elif (length := headers.get("Content-Length", "")).isdigit():
+            self._remaining = int(length)
+        else:
+            self._keepalive = False
+        self._closed = False
+
+    @property
+    def finished(self) -> bool:
+        if self._chunked:
+            return self._chunk_eof
+        return self._remaining == 0
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise requests.HTTPError(f"{self.status} Error for url: {self.url}")
+
+    async def _next_chunk(self):
+        size = int((await self._reader.readline()).split(b";")[0].strip() or b"0", 16)
+        if size == 0:
+            # 跳过 trailer
+            while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            self._chunk_eof = True
+        self._remaining = size
+
+    async def read(self, size: int = 2**16) -> bytes:
+        """读至多 size 个字节，读完了返回 b\"\" """
+        if self._chunked:
+            if self._chunk_eof:
+                return b""
+            if self._remaining == 0:
+                await self._next_chunk()
+                if self._chunk_eof:
+                    return b""
+            data = await self._reader.read(min(size, self._remaining))
+            if not data:
+                raise ConnectionError("connection closed while reading chunk")
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                await self._reader.readline()  # 块结尾的 CRLF
+            return data
+        if self._remaining is None:
+            return await self._reader.read(size)
+        if self._remaining == 0:
+            return b""
+        data = await self._reader.read(min(size, self._remaining))
+        if not data:
+            raise ConnectionError(
+                f"connection closed early with {self._remaining} bytes left"
+            )
+        self._remaining -= len(data)
+        return data
+
+    async def aclose(self):
+        """响应体读完了就把连接还回去复用，否则直接断开"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._keepalive and self.finished:
+            self._client._put_conn(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+
+class AsyncHTTPClient:
+    """只能在创建它的事件循环里用"""
+
+    MAX_REDIRECTS = 5
+    CONNECT_TIMEOUT, READ_TIMEOUT = CDN_TIMEOUT
+    # 每个主机最多留着的空闲连接数
+    MAX_IDLE_PER_HOST = 32
+
+    def __init__(self) -> None:
+        self._ssl = ssl.create_default_context()
+        self._idle: dict[_ConnKey, list] = {}
+
+    def _put_conn(self, key: _ConnKey, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.MAX_IDLE_PER_HOST and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def _get_conn(self, key: _ConnKey):
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def _connect(self, key: _ConnKey):
+        scheme, host, port = key
+        return await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port,
+                ssl=self._ssl if scheme == "https" else None,
+                server_hostname=host if scheme == "https" else None,
+            ),
+            self.CONNECT_TIMEOUT,
+        )
+
+    async def _request_once(
+        self, method: str, url: str, headers: dict[str, str]
+    ) -> AsyncResponse:
+        parsed = urlparse(url)
+        scheme = parsed.scheme.lower()
+        if scheme not in ("http", "https") or not parsed.hostname:
+            raise ValueError(f"unsupported url: {url}")
+        port = parsed.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed.hostname, port)
+        path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {parsed.netloc}"]
+        lines += [f"{k}: {v}" for k, v in headers.items() if k.lower() != "host"]
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        conn = self._get_conn(key)
+        # 复用的连接可能已经被服务器关掉了，这种情况换条新连接重试一次
+        for reused in ((True, False) if conn else (False,)):
+            reader, writer = conn if reused else await self._connect(key)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                # 状态行和响应头一起算超时，免得服务器发一半就不动了
+                status, resp_headers = await asyncio.wait_for(
+                    self._read_head(reader), self.READ_TIMEOUT
+                )
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+            except BaseException:
+                writer.close()
+                raise
+            else:
+                return AsyncResponse(
+                    self,
+                    key,
+                    url,
+                    reader,
+                    writer,
+                    status,
+                    resp_headers,
+                    has_body=method != "HEAD" and status not in (204, 304),
+                )
+        raise ConnectionError("unreachable")
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed before response")
+        status = int(status_line.split(None, 2)[1])
+        headers = CaseInsensitiveDict()
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip()] = v.strip()
+        return status, headers
+
+    async def request(
+        self, method: str, url: str, headers: Optional[dict[str, str]] = None
+    ) -> AsyncResponse:
+        headers = dict(headers or {})
+        for _ in range(self.MAX_REDIRECTS + 1):
+            resp = await self._request_once(method, url, headers)
+            if resp.status in (301, 302, 303, 307, 308) and (
+                location := resp.headers.get("Location")
+            ):
+                await resp.aclose()
+                url = urljoin(url, location)
+                continue
+            return resp
+        raise requests.TooManyRedirects(f"exceeded {self.MAX_REDIRECTS} redirects")
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncEngine:
+    """在一个后台线程里跑事件循环，别的线程通过 run 把下载任务交给它并等待结果"""
+
+    JOURNAL_INTERVAL = MultiThreadDownloader.JOURNAL_INTERVAL
+    REPORT_INTERVAL = MultiThreadDownloader.REPORT_INTERVAL
+
+    def __init__(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._client: Optional[AsyncHTTPClient] = None
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, daemon=True, name="bilicore-aio"
+        )
+        self._thread.start()
+
+    @property
+    def client(self) -> AsyncHTTPClient:
+        """只能在事件循环里访问"""
+        if self._client is None:
+            self._client = AsyncHTTPClient()
+        return self._client
+
+    def run(self, coro: Coroutine):
+        """在事件循环上跑 coro 并阻塞到它结束，Ctrl-C 时取消任务"""
+        finished = threading.Event()
+
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                finished.set()
+
+        future = asyncio.run_coroutine_threadsafe(wrapper(), self._loop)
+        try:
+            # 带超时是为了能及时响应 Ctrl-C
+            while not finished.wait(0.5):
+                pass
+        except KeyboardInterrupt:
+            future.cancel()
+            # 等任务把断点记录写完
+            finished.wait()
+            raise
+        return future.result()
+
+    def close(self):
+        async def shutdown():
+            if self._client is not None:
+                self._client.close()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _head(self, pool: MirrorPool, headers: dict[str, str]):
+        """返回能连上的那个地址和它的响应头"""
+        for i, url in enumerate(urls := pool.urls):
+            try:
+                async with await self.client.request("HEAD", url, headers) as resp:
+                    resp.raise_for_status()
+                    return url, resp.headers
+            except (OSError, asyncio.TimeoutError, requests.RequestException):
+                if i + 1 == len(urls):
+                    raise
+
+    async def download(
+        self,
+        url: str,
+        filepath: str,
+        hook_func: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+        threadnum: int = 8,
+        min_range_size: Optional[int] = None,
+        mirrors: Optional[Iterable[str]] = None,
+        headers: Optional[dict[str, str]] = None,
+        buffer_size: Optional[int] = None,
+        trust_etag: bool = False,
+        stall_speed: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
+        prefix_hook: Optional[Callable[[int], Any]] = None,
+    ):
+        """和 MultiThreadDownloader 的行为一致，threadnum 在这里是并发的连接数，
+        buffer_size 是每条连接一次读写的上限"""
+        if os.path.isfile(filepath):
+            return
+        headers = media_headers(headers)
+        pool = MirrorPool([url] + list(mirrors or []))
+        url, head = await self._head(pool, headers)
+        length = -1 if content_encoded(head) else int(head.get("Content-Length", -1))
+        reporter = _Reporter(hook_func, self.REPORT_INTERVAL, prefix_hook)
+        reporter.total = length if length != -1 else None
+        digest = StreamDigest(expected_digests(head, trust_etag))
+        stall = (
+            watchdog.FLOOR if stall_speed is None else stall_speed,
+            watchdog.GRACE if stall_timeout is None else stall_timeout,
+        )
+        block_size = max(buffer_size or ReceiveBuffer.MAX_SIZE, ReceiveBuffer.MIN_SIZE)
+        if head.get("Accept-Ranges") == "bytes" and length > 0:
+            await self._download_multi(
+                pool,
+                filepath,
+                length,
+                headers,
+                reporter,
+                threadnum,
+                min_range_size or MultiThreadDownloader.MIN_RANGE_SIZE,
+                digest,
+                stall,
+                block_size,
+                validator_of(head),
+            )
+        else:
+            await self._download_single(
+                url, filepath, headers, reporter, digest, stall, block_size
+            )
+        hostrank.record_speeds(pool.stats())
+
+    async def _read(
+        self, resp: AsyncResponse, meter: ThroughputMeter, size: int
+    ) -> bytes:
+        """读一块数据，读取超时或者速度低于下限太久时抛出异常"""
+        # 不直接取消 read，免得读了一半的数据丢掉；每隔一会儿检查一下速度
+        task = asyncio.ensure_future(resp.read(size))
+        waited = 0.0
+        try:
+            while not (await asyncio.wait({task}, timeout=meter.interval))[0]:
+                waited += meter.interval
+                if meter.check():
+                    raise StallError(meter.describe())
+                if waited >= self.client.READ_TIMEOUT:
+                    raise TimeoutError(f"read timed out on {resp.url}")
+        finally:
+            task.cancel()
+        chunk = task.result()
+        meter.feed(len(chunk))
+        if meter.check():
+            raise StallError(meter.describe())
+        return chunk
+
+    async def _read_block(
+        self, resp: AsyncResponse, meter: ThroughputMeter, size: int
+    ) -> bytes:
+        """攒够 size 字节再交出去写文件，和 ReceiveBuffer 一样，
+        连接慢的时候读了 TARGET_INTERVAL 秒就先交出去；
+        攒到一半出错时先把攒到的交出去，错误下次读的时候再抛"""
+        chunks: list[bytes] = []
+        got = 0
+        start = time.monotonic()
+        try:
+            while got < size and (chunk := await self._read(resp, meter, size - got)):
+                chunks.append(chunk)
+                got += len(chunk)
+                if time.monotonic() - start >= ReceiveBuffer.TARGET_INTERVAL:
+                    break
+        except RESET_ERRORS:
+            if not chunks:
+                raise
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    async def _download_single(
+        self,
+        url: str,
+        filepath: str,
+        headers: dict[str, str],
+        reporter: "_Reporter",
+        digest: StreamDigest,
+        stall: tuple[float, float],
+        block_size: int,
+    ):
+        tmpfilepath = filepath + ".download"
+        # 和 DownloadThread 一样，上次留下的临时文件接着往后下
+        size = os.path.getsize(tmpfilepath) if os.path.isfile(tmpfilepath) else 0
+        reporter.prefix_of = lambda: reporter.size
+        reporter.update(size, force=True)
+        host = urlparse(url).hostname
+        resumable = False
+
+        async def receive(fp):
+            nonlocal resumable, digest
+            start = reporter.size
+            range_headers = headers | {"Range": f"bytes={start}-"} if start else headers
+            async with await self.client.request("GET", url, range_headers) as resp:
+                resp.raise_for_status()
+                resumable = (
+                    resp.headers.get("Accept-Ranges") == "bytes"
+                    or "Content-Range" in resp.headers
+                )
+                length = resp.headers.get("Content-Length", "")
+                if (decoder := _decoder(resp.headers)) is not None:
+                    # 服务器硬给了压缩过的响应体，长度和摘要说的都是压缩后的，只能整个重新下
+                    resumable, length, digest = False, "", StreamDigest()
+                if start and resp.status != 206:
+                    logging.info("range ignored by server, restart %s", url)
+                    start = 0
+                    await asyncio.to_thread(fp.truncate, 0)
+                    reporter.update(0, force=True)
+                if digest.pos < start:
+                    # 续传前已有的部分先读回来算上
+                    await asyncio.to_thread(digest.feed_file, tmpfilepath, start)
+                reporter.total = start + int(length) if length.isdigit() else None
+                meter = ThroughputMeter(*stall)
+                with _FileWriter(fp, digest, decoder) as sink:
+                    while chunk := await self._read_block(resp, meter, block_size):
+                        if (wait := limiter.reserve(len(chunk), host)) > 0:
+                            await asyncio.sleep(wait)
+                            meter.skip(wait)
+                        written = await sink.write(reporter.size, chunk)
+                        reporter.update(reporter.size + written)
+                    reporter.update(reporter.size + await sink.flush(reporter.size))
+
+        backoff = Backoff()
+        with open(tmpfilepath, "r+b" if size else "wb", buffering=0) as fp:
+            # 连接中途断掉时从断开的地方重新请求，多次没有进展才算失败
+            while True:
+                before = reporter.size
+                try:
+                    await receive(fp)
+                    break
+                except RESET_ERRORS as e:
+                    progressed = reporter.size > before
+                    if not resumable or (delay := backoff.next(progressed)) is None:
+                        raise
+                    logging.warning(
+                        "connection lost at byte %d, resume in %.1fs: %s",
+                        reporter.size,
+                        delay,
+                        e,
+                    )
+                    await asyncio.sleep(delay)
+        try:
+            await asyncio.to_thread(
+                verify_file,
+                tmpfilepath,
+                reporter.total if reporter.total is not None else reporter.size,
+                digest,
+            )
+        except IntegrityError:
+            os.remove(tmpfilepath)
+            raise
+        os.replace(tmpfilepath, filepath)
+        reporter.update(reporter.size, force=True)
+
+    async def _download_multi(
+        self,
+        pool: MirrorPool,
+        filepath: str,
+        total_size: int,
+        headers: dict[str, str],
+        reporter: "_Reporter",
+        threadnum: int,
+        min_range_size: int,
+        digest: StreamDigest,
+        stall: tuple[float, float],
+        block_size: int,
+        validator: Optional[str] = None,
+    ):
+        tmpfilepath = filepath + ".download"
+        journal = RangeJournal(tmpfilepath, total_size, validator)
+        done = load_done_ranges(tmpfilepath, journal, total_size)
+
+        def allocate():
+            mode = "r+b" if os.path.isfile(tmpfilepath) else "wb"
+            with open(tmpfilepath, mode) as fp:
+                fp.truncate(total_size)
+
+        await asyncio.to_thread(allocate)
+        if done and done[0][0] == 0:
+            await asyncio.to_thread(digest.feed_file, tmpfilepath, done[0][1] + 1)
+        reporter.update(sum(end - start + 1 for start, end in done), force=True)
+        ranges = plan_ranges(done, total_size, threadnum, min_range_size)
+        splitter = RangeSplitter(ranges, min_size=min_range_size)
+
+        saving: Optional[asyncio.Future] = None
+
+        async def save_journal():
+            # 存的时候要 fsync，放到线程里做，别卡住所有连接；
+            # 上一次还没存完时先等它，免得旧的盖掉新的
+            nonlocal saving
+            if saving is not None:
+                await asyncio.wait([saving])
+            saving = asyncio.ensure_future(
+                asyncio.to_thread(journal.save, done + splitter.finished())
+            )
+            await asyncio.shield(saving)
+
+        reporter.prefix_of = lambda: contiguous_size(done + splitter.finished())
+
+        async def journal_keeper():
+            while True:
+                await asyncio.sleep(self.JOURNAL_INTERVAL)
+                await save_journal()
+
+        # 所有的写都排在同一个写线程里，共用一个文件句柄，seek 和 write 之间不会插进别的
+        with open(tmpfilepath, "r+b", buffering=0) as fp, _FileWriter(
+            fp, digest
+        ) as sink:
+            workers = [
+                asyncio.create_task(
+                    self._range_worker(
+                        pool,
+                        splitter,
+                        sink,
+                        headers,
+                        total_size,
+                        reporter,
+                        stall,
+                        block_size,
+                    )
+                )
+                for _ in range(min(threadnum, len(ranges)))
+            ]
+            keeper = asyncio.create_task(journal_keeper())
+            try:
+                results = await asyncio.gather(*workers, return_exceptions=True)
+            except asyncio.CancelledError:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                await save_journal()
+                raise
+            finally:
+                keeper.cancel()
+                if saving is not None:
+                    await asyncio.wait([saving])
+        reporter.update(reporter.size, force=True)
+        if splitter.remaining() == 0:
+            try:
+                await asyncio.to_thread(
+                    verify_file,
+                    tmpfilepath,
+                    total_size,
+                    digest,
+                    done + splitter.finished(),
+                )
+            except IntegrityError:
+                # 不知道坏在哪一段，只能整个重下
+                os.remove(tmpfilepath)
+                journal.remove()
+                raise
+            os.replace(tmpfilepath, filepath)
+            journal.remove()
+            return
+        await save_journal()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        raise RuntimeError("download incomplete: no worker left")
+
+    async def _range_worker(
+        self,
+        pool: MirrorPool,
+        splitter: RangeSplitter,
+        sink: "_FileWriter",
+        headers: dict[str, str],
+        total_size: int,
+        reporter: "_Reporter",
+        stall: tuple[float, float],
+        block_size: int,
+    ):
+        failed_url = None
+        while (seg := splitter.acquire()) is not None:
+            # 刚出过错的镜像，有别的可选时先不用
+            url = pool.pick(avoid=failed_url)
+            failed_url = None
+            done, started = seg.done, time.monotonic()
+            try:
+                await self._fetch_segment(
+                    url,
+                    seg,
+                    splitter,
+                    sink,
+                    headers,
+                    total_size,
+                    reporter,
+                    stall,
+                    block_size,
+                )
+            except asyncio.CancelledError:
+                pool.report(url, seg.done - done, time.monotonic() - started)
+                raise
+            except Exception as e:
+                pool.report(
+                    url, seg.done - done, time.monotonic() - started, failed=True
+                )
+                if not pool.available():
+                    raise
+                failed_url = url
+                logging.warning("range download failed on %s: %s", url, e)
+            else:
+                pool.report(url, seg.done - done, time.monotonic() - started)
+            finally:
+                splitter.release(seg)
+
+    async def _fetch_segment(
+        self,
+        url: str,
+        seg: RangeSegment,
+        splitter: RangeSplitter,
+        sink: "_FileWriter",
+        headers: dict[str, str],
+        total_size: int,
+        reporter: "_Reporter",
+        stall: tuple[float, float],
+        block_size: int,
+    ):
+        """下载 seg，连接中途断掉时从断开的地方重新请求，多次没有进展才算失败"""
+        backoff = Backoff()
+        while True:
+            before = seg.done
+            try:
+                await self._fetch_range(
+                    url,
+                    seg,
+                    splitter,
+                    sink,
+                    headers,
+                    total_size,
+                    reporter,
+                    stall,
+                    block_size,
+                )
+                return
+            except StallError:
+                raise
+            except RESET_ERRORS as e:
+                if seg.remaining <= 0:
+                    return
+                if (delay := backoff.next(seg.done > before)) is None:
+                    raise
+                logging.info(
+                    "range connection lost at byte %d, resume in %.1fs: %s",
+                    seg.pos,
+                    delay,
+                    e,
+                )
+                await asyncio.sleep(delay)
+
+    async def _fetch_range(
+        self,
+        url: str,
+        seg: RangeSegment,
+        splitter: RangeSplitter,
+        sink: "_FileWriter",
+        headers: dict[str, str],
+        total_size: int,
+        reporter: "_Reporter",
+        stall: tuple[float, float],
+        block_size: int,
+    ):
+        headers = headers | {"Range": f"bytes={seg.pos}-{seg.end}"}
+        host = urlparse(url).hostname
+        async with await self.client.request("GET", url, headers) as resp:
+            resp.raise_for_status()
+            if resp.status != 206 or content_encoded(resp.headers):
+                raise RuntimeError("range operation not supported")
+            # 不同镜像上的文件要是同一个
+            if (
+                total := resp.headers.get("Content-Range", "").rpartition("/")[2]
+            ).isdigit() and int(total) != total_size:
+                raise RuntimeError(f"size mismatch: expect {total_size}, got {total}")
+            meter = ThroughputMeter(*stall)
+            while seg.remaining > 0 and (
+                chunk := await self._read_block(
+                    resp, meter, min(block_size, seg.remaining)
+                )
+            ):
+                if (wait := limiter.reserve(len(chunk), host)) > 0:
+                    await asyncio.sleep(wait)
+                    meter.skip(wait)
+                # 这段可能被别的协程切走了后半，只写还归自己的部分
+                if size := splitter.advance(seg, len(chunk)):
+                    # 写完了才算数，写到一半出错的话 seg.done 不动
+                    await sink.write(seg.done, memoryview(chunk)[:size])
+                    seg.done += size
+                    reporter.update(reporter.size + size)
+        if seg.remaining > 0:
+            raise ConnectionError(f"connection closed early at byte {seg.pos}")
+
+
+def _decoder(headers):
+    """有内容编码时返回解码用的对象，没有时返回 None"""
+    encoding = headers.get("Content-Encoding", "identity").lower()
+    if encoding == "identity":
+        return None
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        # 自动识别 gzip 和 zlib 的头
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    raise RuntimeError(f"unsupported content encoding: {encoding}")
+
+
+class _FileWriter:
+    """一个下载专用的写线程，写文件和算摘要都在这里做，不占用事件循环
+
+    写是按提交的顺序一个一个做的，所以几个协程可以共用一个文件句柄"""
+
+    def __init__(self, fp, digest: StreamDigest, decoder=None) -> None:
+        self._fp = fp
+        self._digest = digest
+        self._decoder = decoder
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="bilicore-aio-writer"
+        )
+
+    def _write(self, pos: int, data, flush: bool = False) -> int:
+        if self._decoder is not None:
+            data = self._decoder.flush() if flush else self._decoder.decompress(data)
+        self._fp.seek(pos)
+        write_all(self._fp, memoryview(data))
+        self._digest.update(pos, data)
+        return len(data)
+
+    async def _submit(self, *args) -> int:
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor, self._write, *args
+        )
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # 已经交出去的要等它写完，之后才能关文件
+            await asyncio.wait([future])
+            raise
+
+    async def write(self, pos: int, data) -> int:
+        """在 pos 处写入 data，返回写进文件的字节数（解码以后的）"""
+        return await self._submit(pos, data)
+
+    async def flush(self, pos: int) -> int:
+        """响应体读完以后把解码器里剩下的写进去"""
+        if self._decoder is None:
+            return 0
+        return await self._submit(pos, b"", True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._executor.shutdown()
+
+
+class _Reporter:
+    """限制调用 hook_func 和 prefix_hook 的频率"""
+
+    def __init__(
+        self,
+        hook_func: Optional[Callable[[Optional[int], Optional[int]], Any]],
+        interval: float,
+        prefix_hook: Optional[Callable[[int], Any]] = None,
+    ) -> None:
+        self._hook_func = hook_func
+        self._prefix_hook = prefix_hook
+        self.prefix_of: Optional[Callable[[], int]] = None
+        self._interval = interval
+        self._last = 0.0
+        self.size = 0
+        self.total: Optional[int] = None
+
+    def update(self, size: int, force: bool = False):
+        self.size = size
+        if self._hook_func is None and self._prefix_hook is None:
+            return
+        now = time.monotonic()
+        if force or now - self._last >= self._interval:
+            self._last = now
+            if self._hook_func:
+                self._hook_func(self.size, self.total)
+            if self._prefix_hook and self.prefix_of:
+                self._prefix_hook(self.prefix_of())
+
+
+_engine: Optional[AsyncEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> AsyncEngine:
+    """进程内共用的引擎，第一次用到时启动"""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = AsyncEngine()
+        return _engine
+
+
+def download_common(
+    url: str,
+    filepath: str,
+    session: Optional[requests.Session] = None,
+    hook_func: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+    threadnum: int = 8,
+    min_range_size: Optional[int] = None,
+    mirrors: Optional[Iterable[str]] = None,
+    buffer_size: Optional[int] = None,
+    trust_etag: bool = False,
+    stall_speed: Optional[float] = None,
+    stall_timeout: Optional[float] = None,
+    prefix_hook: Optional[Callable[[int], Any]] = None,
+    **kwargs,
+):
+    """和 bilicore.downloader.download_common 一样，但传输在共用的事件循环上进行
+
+    session 只是为了和线程版保持同样的签名，这里不会用到它（也就不走它的代理设置）"""
+    engine = get_engine()
+    engine.run(
+        engine.download(
+            url,
+            filepath,
+            hook_func=hook_func,
+            threadnum=threadnum,
+            min_range_size=min_range_size,
+            mirrors=mirrors,
+            headers=kwargs.get("headers"),
+            buffer_size=buffer_size,
+            trust_etag=trust_etag,
+            stall_speed=stall_speed,
+            stall_timeout=stall_timeout,
+            prefix_hook=prefix_hook,
+        )
+    )
@@ -1,17 +1,49 @@
 import os
+import json
+import http.client
+import logging
+import random
 from typing import Callable, Optional, Any, Literal, Iterable
+from urllib.parse import urlparse
 import threading
 from enum import Enum
 import time
 
 import requests
+import urllib3
 
 from biliapis import HEADERS
+from biliapis.constants import CDN_TIMEOUT
+from bilicore import hostrank
+from bilicore.integrity import (
+    IntegrityError,
+    StreamDigest,
+    expected_digests,
+    validator_of,
+)
+from bilicore.ratelimit import limiter
+from bilicore.watchdog import StallError, watchdog
+from bilicore.utils import ProgressNotifier
+
+
+def media_headers(headers: Optional[dict] = None) -> dict:
+    """下载用的请求头：不带 Range，也不要内容编码，
+    压缩过的响应体大小、Range 和摘要都对不上原文件"""
+    headers = (HEADERS if headers is None else headers).copy()
+    headers.pop("Range", None)
+    headers["Accept-Encoding"] = "identity"
+    return headers
+
+
+def content_encoded(headers) -> bool:
+    """响应体有没有内容编码（比如不理会 Accept-Encoding 硬塞 gzip 的服务器）"""
+    return headers.get("Content-Encoding", "identity").lower() != "identity"
 
 
 def get_remote_head(url, session=None, **kwargs):
     session = session if session else requests.Session()
-    kwargs.setdefault("headers", HEADERS.copy())
+    kwargs["headers"] = media_headers(kwargs.get("headers"))
+    kwargs.setdefault("timeout", CDN_TIMEOUT)
     with session.head(url, **kwargs) as resp:
         resp.raise_for_status()
         return resp.headers.copy()
@@ -22,28 +54,220 @@ def download_common(
     filepath: str,
     session: Optional[requests.Session] = None,
     hook_func: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+    threadnum: int = 8,
+    min_range_size: Optional[int] = None,
+    mirrors: Optional[Iterable[str]] = None,
+    buffer_size: Optional[int] = None,
+    trust_etag: bool = False,
+    stall_speed: Optional[float] = None,
+    stall_timeout: Optional[float] = None,
+    prefix_hook: Optional[Callable[[int], Any]] = None,
     **kwargs,
 ):
+    """下载一个文件，服务器支持 Range 时分段多线程下载
+
+    mirrors 是同一文件的其他地址，给了的话会同时从多个镜像下载不同的范围；
+    buffer_size 是每条连接接收缓冲区的上限（见 ReceiveBuffer）；
+    下载完会检查大小，服务器给了摘要时也会校验摘要（见 integrity.expected_digests），
+    对不上时抛出 IntegrityError；
+    单条连接连续 stall_timeout 秒低于 stall_speed 字节每秒时会被掐掉重连（见 watchdog）；
+    prefix_hook(n) 报告临时文件开头已经连续写好了多少字节，可以跟在后面边下边读"""
     if os.path.isfile(filepath):
         return
-    tmpfilepath = filepath + ".download"
-    if os.path.isfile(tmpfilepath):
-        headers = get_remote_head(url, **kwargs.copy())
-        if headers.get("Accept-Ranges") != "bytes":
-            # 不能续传，删掉上次未完成的文件
-            os.remove(tmpfilepath)
-    thread = DownloadThread(url=url, filepath=filepath, session=session, **kwargs)
-    thread.start()
-    while thread.is_alive():
+    downloader = MultiThreadDownloader(
+        url,
+        filepath,
+        session=session,
+        threadnum=threadnum,
+        min_range_size=min_range_size,
+        mirrors=mirrors,
+        hook_func=hook_func,
+        buffer_size=buffer_size,
+        trust_etag=trust_etag,
+        stall_speed=stall_speed,
+        stall_timeout=stall_timeout,
+        prefix_hook=prefix_hook,
+        **kwargs,
+    )
+    downloader.start()
+    while downloader.is_alive():
         try:
-            time.sleep(0.05)
-            status = thread.observe()
-            if hook_func:
-                hook_func(status["size_local"], status["size_remote"])
+            # 带超时是为了能及时响应 Ctrl-C
+            downloader.join(0.5)
         except KeyboardInterrupt:
-            thread.stop()
-    if thread.exception is not None:
-        raise thread.exception
+            downloader.stop()
+    if downloader.exception is not None:
+        raise downloader.exception
+    if excs := downloader.child_exceptions:
+        raise excs[0]
+    hostrank.record_speeds(downloader.mirror_stats())
+
+
+class ReceiveBuffer:
+    """复用的接收缓冲区
+
+    响应体直接 readinto 进预先分配好的 bytearray，读满一块再整块写进文件，不再为每个分块新建 bytes；
+    块大小按实测速度在 [min_size, max_size] 内翻倍或减半，让读写一块大约花 TARGET_INTERVAL 秒，
+    这样快的时候写得少而大，慢的时候进度也能及时更新"""
+
+    # 块大小总是它的整数倍
+    ALIGN = 2**16
+    MIN_SIZE = 2**16
+    MAX_SIZE = 2**21
+    TARGET_INTERVAL = 0.25
+
+    def __init__(
+        self, max_size: Optional[int] = None, min_size: Optional[int] = None
+    ) -> None:
+        self.max_size = self._align(max_size or self.MAX_SIZE)
+        self.min_size = min(self._align(min_size or self.MIN_SIZE), self.max_size)
+        self.size = self.min_size
+        self._view = memoryview(bytearray(self.size))
+        self._last: Optional[float] = None
+        self._got = 0
+
+    @classmethod
+    def _align(cls, size: int) -> int:
+        return max(size // cls.ALIGN, 1) * cls.ALIGN
+
+    def _adapt(self, elapsed: float):
+        # 只有读满了的块才能说明速度跟得上
+        if self._got >= self.size and elapsed < self.TARGET_INTERVAL / 2:
+            self.size = min(self.size * 2, self.max_size)
+        elif elapsed > self.TARGET_INTERVAL * 2:
+            self.size = max(self._align(self.size // 2), self.min_size)
+        if self.size > len(self._view):
+            # 缓冲区只在变大时重新分配，用多少分配多少
+            self._view = memoryview(bytearray(self.size))
+
+    @staticmethod
+    def _reader(resp: requests.Response):
+        # 绕过 urllib3 直接读 http.client 的响应，它的 readinto 是直接读进来的；
+        # 拿不到的时候用 urllib3 的 readinto，它内部还是会先 read 出 bytes 再复制
+        fp = getattr(resp.raw, "_fp", None)
+        if isinstance(fp, http.client.HTTPResponse):
+            return fp
+        return resp.raw
+
+    def _decode_into(self, resp: requests.Response, view: memoryview) -> int:
+        """有内容编码时的慢路径：requests 给的 raw 不会解码（readinto 也一样），
+        只能 read 出解码后的 bytes 再复制进来"""
+        now = time.monotonic()
+        got = 0
+        while got < len(view):
+            data = resp.raw.read(len(view) - got, decode_content=True)
+            if not data:
+                break
+            view[got : got + len(data)] = data
+            got += len(data)
+            if time.monotonic() - now >= self.TARGET_INTERVAL:
+                break
+        return got
+
+    def readinto(
+        self, resp: requests.Response, limit: Optional[int] = None
+    ) -> memoryview:
+        """从 resp 读一块，至多 limit 字节；读完了返回空的
+
+        返回的 memoryview 指向缓冲区内部，下次调用之前有效。
+        两次调用之间的耗时（包括写文件、限速等待）就是这一块的耗时。
+        连接变慢时不等读满，读了 TARGET_INTERVAL 秒就先交出去，
+        免得看门狗和限速很久都看不到进度"""
+        now = time.monotonic()
+        if self._last is not None:
+            self._adapt(now - self._last)
+        self._last = now
+        size = self.size if limit is None else max(min(self.size, limit), 0)
+        view = self._view[:size]
+        if content_encoded(resp.headers):
+            self._got = self._decode_into(resp, view)
+            return view[: self._got]
+        reader = self._reader(resp)
+        got = 0
+        while got < size and (n := reader.readinto(view[got:])):
+            got += n
+            if time.monotonic() - now >= self.TARGET_INTERVAL:
+                break
+        if not got and size and reader is not resp.raw and reader.length:
+            # http.client 提前读到连接关闭时不会报错，这里和 urllib3 一样当作没读完
+            raise http.client.IncompleteRead(b"", reader.length)
+        if reader is not resp.raw and reader.isclosed():
+            # 绕过了 urllib3，读完之后要自己把连接还回连接池
+            resp.raw.release_conn()
+        self._got = got
+        return view[:got]
+
+
+def verify_file(
+    filepath: str,
+    size: int,
+    digest: Optional[StreamDigest] = None,
+    done: Optional[Iterable[tuple[int, int]]] = None,
+):
+    """检查文件大小，给了 digest 时再校验摘要
+
+    分段下载的文件一开始就截成了完整的大小，大小说明不了什么，
+    这时给出写完了的区间 done，检查它们覆盖了整个文件"""
+    if (actual := os.path.getsize(filepath)) != size:
+        raise IntegrityError(f"size mismatch: expect {size}, got {actual}")
+    if done is not None and (holes := missing_ranges(done, size)):
+        raise IntegrityError(
+            f"{sum(end - start + 1 for start, end in holes)} bytes never written, "
+            f"first at {holes[0][0]}"
+        )
+    if digest is not None:
+        digest.verify(filepath, size)
+
+
+def write_all(fp, data: memoryview):
+    """无缓冲的文件一次 write 不一定能写完"""
+    while data:
+        data = data[fp.write(data) :]
+
+
+# 连接中途断掉时可能抛出的异常，这些情况可以重新连接接着下载
+RESET_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.ReadTimeoutError,
+    http.client.HTTPException,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class Backoff:
+    """有上限的指数退避，每次有新进展后重新计数
+
+    长时间的传输中途被重置很多次也没关系，只要每次重连后都有进展"""
+
+    BASE = 0.5
+    CAP = 8.0
+    MAX_TRIES = 5
+
+    def __init__(
+        self,
+        base: Optional[float] = None,
+        cap: Optional[float] = None,
+        max_tries: Optional[int] = None,
+    ) -> None:
+        self.base = self.BASE if base is None else base
+        self.cap = self.CAP if cap is None else cap
+        self.max_tries = self.MAX_TRIES if max_tries is None else max_tries
+        self._tries = 0
+
+    def next(self, progressed: bool = False) -> Optional[float]:
+        """下一次重试前要等的秒数，次数用完了返回 None"""
+        if progressed:
+            self._tries = 0
+        if self._tries >= self.max_tries:
+            return None
+        delay = min(self.cap, self.base * 2**self._tries)
+        self._tries += 1
+        # 加点抖动，免得一起断掉的连接又同时重连
+        return delay * random.uniform(0.5, 1)
 
 
 class DownloadStatus(Enum):
@@ -61,16 +285,30 @@ class DownloadThread(threading.Thread):
         session: Optional[requests.Session] = None,
         start_byte: int = 0,
         end_byte: Optional[int] = None,
+        notifier: Optional[ProgressNotifier] = None,
+        buffer_size: Optional[int] = None,
+        digest: Optional[StreamDigest] = None,
+        trust_etag: bool = False,
+        stall_speed: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
         **kwargs,
     ) -> None:
         super().__init__(daemon=True)
         self._url = url
         self._filepath = filepath
+        # 没给的话从完整响应（200）的响应头里找
+        self._digest = digest
+        self._trust_etag = trust_etag
+        self._stall = (stall_speed, stall_timeout)
         self._session = session if session else requests.Session()
         self._start_byte = start_byte
         self._end_byte = end_byte
-        kwargs["headers"] = kwargs.get("headers", HEADERS).copy()
-        kwargs["headers"].pop("Range", None)
+        # 只有从头开始的完整文件才能校验摘要
+        self._whole = start_byte == 0 and not end_byte
+        self._notifier = notifier
+        self._buffer_size = buffer_size
+        kwargs["headers"] = media_headers(kwargs.get("headers"))
+        kwargs.setdefault("timeout", CDN_TIMEOUT)
         self._kwargs = kwargs
         self.exception: Optional[Exception] = None
         self._status: dict[
@@ -101,6 +339,46 @@ class DownloadThread(threading.Thread):
         else:
             local_size = 0
         self._status["size_local"] = local_size
+        backoff = Backoff()
+        # 连接中途断掉时从断开的地方重新请求，多次没有进展才算失败
+        while True:
+            before = self._status["size_local"]
+            try:
+                self._receive(tmpfilepath)
+                break
+            except RESET_ERRORS as e:
+                if self._stop_event.is_set():
+                    return
+                progressed = self._status["size_local"] > before
+                if not self._status["resumable"] or (
+                    delay := backoff.next(progressed)
+                ) is None:
+                    raise
+                logging.warning(
+                    "connection lost at byte %d, resume in %.1fs: %s",
+                    self._status["size_local"],
+                    delay,
+                    e,
+                )
+                if self._stop_event.wait(delay):
+                    return
+        if self._stop_event.is_set():
+            return
+        local_size = self._status["size_local"]
+        if (size := self._status["size_remote"]) is not None and local_size != size:
+            # 临时文件留着，下次从断开的地方续传
+            raise IntegrityError(f"size mismatch: expect {size}, got {local_size}")
+        if (digest := self._digest if self._whole else None) is not None:
+            try:
+                digest.verify(tmpfilepath, local_size)
+            except IntegrityError:
+                os.remove(tmpfilepath)
+                raise
+        os.rename(tmpfilepath, self._filepath)
+
+    def _receive(self, tmpfilepath: str):
+        """请求一次，从临时文件的末尾接着写，读完或者被叫停时返回"""
+        local_size = self._status["size_local"]
         # 设置 Range 头
         if self._start_byte > 0 or self._end_byte or local_size > 0:
             self._kwargs["headers"]["Range"] = (
@@ -108,7 +386,9 @@ class DownloadThread(threading.Thread):
                 + (f"{self._end_byte}" if self._end_byte else "")
             )
         # 开始
-        with self._session.get(self._url, stream=True, **self._kwargs) as resp:
+        with self._session.get(
+            self._url, stream=True, **self._kwargs
+        ) as resp, watchdog.watch(resp, *self._stall) as watch:
             resp.raise_for_status()
             # 获取元数据
             self._status["resumable"] = (
@@ -116,23 +396,51 @@ class DownloadThread(threading.Thread):
                 or "Content-Range" in resp.headers
             )
             content_length = int(resp.headers.get("Content-Length", -1))
+            if content_encoded(resp.headers):
+                # 服务器硬给了压缩过的响应体，长度和摘要说的都是压缩后的，只能整个重新下
+                content_length = -1
+                self._status["resumable"] = False
+                self._digest = None
             # 检查支持情况
             if "Range" in self._kwargs["headers"] and (
                 resp.status_code != 206 or content_length == -1
             ):
                 raise RuntimeError("range operation not supported")
-            self._status["size_remote"] = local_size + content_length
-            with open(tmpfilepath, "ab+") as fp:
-                for chunk in resp.iter_content(chunk_size=2**16):
+            self._status["size_remote"] = (
+                local_size + content_length if content_length != -1 else None
+            )
+            if self._digest is None and self._whole and resp.status_code == 200:
+                self._digest = StreamDigest(
+                    expected_digests(resp.headers, trust_etag=self._trust_etag)
+                )
+            digest = self._digest if self._whole else None
+            if digest is not None and digest.pos < local_size:
+                # 续传前已有的部分先读回来算上
+                digest.feed_file(tmpfilepath, local_size)
+            host = urlparse(self._url).hostname
+            buffer = ReceiveBuffer(self._buffer_size)
+            with open(tmpfilepath, "ab", buffering=0) as fp:
+                while True:
                     # 暂停与终止
                     if self._stop_event.is_set():
                         return
-                    self._pause_event.wait()
-                    if chunk:
-                        fp.write(chunk)
-                        local_size += len(chunk)
-                        self._status["size_local"] = local_size
-        os.rename(tmpfilepath, self._filepath)
+                    with watch.pause():
+                        self._pause_event.wait()
+                    if not (chunk := buffer.readinto(resp)):
+                        break
+                    watch.feed(len(chunk))
+                    with watch.pause():
+                        limiter.consume(len(chunk), host)
+                    write_all(fp, chunk)
+                    if digest is not None:
+                        digest.update(local_size, chunk)
+                    local_size += len(chunk)
+                    self._status["size_local"] = local_size
+                    self._notify()
+
+    def _notify(self):
+        if self._notifier:
+            self._notifier.notify()
 
     def run(self):
         try:
@@ -143,6 +451,8 @@ class DownloadThread(threading.Thread):
             self.exception = e
         else:
             self._status["status"] = DownloadStatus.DONE
+        finally:
+            self._notify()
 
     def observe(self, raiseexc: bool = True):
         if (e := self.exception) and raiseexc:
@@ -159,6 +469,408 @@ class DownloadThread(threading.Thread):
         self._stop_event.set()
 
 
+class RangeSegment:
+    """一段待下载的字节范围
+
+    pos 是下一个要认领的字节，done 是下一个还没写进文件的字节，end 可能被别的线程切短"""
+
+    __slots__ = ("start", "pos", "done", "end")
+
+    def __init__(self, start: int, end: int) -> None:
+        self.start = start
+        self.pos = start
+        self.done = start
+        self.end = end
+
+    @property
+    def remaining(self):
+        return self.end - self.pos + 1
+
+
+def merge_ranges(ranges: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+    """合并重叠或相接的闭区间"""
+    result: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if result and start <= result[-1][1] + 1:
+            result[-1] = (result[-1][0], max(result[-1][1], end))
+        else:
+            result.append((start, end))
+    return result
+
+
+def missing_ranges(
+    done: Iterable[tuple[int, int]], total_size: int
+) -> list[tuple[int, int]]:
+    """求 [0, total_size) 中没被 done 覆盖的部分"""
+    result = []
+    pos = 0
+    for start, end in merge_ranges(done):
+        if start > pos:
+            result.append((pos, start - 1))
+        pos = max(pos, end + 1)
+    if pos < total_size:
+        result.append((pos, total_size - 1))
+    return result
+
+
+def contiguous_size(ranges: Iterable[tuple[int, int]]) -> int:
+    """从 0 开始连续的字节数"""
+    if (merged := merge_ranges(ranges)) and merged[0][0] == 0:
+        return merged[0][1] + 1
+    return 0
+
+
+def load_done_ranges(
+    tmpfilepath: str, journal: "RangeJournal", total_size: int
+) -> list[tuple[int, int]]:
+    """找出临时文件里上次已经下完的范围"""
+    if (done := journal.load()) is not None:
+        logging.debug("resume from journal: %s", journal.path)
+        return done
+    journal.remove()
+    # 没有记录时，遗留的临时文件比总大小小，说明是单线程顺序写的，前面这部分可以直接用；
+    # 否则不知道哪些部分写完了，只能从头来
+    if os.path.isfile(tmpfilepath):
+        if 0 < (size := os.path.getsize(tmpfilepath)) < total_size:
+            return [(0, size - 1)]
+        os.remove(tmpfilepath)
+    return []
+
+
+def plan_ranges(
+    done: list[tuple[int, int]], total_size: int, threadnum: int, min_size: int
+) -> list[tuple[int, int]]:
+    """把还没下完的部分切成初始的若干段，按缺口大小分配段数，总共约 threadnum 段"""
+    missing_size = total_size - sum(end - start + 1 for start, end in done)
+    ranges = []
+    for start, end in missing_ranges(done, total_size):
+        ranges += MultiThreadDownloader.calculate_ranges(
+            total_size=end - start + 1,
+            num_threads=-(-threadnum * (end - start + 1) // missing_size),
+            min_size=min_size,
+            offset=start,
+        )
+    return ranges
+
+
+class RangeSplitter:
+    """给多线程下载分配字节范围
+
+    没有待分配的范围时，空闲的线程会把正在下载的剩余最多的那段对半切走后一半，
+    直到剩余部分小于 min_size 的两倍为止"""
+
+    def __init__(self, ranges: Iterable[tuple[int, int]], min_size: int = 1) -> None:
+        self._lock = threading.Lock()
+        self._pending = [RangeSegment(start, end) for start, end in ranges]
+        self._active: list[RangeSegment] = []
+        self._finished: list[tuple[int, int]] = []
+        self._min_size = max(min_size, 1)
+
+    def acquire(self) -> Optional[RangeSegment]:
+        """领取一段范围，没有可以领的了就返回 None"""
+        with self._lock:
+            if self._pending:
+                seg = self._pending.pop(0)
+                self._active.append(seg)
+                return seg
+            victim = max(self._active, key=lambda x: x.remaining, default=None)
+            if victim is None or victim.remaining < 2 * self._min_size:
+                return None
+            mid = victim.pos + victim.remaining // 2
+            seg = RangeSegment(mid, victim.end)
+            victim.end = mid - 1
+            self._active.append(seg)
+            return seg
+
+    def advance(self, seg: RangeSegment, size: int) -> int:
+        """认领 seg 接下来的至多 size 个字节，返回实际可以写入的字节数
+
+        写完之后由调用方自己把 seg.done 加上去"""
+        with self._lock:
+            size = max(min(size, seg.remaining), 0)
+            seg.pos += size
+            return size
+
+    def release(self, seg: RangeSegment):
+        """归还范围，没写完的部分放回去等别的线程领取"""
+        with self._lock:
+            self._active.remove(seg)
+            if seg.done > seg.start:
+                self._finished.append((seg.start, seg.done - 1))
+            if seg.done <= seg.end:
+                self._pending.append(RangeSegment(seg.done, seg.end))
+
+    def remaining(self) -> int:
+        with self._lock:
+            return sum(s.end - s.done + 1 for s in self._pending + self._active)
+
+    def finished(self) -> list[tuple[int, int]]:
+        """已经写进文件的范围，包括正在下载的段里已写完的部分"""
+        with self._lock:
+            return merge_ranges(
+                self._finished
+                + [(s.start, s.done - 1) for s in self._active if s.done > s.start]
+            )
+
+
+class RangeJournal:
+    """分段下载的续传记录，放在临时文件旁边，记着已经写进临时文件的字节范围
+
+    记录之前会先把临时文件刷到磁盘上，所以断电之后记录里的范围也是可信的"""
+
+    SUFFIX = ".parts"
+
+    def __init__(
+        self, datafile: str, total_size: int, validator: Optional[str] = None
+    ) -> None:
+        """validator 是远端文件的 ETag 之类，和记录里的不一样说明文件变了，不能续传"""
+        self._datafile = datafile
+        self._path = datafile + self.SUFFIX
+        self._total_size = total_size
+        self._validator = validator
+
+    @property
+    def path(self):
+        return self._path
+
+    def load(self) -> Optional[list[tuple[int, int]]]:
+        """读取记录，记录不存在、损坏或者与文件对不上时返回 None"""
+        if not (os.path.isfile(self._path) and os.path.isfile(self._datafile)):
+            return None
+        try:
+            with open(self._path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+            if data["size"] != self._total_size:
+                return None
+            if data.get("validator") != self._validator:
+                return None
+            if os.path.getsize(self._datafile) != self._total_size:
+                return None
+            return merge_ranges(
+                (int(start), int(end))
+                for start, end in data["done"]
+                if 0 <= start <= end < self._total_size
+            )
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("unable to load journal %s: %s", self._path, e)
+            return None
+
+    def save(self, done: Iterable[tuple[int, int]]):
+        with open(self._datafile, "r+b") as fp:
+            os.fsync(fp.fileno())
+        tmppath = self._path + ".tmp"
+        with open(tmppath, "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "size": self._total_size,
+                    "validator": self._validator,
+                    "done": merge_ranges(done),
+                },
+                fp,
+            )
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmppath, self._path)
+
+    def remove(self):
+        if os.path.isfile(self._path):
+            os.remove(self._path)
+
+
+class MirrorPool:
+    """同一个文件的多个镜像地址，记录各镜像的实测速度，按速度分配连接
+
+    新连接总是给 速度/(已有连接数+1) 最大的镜像，没测过速的优先；
+    连续失败 MAX_FAILURES 次的镜像不再使用"""
+
+    MAX_FAILURES = 3
+    # 测速结果的平滑系数
+    SMOOTHING = 0.3
+
+    def __init__(self, urls: Iterable[str]) -> None:
+        self._urls = list(dict.fromkeys(urls))
+        if not self._urls:
+            raise ValueError("at least one url is required")
+        self._lock = threading.Lock()
+        self._speed: dict[str, Optional[float]] = {u: None for u in self._urls}
+        self._active: dict[str, int] = {u: 0 for u in self._urls}
+        self._failures: dict[str, int] = {u: 0 for u in self._urls}
+
+    @property
+    def urls(self):
+        return self._urls.copy()
+
+    def available(self) -> bool:
+        with self._lock:
+            return any(self._failures[u] < self.MAX_FAILURES for u in self._urls)
+
+    def pick(self, avoid: Optional[str] = None) -> str:
+        """选一个镜像并占用一个连接名额，用完要 report
+
+        有别的镜像可选时不会选 avoid"""
+        with self._lock:
+            candidates = [
+                u for u in self._urls if self._failures[u] < self.MAX_FAILURES
+            ]
+            if not candidates:
+                raise RuntimeError("no mirror available")
+            if len(candidates) > 1 and avoid in candidates:
+                candidates.remove(avoid)
+            url = max(
+                candidates,
+                key=lambda u: (
+                    self._speed[u] is None,
+                    (self._speed[u] or 0) / (self._active[u] + 1),
+                    -self._active[u],
+                ),
+            )
+            self._active[url] += 1
+            return url
+
+    def report(self, url: str, size: int, seconds: float, failed: bool = False):
+        """归还连接名额，并记录这次传输的结果"""
+        with self._lock:
+            self._active[url] -= 1
+            if size > 0 and seconds > 0:
+                speed = size / seconds
+                old = self._speed[url]
+                self._speed[url] = (
+                    speed
+                    if old is None
+                    else old * (1 - self.SMOOTHING) + speed * self.SMOOTHING
+                )
+            if failed:
+                self._failures[url] += 1
+            else:
+                self._failures[url] = 0
+
+    def stats(self) -> dict[str, Optional[float]]:
+        """各镜像的实测速度，字节每秒"""
+        with self._lock:
+            return self._speed.copy()
+
+
+class RangeDownloadThread(DownloadThread):
+    """从 RangeSplitter 领取字节范围来下载，直接写进已经预分配好的文件的对应偏移处，
+    领不到新范围时结束
+
+    给了 mirrors 时每一段都从当时最合适的镜像下载，某个镜像出错就换别的镜像重试这一段
+
+    filepath 指向的文件需要事先创建好，该线程不会创建、改名或删除它"""
+
+    def __init__(
+        self,
+        url: str,
+        filepath: str,
+        splitter: RangeSplitter,
+        session: Optional[requests.Session] = None,
+        mirrors: Optional[MirrorPool] = None,
+        total_size: Optional[int] = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(url, filepath, session=session, **kwargs)
+        self._splitter = splitter
+        self._mirrors = mirrors if mirrors else MirrorPool([url])
+        self._total_size = total_size
+
+    def _worker(self):
+        self._status["size_local"] = 0
+        buffer = ReceiveBuffer(self._buffer_size)
+        failed_url = None
+        with open(self._filepath, "r+b", buffering=0) as fp:
+            while (seg := self._splitter.acquire()) is not None:
+                # 刚出过错的镜像，有别的可选时先不用
+                url = self._mirrors.pick(avoid=failed_url)
+                failed_url = None
+                done, started = seg.done, time.monotonic()
+                try:
+                    self._download_segment(url, seg, fp, buffer)
+                except Exception as e:
+                    self._mirrors.report(
+                        url, seg.done - done, time.monotonic() - started, failed=True
+                    )
+                    if not self._mirrors.available():
+                        raise
+                    failed_url = url
+                    logging.warning("range download failed on %s: %s", url, e)
+                else:
+                    self._mirrors.report(
+                        url, seg.done - done, time.monotonic() - started
+                    )
+                finally:
+                    self._splitter.release(seg)
+                if self._stop_event.is_set():
+                    return
+
+    def _download_segment(
+        self, url: str, seg: RangeSegment, fp, buffer: ReceiveBuffer
+    ):
+        """下载 seg，连接中途断掉时从断开的地方重新请求，多次没有进展才算失败
+
+        卡住的连接不在这里重试，交给调用方换个镜像"""
+        backoff = Backoff()
+        while True:
+            before = seg.done
+            try:
+                self._fetch_range(url, seg, fp, buffer)
+                return
+            except StallError:
+                raise
+            except RESET_ERRORS as e:
+                if self._stop_event.is_set() or seg.remaining <= 0:
+                    return
+                if (delay := backoff.next(seg.done > before)) is None:
+                    raise
+                logging.info(
+                    "range connection lost at byte %d, resume in %.1fs: %s",
+                    seg.pos,
+                    delay,
+                    e,
+                )
+                if self._stop_event.wait(delay):
+                    return
+
+    def _fetch_range(self, url: str, seg: RangeSegment, fp, buffer: ReceiveBuffer):
+        self._kwargs["headers"]["Range"] = f"bytes={seg.pos}-{seg.end}"
+        with self._session.get(
+            url, stream=True, **self._kwargs
+        ) as resp, watchdog.watch(resp, *self._stall) as watch:
+            resp.raise_for_status()
+            if resp.status_code != 206 or content_encoded(resp.headers):
+                raise RuntimeError("range operation not supported")
+            # 不同镜像上的文件要是同一个
+            if self._total_size is not None and (
+                total := resp.headers.get("Content-Range", "").rpartition("/")[2]
+            ).isdigit():
+                if int(total) != self._total_size:
+                    raise RuntimeError(
+                        f"size mismatch: expect {self._total_size}, got {total}"
+                    )
+            self._status["resumable"] = True
+            host = urlparse(url).hostname
+            fp.seek(seg.pos)
+            while seg.remaining > 0:
+                if self._stop_event.is_set():
+                    return
+                with watch.pause():
+                    self._pause_event.wait()
+                if not (chunk := buffer.readinto(resp, seg.remaining)):
+                    break
+                watch.feed(len(chunk))
+                with watch.pause():
+                    limiter.consume(len(chunk), host)
+                # 这段可能被别的线程切走了后半，只写还归自己的部分
+                if size := self._splitter.advance(seg, len(chunk)):
+                    write_all(fp, chunk[:size])
+                    if self._digest is not None:
+                        self._digest.update(seg.done, chunk[:size])
+                    seg.done += size
+                    self._status["size_local"] += size
+                    self._notify()
+        if seg.remaining > 0:
+            raise ConnectionError(f"connection closed early at byte {seg.pos}")
+
+
 class SimpleDownloadThreadList(list[DownloadThread]):
     """十分甚至九分简陋的一个用来方便管理下载线程的东西"""
 
@@ -205,27 +917,60 @@ class SimpleDownloadThreadList(list[DownloadThread]):
         return bool(sum(t.is_alive() for t in self))
 
 
-# 并未实际使用
 class MultiThreadDownloader(threading.Thread):
     """下载一个文件。如果服务器支持的话就采用多线程
 
+    多线程时预分配好临时文件，各线程直接写入自己负责的偏移处，完成后改名，不需要再合并；
+    先下完的线程会去切分别的线程剩下的部分，最多 threadnum 个连接，每段不小于 min_range_size；
+    下载过程中在临时文件旁边维护一份续传记录（见 RangeJournal），中断后再下只补缺的部分；
+    给了 mirrors 时不同的范围同时从各个镜像下载，按各镜像的实测速度分配连接
+
+    子线程有进度时会通知这里，再由这里调用 hook_func(已下载, 总大小)，不需要外面轮询
+
     有线程出错也视为完成，错误会放在 self.child_exceptions 中"""
 
+    # 每段至少这么大，太小的文件没必要切
+    MIN_RANGE_SIZE = 2**20
+    # 续传记录的保存间隔，秒
+    JOURNAL_INTERVAL = 2.0
+    # 没有进度变化时也至少隔这么久检查一次，秒
+    HEARTBEAT_INTERVAL = 0.5
+    # 两次进度回调之间至少隔这么久，秒
+    REPORT_INTERVAL = 0.05
+
     def __init__(
         self,
         url,
         filepath,
         session: Optional[requests.Session] = None,
         threadnum: int = 8,
+        min_range_size: Optional[int] = None,
+        mirrors: Optional[Iterable[str]] = None,
+        hook_func: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+        buffer_size: Optional[int] = None,
+        trust_etag: bool = False,
+        stall_speed: Optional[float] = None,
+        stall_timeout: Optional[float] = None,
+        prefix_hook: Optional[Callable[[int], Any]] = None,
         **kwargs,
     ) -> None:
         super().__init__(daemon=True)
         self._url = url
+        self._stall = {"stall_speed": stall_speed, "stall_timeout": stall_timeout}
+        self._buffer_size = buffer_size
+        self._trust_etag = trust_etag
+        self._head: dict[str, str] = {}
+        self._hook_func = hook_func
+        self._prefix_hook = prefix_hook
+        # 下载开始后换成计算临时文件连续前缀的函数
+        self._prefix_of: Optional[Callable[[], int]] = None
+        self._notifier = ProgressNotifier(min_interval=self.REPORT_INTERVAL)
+        self._mirrors = MirrorPool([url] + list(mirrors or []))
         self._filepath = filepath
-        self._threadnum = threadnum
+        self._threadnum = max(threadnum, 1)
+        self._min_range_size = max(min_range_size or self.MIN_RANGE_SIZE, 1)
         self._session = session if session else requests.Session()
-        kwargs["headers"] = kwargs.get("headers", HEADERS).copy()
-        kwargs["headers"].pop("Range", None)
+        kwargs["headers"] = media_headers(kwargs.get("headers"))
         self._kwargs = kwargs
         self._status: dict[
             Literal[
@@ -250,49 +995,111 @@ class MultiThreadDownloader(threading.Thread):
             raise e
         return self._status.copy()
 
-    def _worker_multi(self, ranges: list[tuple[int, int]]):
-        threads = SimpleDownloadThreadList()
-        for start, end in ranges:
-            tmpfilepath = self._filepath + f".m{start}-{end}dl"
-            threads.append(
-                DownloadThread(
-                    self._url,
-                    tmpfilepath,
-                    session=self._session,
-                    start_byte=start,
-                    end_byte=end,
-                    **self._kwargs,
-                )
-            )
-        threads.start_all()
+    def mirror_stats(self):
+        """各个地址在这次下载中的实测速度，字节每秒，没有测到的为 None"""
+        return self._mirrors.stats()
+
+    def _report(self, size_local: Optional[int] = None):
+        if size_local is not None:
+            self._status["size_local"] = size_local
+        if self._hook_func:
+            self._hook_func(self._status["size_local"], self._status["size_remote"])
+        if self._prefix_hook and self._prefix_of:
+            self._prefix_hook(self._prefix_of())
+
+    def _wait_threads(
+        self,
+        threads: SimpleDownloadThreadList,
+        offset: int = 0,
+        on_tick: Optional[Callable[[], Any]] = None,
+        tick_interval: float = 0,
+    ):
+        """等待线程们结束，期间有进度就汇报，处理暂停和终止，每隔 tick_interval 秒调用一次 on_tick
+
+        被终止时返回 False"""
+        last_tick = time.monotonic()
         while threads.is_alive():
             size, _, _, running, _ = threads.observe()
-            self._status["size_local"] = size
             self._status["thread_active"] = running
+            self._report(offset + size)
             if self._stop_event.is_set():
                 threads.switch_all("stop")
-                return
+                return False
             if not self._pause_event.is_set():
                 threads.switch_all("pause")
                 self._pause_event.wait()
                 threads.switch_all("resume")
-            time.sleep(0.1)
-        _, _, errored, _, excps = threads.observe()
-        if errored == 0:
-            self._merge_chunks([t.filepath for t in threads], self._filepath, True)
-        else:
-            self.child_exceptions = excps
+            if on_tick and time.monotonic() - last_tick >= tick_interval:
+                on_tick()
+                last_tick = time.monotonic()
+            self._notifier.wait(self.HEARTBEAT_INTERVAL)
+        size, _, _, _, _ = threads.observe()
+        self._status["thread_active"] = 0
+        self._report(offset + size)
+        return True
 
-    @staticmethod
-    def _merge_chunks(chunks: Iterable[str], resultfile: str, delete: bool = True):
-        with open(resultfile, "wb") as outfile:
-            for chunk in chunks:
-                with open(chunk, "rb") as infile:
-                    outfile.write(infile.read())
+    def _worker_multi(self, total_size: int):
+        tmpfilepath = self._filepath + ".download"
+        journal = RangeJournal(tmpfilepath, total_size, validator_of(self._head))
+        done = load_done_ranges(tmpfilepath, journal, total_size)
+        with open(tmpfilepath, "r+b" if os.path.isfile(tmpfilepath) else "wb") as fp:
+            fp.truncate(total_size)
+        done_size = sum(end - start + 1 for start, end in done)
+        digest = StreamDigest(expected_digests(self._head, self._trust_etag))
+        if done and done[0][0] == 0:
+            digest.feed_file(tmpfilepath, done[0][1] + 1)
+        ranges = plan_ranges(done, total_size, self._threadnum, self._min_range_size)
+        splitter = RangeSplitter(ranges, min_size=self._min_range_size)
+        threads = SimpleDownloadThreadList(
+            *[
+                RangeDownloadThread(
+                    self._url,
+                    tmpfilepath,
+                    splitter,
+                    session=self._session,
+                    mirrors=self._mirrors,
+                    total_size=total_size,
+                    notifier=self._notifier,
+                    buffer_size=self._buffer_size,
+                    digest=digest,
+                    **self._stall,
+                    **self._kwargs,
+                )
+                for _ in range(min(self._threadnum, len(ranges)))
+            ]
+        )
 
-        if delete:
-            for chunk in chunks:
-                os.remove(chunk)
+        def save_journal():
+            journal.save(done + splitter.finished())
+
+        self._prefix_of = lambda: contiguous_size(done + splitter.finished())
+        threads.start_all()
+        if not self._wait_threads(
+            threads,
+            offset=done_size,
+            on_tick=save_journal,
+            tick_interval=self.JOURNAL_INTERVAL,
+        ):
+            save_journal()
+            return
+        _, _, _, _, excps = threads.observe()
+        if splitter.remaining() == 0:
+            try:
+                verify_file(
+                    tmpfilepath, total_size, digest, done + splitter.finished()
+                )
+            except IntegrityError:
+                # 不知道坏在哪一段，只能整个重下
+                os.remove(tmpfilepath)
+                journal.remove()
+                raise
+            os.replace(tmpfilepath, self._filepath)
+            journal.remove()
+        else:
+            save_journal()
+            self.child_exceptions = excps or [
+                RuntimeError("download incomplete: no worker left")
+            ]
 
     def _worker_single(self):
         tmpfilepath = self._filepath + ".download"
@@ -300,22 +1107,39 @@ class MultiThreadDownloader(threading.Thread):
             # 由于不能续传，删掉上次的未完成文件
             os.remove(tmpfilepath)
         thread = DownloadThread(
-            self._url, self._filepath, session=self._session, **self._kwargs
+            self._url,
+            self._filepath,
+            session=self._session,
+            notifier=self._notifier,
+            buffer_size=self._buffer_size,
+            digest=StreamDigest(expected_digests(self._head, self._trust_etag)),
+            **self._stall,
+            **self._kwargs,
         )
-        while thread.is_alive():
-            time.sleep(0.1)
-            self._status["thread_active"] = 1
-            self._status.update(thread.observe())
-            if not self._pause_event.is_set():
-                thread.pause()
-                self._pause_event.wait()
-                thread.resume()
-        self._status["thread_active"] = 0
+        # 单线程是顺序写的，写了多少就是多少
+        self._prefix_of = lambda: thread.observe(False)["size_local"] or 0
+        thread.start()
+        self._wait_threads(SimpleDownloadThreadList(thread))
+        if (size := thread.observe(False)["size_remote"]) is not None:
+            self._status["size_remote"] = size
+            self._report()
+        if e := thread.exception:
+            self.child_exceptions = [e]
 
     def _prepare(self):
         """确定是否要多线程"""
-        head = get_remote_head(self._url, session=self._session, **self._kwargs)
-        length = int(head.get("Content-Length", -1))
+        for i, url in enumerate(urls := self._mirrors.urls):
+            try:
+                head = get_remote_head(url, session=self._session, **self._kwargs)
+            except requests.RequestException:
+                if i + 1 == len(urls):
+                    raise
+            else:
+                # 单线程时只用能连上的这个
+                self._url = url
+                self._head = head
+                break
+        length = -1 if content_encoded(head) else int(head.get("Content-Length", -1))
         if head.get("Accept-Ranges") == "bytes" and (length != -1):
             return True, length
         return False, length
@@ -324,13 +1148,10 @@ class MultiThreadDownloader(threading.Thread):
         if os.path.exists(self._filepath):
             return
         multi, total_size = self._prepare()
-        self._status["size_remote"] = total_size
-        if multi:
-            ranges = self.calculate_ranges(
-                total_size=total_size, num_threads=self._threadnum
-            )
+        self._status["size_remote"] = total_size if total_size != -1 else None
+        if multi and total_size > 0:
             self._status["resumable"] = True
-            self._worker_multi(ranges)
+            self._worker_multi(total_size)
         else:
             self._status["resumable"] = False
             self._status["size_local"] = 0
@@ -338,9 +1159,11 @@ class MultiThreadDownloader(threading.Thread):
 
     def stop(self):
         self._stop_event.set()
+        self._notifier.notify()
 
     def pause(self):
         self._pause_event.clear()
+        self._notifier.notify()
 
     def resume(self):
         self._pause_event.set()
@@ -358,16 +1181,20 @@ class MultiThreadDownloader(threading.Thread):
             self._status["thread_active"] = 0
 
     @staticmethod
-    def calculate_ranges(total_size: int, num_threads: int):
+    def calculate_ranges(
+        total_size: int, num_threads: int, min_size: int = 1, offset: int = 0
+    ):
+        """把 offset 开始的 total_size 字节切成至多 num_threads 段，每段不小于 min_size"""
+        num_threads = max(1, min(num_threads, total_size // max(min_size, 1)))
         # 计算每个线程要下载的字节数
         chunk_size = total_size // num_threads
         ranges = []
 
         for i in range(num_threads):
-            start = i * chunk_size
+            start = offset + i * chunk_size
             # 最后一个线程将负责下载剩余的所有部分
             if i == num_threads - 1:
-                end = total_size - 1
+                end = offset + total_size - 1
             else:
                 end = start + chunk_size - 1
             ranges.append((start, end))
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from typing import Optional, Iterable
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from biliapis import HEADERS
+
+__all__ = [
+    "ranking",
+    "init",
+    "rank_urls",
+    "probe",
+    "record_speeds",
+    "speed_of",
+    "HostRanking",
+]
+
+DEFAULT_PATH = "./hostrank.json"
+
+
+def _host(url: str) -> str:
+    return urlparse(url).hostname or url
+
+
+class HostRanking:
+    """记录各个 CDN 主机的延迟和速度，保存在文件里供以后使用"""
+
+    # 平滑系数
+    SMOOTHING = 0.3
+    # 超过这个时间没更新的记录就不可信了，秒
+    EXPIRE_TIME = 7 * 24 * 60 * 60
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self._hosts: dict[str, dict[str, float]] = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, "r", encoding="utf-8") as fp:
+                    if isinstance(data := json.load(fp), dict):
+                        self._hosts = data
+            except (OSError, ValueError) as e:
+                logging.warning("unable to load host ranking: %s", e)
+        atexit.register(self.save)
+
+    def update(
+        self, host: str, latency: Optional[float] = None, speed: Optional[float] = None
+    ):
+        """记录一次测量结果，latency 单位秒，speed 单位字节每秒"""
+        with self._lock:
+            record = self._hosts.setdefault(host, {})
+            for key, value in (("latency", latency), ("speed", speed)):
+                if value is None:
+                    continue
+                old = record.get(key)
+                record[key] = (
+                    value
+                    if old is None
+                    else old * (1 - self.SMOOTHING) + value * self.SMOOTHING
+                )
+            record["updated"] = time.time()
+
+    def get(self, host: str) -> Optional[dict[str, float]]:
+        """取一个主机的记录，没有或过期了返回 None"""
+        with self._lock:
+            record = self._hosts.get(host)
+            if not record or "speed" not in record:
+                return None
+            if time.time() - record.get("updated", 0) > self.EXPIRE_TIME:
+                return None
+            return record.copy()
+
+    def known(self, urls: Iterable[str]) -> bool:
+        """这些地址的主机是不是都有可信的记录"""
+        return all(self.get(_host(u)) is not None for u in urls)
+
+    def sort(self, urls: Iterable[str]) -> list[str]:
+        """按记录的速度从快到慢排序，没有记录的按已知主机的平均速度算"""
+        urls = list(urls)
+        speeds = {u: r["speed"] if (r := self.get(_host(u))) else None for u in urls}
+        known = [s for s in speeds.values() if s is not None]
+        default = sum(known) / len(known) if known else 0
+        # sorted 是稳定的，速度相同时保持原顺序
+        return sorted(
+            urls, key=lambda u: -(s if (s := speeds[u]) is not None else default)
+        )
+
+    def save(self):
+        with self._lock:
+            data = self._hosts.copy()
+        try:
+            tmppath = self._path + ".tmp"
+            with open(tmppath, "w", encoding="utf-8") as fp:
+                json.dump(data, fp, indent=4)
+            os.replace(tmppath, self._path)
+            logging.debug("host ranking saved: %s", self._path)
+        except OSError as e:
+            logging.warning("unable to save host ranking: %s", e)
+
+
+ranking: HostRanking | None = None
+
+
+def init(path: str = DEFAULT_PATH):
+    global ranking
+    if not ranking:
+        ranking = HostRanking(path)
+
+
+def _probe_one(url: str, session: requests.Session, size: int, **kwargs):
+    kwargs = kwargs.copy()
+    kwargs["headers"] = kwargs.get("headers", HEADERS).copy()
+    kwargs["headers"]["Range"] = f"bytes=0-{size - 1}"
+    start = time.monotonic()
+    with session.get(url, stream=True, **kwargs) as resp:
+        resp.raise_for_status()
+        latency = time.monotonic() - start
+        received = sum(len(chunk) for chunk in resp.iter_content(chunk_size=2**14))
+    return latency, received / max(time.monotonic() - start, 1e-6)
+
+
+def probe(
+    urls: Iterable[str],
+    session: Optional[requests.Session] = None,
+    size: int = 2**16,
+    timeout: float = 5,
+    **kwargs,
+) -> list[str]:
+    """同时向每个地址请求开头的 size 个字节，按速度从快到慢返回能连上的地址
+
+    测量结果会记进 ranking（如果已经 init 过）"""
+    urls = list(dict.fromkeys(urls))
+    session = session if session else requests.Session()
+    kwargs.setdefault("timeout", timeout)
+    speeds: dict[str, float] = {}
+    with ThreadPoolExecutor(max_workers=len(urls) or 1) as executor:
+        futures = {
+            url: executor.submit(_probe_one, url, session, size, **kwargs)
+            for url in urls
+        }
+        for url, future in futures.items():
+            try:
+                latency, speed = future.result()
+            except Exception as e:
+                logging.debug("probe failed: %s, %s", url, e)
+                continue
+            speeds[url] = speed
+            if ranking:
+                ranking.update(_host(url), latency=latency, speed=speed)
+    logging.debug("probe result: %s", speeds)
+    return sorted(speeds, key=lambda u: -speeds[u])
+
+
+def rank_urls(
+    urls: list[str], session: Optional[requests.Session] = None, **kwargs
+) -> list[str]:
+    """把候选地址按主机的快慢排序
+
+    未 init 时原样返回；所有主机都有记录时直接按记录排，否则先测速；
+    测速失败的地址放到最后，不会被丢掉"""
+    if not ranking or len(urls) < 2:
+        return urls
+    if ranking.known(urls):
+        return ranking.sort(urls)
+    fastest = probe(urls, session=session, **kwargs)
+    return fastest + [u for u in urls if u not in fastest]
+
+
+def record_speeds(speeds: dict[str, Optional[float]]):
+    """记录实际下载时各地址的速度"""
+    if not ranking:
+        return
+    for url, speed in speeds.items():
+        if speed is not None:
+            ranking.update(_host(url), speed=speed)
+
+
+def speed_of(urls: Iterable[str]) -> Optional[float]:
+    """这些地址里最快的主机记录下来的速度，字节每秒；未 init 或都没有记录时返回 None"""
+    if not ranking:
+        return None
+    speeds = [r["speed"] for u in urls if (r := ranking.get(_host(u)))]
+    return max(speeds) if speeds else None
@@ -0,0 +1,108 @@
+import re
+import base64
+import hashlib
+import binascii
+import threading
+from typing import Mapping, Optional
+
+__all__ = ["IntegrityError", "StreamDigest", "expected_digests", "validator_of"]
+
+
+class IntegrityError(RuntimeError):
+    """下载下来的文件和服务器给出的大小或摘要对不上"""
+
+
+# Digest 头里的算法名 -> hashlib 里的名字
+_DIGEST_ALGORITHMS = {"md5": "md5", "sha": "sha1", "sha-256": "sha256"}
+
+
+def _b64_to_hex(value: str) -> Optional[str]:
+    try:
+        return base64.b64decode(value.strip(), validate=True).hex()
+    except (binascii.Error, ValueError):
+        return None
+
+
+def expected_digests(
+    headers: Mapping[str, str], trust_etag: bool = False
+) -> dict[str, str]:
+    """从完整响应（不是 206）的响应头里找服务器给出的摘要，返回 {算法: 十六进制摘要}
+
+    认 Content-MD5 和 Digest 头；ETag 不一定是内容的摘要，只有 trust_etag 时才把
+    32 位或 40 位十六进制的强 ETag 当作 md5 或 sha1"""
+    result: dict[str, str] = {}
+    if (value := headers.get("Content-MD5")) and (digest := _b64_to_hex(value)):
+        result["md5"] = digest
+    for item in headers.get("Digest", "").split(","):
+        name, sep, value = item.strip().partition("=")
+        if sep and (algo := _DIGEST_ALGORITHMS.get(name.strip().lower())):
+            if digest := _b64_to_hex(value):
+                result.setdefault(algo, digest)
+    if trust_etag and (etag := headers.get("ETag", "")) and not etag.startswith("W/"):
+        etag = etag.strip('"').lower()
+        if re.fullmatch(r"[0-9a-f]{32}", etag):
+            result.setdefault("md5", etag)
+        elif re.fullmatch(r"[0-9a-f]{40}", etag):
+            result.setdefault("sha1", etag)
+    return result
+
+
+def validator_of(headers: Mapping[str, str]) -> Optional[str]:
+    """用来判断远端文件有没有变过的标识，续传前要和上次的一致"""
+    return headers.get("ETag") or headers.get("Last-Modified") or None
+
+
+class StreamDigest:
+    """边写边算整个文件的摘要
+
+    正好接在已算部分后面写入的数据直接参与计算；其余的（其他线程负责的范围、
+    续传前就有的部分）在 feed_file 时从文件里读回来补上。
+    expected 为空时什么都不算"""
+
+    READ_SIZE = 2**20
+
+    def __init__(self, expected: Optional[Mapping[str, str]] = None) -> None:
+        self.expected = dict(expected or {})
+        self._hashes = {name: hashlib.new(name) for name in self.expected}
+        self._pos = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pos(self) -> int:
+        """已经算到的偏移"""
+        return self._pos
+
+    def update(self, offset: int, data) -> bool:
+        """offset 处写入了 data，返回是否参与了计算"""
+        if not self._hashes:
+            return False
+        with self._lock:
+            if offset != self._pos:
+                return False
+            for h in self._hashes.values():
+                h.update(data)
+            self._pos += len(data)
+            return True
+
+    def feed_file(self, filepath: str, end: int):
+        """把文件里 [pos, end) 的部分读回来算上，这部分必须已经写完了"""
+        if not self._hashes:
+            return
+        with self._lock, open(filepath, "rb", buffering=0) as fp:
+            view = memoryview(bytearray(self.READ_SIZE))
+            fp.seek(self._pos)
+            while self._pos < end:
+                if not (n := fp.readinto(view[: min(self.READ_SIZE, end - self._pos)])):
+                    break
+                for h in self._hashes.values():
+                    h.update(view[:n])
+                self._pos += n
+
+    def verify(self, filepath: str, size: int):
+        """补完剩下的部分并和期望的摘要比较，对不上时抛出 IntegrityError"""
+        self.feed_file(filepath, size)
+        for name, h in self._hashes.items():
+            if (actual := h.hexdigest()) != self.expected[name]:
+                raise IntegrityError(
+                    f"{name} mismatch: expect {self.expected[name]}, got {actual}"
+                )
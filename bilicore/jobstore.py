@@ -0,0 +1,269 @@
+import json
+import atexit
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import contextlib
+from typing import Any, Optional
+
+__all__ = ["store", "init", "JobStore", "STAGES"]
+
+DEFAULT_PATH = "./bilijobs.db"
+
+# 任务会经过的阶段，done 以外的都算没做完
+STAGES = ("pending", "preparing", "transferring", "post", "done", "failed")
+
+
+class JobStore:
+    """批量下载的任务记录，存在 SQLite 里，程序中断了下次可以接着下
+
+    每个任务记下类型、重建任务用的参数、进行到的阶段、临时文件和出错信息
+
+    同一个文件可能有几个进程在用（常驻进程、另一个命令行），所以正在做的任务
+    带着所属进程的租约，进程活着就由后台线程每隔一会儿续上，
+    租约还没过期的任务别的进程不会拿去接着下"""
+
+    # 租约的时长，进程没了最多过这么久别的进程就能接手
+    LEASE = 60.0
+    # 失败这么多次就不再接着下了
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._lock = threading.Lock()
+        self.owner = uuid.uuid4().hex
+        self._heartbeat: Optional[threading.Thread] = None
+        with self._connect() as conn:
+            conn.execute(
+                """-- sql
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    batch TEXT,
+                    kind TEXT,
+                    args TEXT,
+                    stage TEXT,
+                    files TEXT,
+                    error TEXT,
+                    updated REAL,
+                    owner TEXT,
+                    lease REAL,
+                    attempts INTEGER DEFAULT 0
+                )
+            """
+            )
+            # 旧版本建的表补上新加的列
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, kind in (
+                ("owner", "TEXT"),
+                ("lease", "REAL"),
+                ("attempts", "INTEGER DEFAULT 0"),
+            ):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {kind}")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        with self._lock:
+            conn = sqlite3.connect(self._path)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                conn.close()
+
+    def add_batch(
+        self, batch: str, jobs: list[tuple[str, dict[str, Any]]]
+    ) -> list[int]:
+        """记下一批任务 [(类型, 参数), ...]，返回它们的 id"""
+        ids = []
+        with self._connect() as conn:
+            for kind, args in jobs:
+                cur = conn.execute(
+                    """-- sql
+                    INSERT INTO jobs (
+                        batch, kind, args, stage, files, updated, owner, lease
+                    )
+                    VALUES (?, ?, ?, 'pending', '[]', ?, ?, ?)
+                """,
+                    (
+                        batch,
+                        kind,
+                        json.dumps(args, ensure_ascii=False),
+                        time.time(),
+                        self.owner,
+                        time.time() + self.LEASE,
+                    ),
+                )
+                ids.append(cur.lastrowid)
+        self._start_heartbeat()
+        logging.debug("job batch added: %s, %d jobs", batch, len(ids))
+        return ids
+
+    def claim(self, job_ids: list[int]) -> list[int]:
+        """把没做完、也没有别的进程在做的任务拿过来，返回拿到的 id"""
+        with self._connect() as conn:
+            # 先锁上库，免得两个进程同时拿到同一个任务
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            claimed = [
+                job_id
+                for job_id in job_ids
+                if conn.execute(
+                    """-- sql
+                    UPDATE jobs SET owner = ?, lease = ?
+                    WHERE id = ? AND stage != 'done'
+                        AND (lease IS NULL OR lease < ? OR owner = ?)
+                """,
+                    (self.owner, now + self.LEASE, job_id, now, self.owner),
+                ).rowcount
+            ]
+        if claimed:
+            self._start_heartbeat()
+        return claimed
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(
+                target=self._renew_forever, daemon=True, name="bilicore-jobstore"
+            )
+            self._heartbeat.start()
+
+    def _renew_forever(self):
+        while True:
+            time.sleep(self.LEASE / 3)
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logging.warning("failed to renew job leases: %s", e)
+
+    def renew(self):
+        """给自己还在做的任务续租"""
+        with self._connect() as conn:
+            conn.execute(
+                """-- sql
+                UPDATE jobs SET lease = ?
+                WHERE owner = ? AND lease IS NOT NULL
+            """,
+                (time.time() + self.LEASE, self.owner),
+            )
+
+    def release(self, job_ids: Optional[list[int]] = None):
+        """放掉自己的租约（job_ids 为 None 时是全部），没做完的别的进程马上就能接手
+
+        一批任务跑完或者被打断时、进程退出时调用，不然 --resume 要等租约过期"""
+        with self._connect() as conn:
+            if job_ids is None:
+                conn.execute(
+                    "UPDATE jobs SET lease = NULL WHERE owner = ?", (self.owner,)
+                )
+            else:
+                conn.executemany(
+                    "UPDATE jobs SET lease = NULL WHERE owner = ? AND id = ?",
+                    [(self.owner, job_id) for job_id in job_ids],
+                )
+
+    def update(
+        self,
+        job_id: int,
+        stage: str,
+        args: Optional[dict[str, Any]] = None,
+        files: Optional[list[str]] = None,
+        error: Optional[str] = None,
+    ):
+        """更新任务的阶段，args / files 为 None 的保持原样
+
+        做完或者失败了就放掉租约，失败的记一次"""
+        if stage not in STAGES:
+            raise ValueError(f"unknown stage: {stage}")
+        ended = stage in ("done", "failed")
+        with self._connect() as conn:
+            conn.execute(
+                """-- sql
+                UPDATE jobs SET
+                    stage = ?,
+                    args = COALESCE(?, args),
+                    files = COALESCE(?, files),
+                    error = ?,
+                    updated = ?,
+                    owner = ?,
+                    lease = ?,
+                    attempts = attempts + ?
+                WHERE id = ?
+            """,
+                (
+                    stage,
+                    None if args is None else json.dumps(args, ensure_ascii=False),
+                    None if files is None else json.dumps(files, ensure_ascii=False),
+                    error,
+                    time.time(),
+                    self.owner,
+                    None if ended else time.time() + self.LEASE,
+                    stage == "failed",
+                    job_id,
+                ),
+            )
+
+    def unfinished(self) -> list[dict[str, Any]]:
+        """没做完、也没有别的进程在做的任务，按添加的顺序"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                """-- sql
+                SELECT id, batch, kind, args, stage, files, error FROM jobs
+                WHERE stage != 'done' AND (lease IS NULL OR lease < ? OR owner = ?)
+                ORDER BY id
+            """,
+                (time.time(), self.owner),
+            ).fetchall()
+        return [
+            {
+                "id": job_id,
+                "batch": batch,
+                "kind": kind,
+                "args": json.loads(args),
+                "stage": stage,
+                "files": json.loads(files),
+                "error": error,
+            }
+            for job_id, batch, kind, args, stage, files, error in rows
+        ]
+
+    def clear_done(self) -> int:
+        """删掉做完了的任务，连着失败了 MAX_ATTEMPTS 次的也不再留着，返回删掉的条数"""
+        with self._connect() as conn:
+            for batch, args, error in conn.execute(
+                """-- sql
+                SELECT batch, args, error FROM jobs
+                WHERE stage = 'failed' AND attempts >= ?
+            """,
+                (self.MAX_ATTEMPTS,),
+            ):
+                logging.warning(
+                    "give up job of %s after %d attempts: %s, %s",
+                    batch,
+                    self.MAX_ATTEMPTS,
+                    args,
+                    error,
+                )
+            count = conn.execute(
+                """-- sql
+                DELETE FROM jobs
+                WHERE stage = 'done' OR (stage = 'failed' AND attempts >= ?)
+            """,
+                (self.MAX_ATTEMPTS,),
+            ).rowcount
+        logging.debug("cleared %d finished jobs", count)
+        return count
+
+
+store: JobStore | None = None
+
+
+def init(path: str = DEFAULT_PATH):
+    global store
+    if not store:
+        store = JobStore(path)
+        atexit.register(store.release)
@@ -0,0 +1,565 @@
+import os
+import sys
+import copy
+import heapq
+import struct
+import itertools
+import contextlib
+from array import array
+from typing import Any, BinaryIO, Callable, Iterable, NamedTuple, Optional
+
+__all__ = ["MuxError", "supports", "mux"]
+
+
+class MuxError(ValueError):
+    """输入不是能直接合起来的 DASH fMP4，交给 ffmpeg 去合"""
+
+
+# 只含子 box 的容器
+_CONTAINERS = {
+    "moov",
+    "trak",
+    "mdia",
+    "minf",
+    "stbl",
+    "mvex",
+    "edts",
+    "dinf",
+    "moof",
+    "traf",
+}
+# 元数据键 -> ilst 里的 box，和 ffmpeg 的 mp4 封装器一致，不认识的键同样不写
+_ILST_KEYS = {
+    "title": "©nam",
+    "artist": "©ART",
+    "album_artist": "aART",
+    "album": "©alb",
+    "composer": "©wrt",
+    "date": "©day",
+    "comment": "©cmt",
+    "genre": "©gen",
+    "copyright": "cprt",
+    "description": "desc",
+    "synopsis": "ldes",
+    "grouping": "©grp",
+    "lyrics": "©lyr",
+}
+_COPY_SIZE = 2**20
+
+
+class _Box:
+    """内存里的 box，容器的内容在 children 里，其他的在 data 里"""
+
+    __slots__ = ("type", "data", "children")
+
+    def __init__(
+        self,
+        kind: str,
+        data: bytes = b"",
+        children: Optional[list["_Box"]] = None,
+    ) -> None:
+        self.type = kind
+        self.data = bytearray(data)
+        self.children = children
+
+    def find(self, kind: str) -> Optional["_Box"]:
+        return next((c for c in self.children or [] if c.type == kind), None)
+
+    def findall(self, kind: str) -> list["_Box"]:
+        return [c for c in self.children or [] if c.type == kind]
+
+    def get(self, path: str) -> "_Box":
+        """按 a/b/c 这样的路径找，找不到就是输入不对"""
+        box: Optional[_Box] = self
+        for kind in path.split("/"):
+            if (box := box.find(kind)) is None:
+                raise MuxError(f"missing box: {path}")
+        return box
+
+    def encode(self) -> bytes:
+        if self.children is not None:
+            payload = b"".join(c.encode() for c in self.children)
+        else:
+            payload = bytes(self.data)
+        kind = self.type.encode("latin-1")
+        if len(payload) + 8 > 0xFFFFFFFF:
+            return struct.pack(">I4sQ", 1, kind, len(payload) + 16) + payload
+        return struct.pack(">I4s", len(payload) + 8, kind) + payload
+
+
+def _parse(data: bytes) -> list[_Box]:
+    boxes, pos = [], 0
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from(">I4s", data, pos)
+        hlen = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, pos + 8)
+            hlen = 16
+        elif size == 0:
+            size = len(data) - pos
+        if size < hlen or pos + size > len(data):
+            raise MuxError("broken box")
+        name = kind.decode("latin-1")
+        body = data[pos + hlen : pos + size]
+        if name in _CONTAINERS:
+            boxes.append(_Box(name, children=_parse(body)))
+        else:
+            boxes.append(_Box(name, body))
+        pos += size
+    return boxes
+
+
+def _full_box(kind: str, payload: bytes, version: int = 0) -> _Box:
+    return _Box(kind, struct.pack(">I", version << 24) + payload)
+
+
+# FullBox 里按版本不同宽度不同的字段（时长、时间），返回 (偏移, 宽度)
+def _field(box: _Box, v0: int, v1: int) -> tuple[int, int]:
+    return (v1, 8) if box.data[0] == 1 else (v0, 4)
+
+
+# 只有偏移按版本不同的 4 字节字段（时间刻度、轨道号）
+def _field32(box: _Box, v0: int, v1: int) -> tuple[int, int]:
+    return (v1 if box.data[0] == 1 else v0, 4)
+
+
+def _get(box: _Box, field: tuple[int, int]) -> int:
+    offset, width = field
+    return struct.unpack_from(">Q" if width == 8 else ">I", box.data, offset)[0]
+
+
+def _put(box: _Box, field: tuple[int, int], value: int):
+    offset, width = field
+    if width == 4:
+        # 装不下时按规范写成全 1，表示未知
+        struct.pack_into(">I", box.data, offset, min(value, 0xFFFFFFFF))
+    else:
+        struct.pack_into(">Q", box.data, offset, value)
+
+
+class _Chunk(NamedTuple):
+    """一个 trun 的样本，输入里是连续的一段，输出里作为一个 chunk"""
+
+    time: float
+    source: "_Input"
+    offset: int
+    size: int
+    samples: int
+    description: int
+
+
+def _array(typecode: str) -> array:
+    a = array(typecode)
+    if a.itemsize != 4:
+        raise MuxError("unsupported platform")
+    return a
+
+
+def _be(a: array) -> bytes:
+    if sys.byteorder == "little":
+        a = copy.copy(a)
+        a.byteswap()
+    return a.tobytes()
+
+
+class _Input:
+    """一个 DASH fMP4 输入：ftyp, moov, [sidx], (moof, mdat)*
+
+    chunks() 读一遍所有 moof，把样本表攒在 durations / sizes / offsets / sync 里"""
+
+    def __init__(self, fp: BinaryIO, track_id: int) -> None:
+        self._fp = fp
+        self.track_id = track_id
+        self.size = os.fstat(fp.fileno()).st_size
+        self.moov: Optional[_Box] = None
+        self.durations = _array("I")
+        self.sizes = _array("I")
+        # 显示时间减解码时间，有 B 帧的视频才有
+        self.offsets = _array("i")
+        self.sync = bytearray()
+        self._fragments_at = 0
+        pos = 0
+        while (header := self._header(pos)) is not None:
+            kind, size, _ = header
+            if kind == "moof":
+                self._fragments_at = pos
+                break
+            if kind == "moov":
+                self._fp.seek(pos)
+                self.moov = _parse(self._fp.read(size))[0]
+            pos += size
+        if self.moov is None or not self._fragments_at:
+            raise MuxError("not a fragmented mp4")
+        if len(self.moov.findall("trak")) != 1 or self.moov.find("mvex") is None:
+            raise MuxError("need exactly one fragmented track")
+        stbl = self.moov.get("trak/mdia/minf/stbl")
+        for kind in ("stco", "co64"):
+            # 样本都应该在 moof 里，moov 里有样本的不是纯 fMP4
+            if (box := stbl.find(kind)) is not None and _get(box, (4, 4)):
+                raise MuxError("samples in moov are not supported")
+        mvhd, mdhd = self.moov.get("mvhd"), self.moov.get("trak/mdia/mdhd")
+        self.movie_timescale = _get(mvhd, _field32(mvhd, 12, 20))
+        self.timescale = _get(mdhd, _field32(mdhd, 12, 20))
+        if not self.movie_timescale or not self.timescale:
+            raise MuxError("zero timescale")
+        trex = self.moov.get("mvex/trex")
+        # 默认的样本描述序号、时长、大小、标志
+        self._trex = struct.unpack_from(">IIII", trex.data, 8)
+
+    @property
+    def duration(self) -> int:
+        """按自己的时间刻度"""
+        return sum(self.durations)
+
+    def _header(self, pos: int) -> Optional[tuple[str, int, int]]:
+        """pos 处的 box 头，返回 (类型, 整个 box 的大小, 头的长度)，到末尾时返回 None"""
+        self._fp.seek(pos)
+        if not (head := self._fp.read(16)):
+            return None
+        if len(head) < 8:
+            raise MuxError("truncated box header")
+        size, kind = struct.unpack_from(">I4s", head)
+        hlen = 8
+        if size == 1:
+            if len(head) < 16:
+                raise MuxError("truncated box header")
+            (size,) = struct.unpack_from(">Q", head, 8)
+            hlen = 16
+        elif size == 0:
+            size = self.size - pos
+        if size < hlen or pos + size > self.size:
+            raise MuxError("truncated box")
+        return kind.decode("latin-1"), size, hlen
+
+    def chunks(self) -> list[_Chunk]:
+        chunks: list[_Chunk] = []
+        pos, dts = self._fragments_at, 0
+        while (header := self._header(pos)) is not None:
+            kind, size, _ = header
+            if kind == "moof":
+                self._fp.seek(pos)
+                for traf in _parse(self._fp.read(size))[0].findall("traf"):
+                    dts = self._read_traf(traf, pos, dts, chunks)
+            # 输入自己的 sidx、mfra 之类的索引在输出里没用了，mdat 按 trun 里的位置读
+            pos += size
+        if not chunks:
+            raise MuxError("no samples")
+        return chunks
+
+    def _read_traf(self, traf: _Box, moof_at: int, dts: int, chunks: list[_Chunk]):
+        tfhd = traf.get("tfhd")
+        flags = int.from_bytes(tfhd.data[1:4], "big")
+        description, duration, size, sample_flags = self._trex
+        pos, base = 8, moof_at
+        if flags & 0x01:
+            (base,) = struct.unpack_from(">Q", tfhd.data, pos)
+            pos += 8
+        for bit in (0x02, 0x08, 0x10, 0x20):
+            if flags & bit:
+                (value,) = struct.unpack_from(">I", tfhd.data, pos)
+                pos += 4
+                if bit == 0x02:
+                    description = value
+                elif bit == 0x08:
+                    duration = value
+                elif bit == 0x10:
+                    size = value
+                else:
+                    sample_flags = value
+        if (tfdt := traf.find("tfdt")) is not None and _get(
+            tfdt, _field(tfdt, 4, 4)
+        ) != dts:
+            # 中间有空档或者不是从 0 开始，拼平了时间会错，交给 ffmpeg
+            raise MuxError("discontinuous decode time")
+        data_at = base
+        for trun in traf.findall("trun"):
+            data = trun.data
+            tflags = int.from_bytes(data[1:4], "big")
+            (count,) = struct.unpack_from(">I", data, 4)
+            pos = 8
+            if tflags & 0x01:
+                data_at = base + struct.unpack_from(">i", data, pos)[0]
+                pos += 4
+            first_flags = None
+            if tflags & 0x04:
+                (first_flags,) = struct.unpack_from(">I", data, pos)
+                pos += 4
+            fields = [bit for bit in (0x100, 0x200, 0x400, 0x800) if tflags & bit]
+            if pos + 4 * len(fields) * count > len(data):
+                raise MuxError("broken trun")
+            chunk_at, chunk_size, chunk_time = data_at, 0, dts
+            if not fields:
+                table: Iterable[tuple[int, ...]] = itertools.repeat((), count)
+            else:
+                table = struct.iter_unpack(
+                    ">" + "I" * len(fields), data[pos : pos + 4 * len(fields) * count]
+                )
+            at = {bit: fields.index(bit) for bit in fields}
+            for n, row in enumerate(table):
+                sample_duration = row[at[0x100]] if 0x100 in at else duration
+                sample_size = row[at[0x200]] if 0x200 in at else size
+                if n == 0 and first_flags is not None:
+                    this_flags = first_flags
+                else:
+                    this_flags = row[at[0x400]] if 0x400 in at else sample_flags
+                offset = row[at[0x800]] if 0x800 in at else 0
+                # 版本 1 是有符号的；版本 0 按规范是无符号的，但和 ffmpeg 一样当有符号读
+                if offset >= 2**31:
+                    offset -= 2**32
+                self.durations.append(sample_duration)
+                self.sizes.append(sample_size)
+                self.offsets.append(offset)
+                # sample_is_non_sync_sample
+                self.sync.append(not this_flags & 0x10000)
+                chunk_size += sample_size
+                dts += sample_duration
+            if count:
+                if chunk_at + chunk_size > self.size:
+                    raise MuxError("samples out of file")
+                chunks.append(
+                    _Chunk(
+                        chunk_time / self.timescale,
+                        self,
+                        chunk_at,
+                        chunk_size,
+                        count,
+                        description,
+                    )
+                )
+            data_at = chunk_at + chunk_size
+        return dts
+
+    def copy_to(self, out: BinaryIO, offset: int, size: int):
+        self._fp.seek(offset)
+        view = memoryview(bytearray(_COPY_SIZE))
+        while size > 0:
+            if not (n := self._fp.readinto(view[: min(size, _COPY_SIZE)])):
+                raise MuxError("truncated mdat")
+            out.write(view[:n])
+            size -= n
+
+
+def _runs(values) -> list[tuple[Any, int]]:
+    """[(值, 连续出现的次数), ...]"""
+    runs: list[tuple[Any, int]] = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1] = (value, runs[-1][1] + 1)
+        else:
+            runs.append((value, 1))
+    return runs
+
+
+def _build_stbl(source: _Input, stbl: _Box, chunks: list[_Chunk], large: bool):
+    """按输出里的 chunk 顺序重建样本表，chunk 的偏移先填 0"""
+    children = [stbl.get("stsd")]
+    stts = _runs(source.durations)
+    children.append(
+        _full_box(
+            "stts",
+            struct.pack(">I", len(stts))
+            + b"".join(struct.pack(">II", n, d) for d, n in stts),
+        )
+    )
+    if any(source.offsets):
+        ctts = _runs(source.offsets)
+        children.append(
+            _full_box(
+                "ctts",
+                struct.pack(">I", len(ctts))
+                + b"".join(struct.pack(">Ii", n, o) for o, n in ctts),
+                version=1 if min(source.offsets) < 0 else 0,
+            )
+        )
+    if not all(source.sync):
+        sync = _array("I")
+        sync.extend(i + 1 for i, s in enumerate(source.sync) if s)
+        children.append(_full_box("stss", struct.pack(">I", len(sync)) + _be(sync)))
+    stsc = _runs((c.samples, c.description) for c in chunks)
+    first, entries = 1, []
+    for (samples, description), n in stsc:
+        entries.append(struct.pack(">III", first, samples, description))
+        first += n
+    children.append(
+        _full_box("stsc", struct.pack(">I", len(entries)) + b"".join(entries))
+    )
+    if len(set(source.sizes)) == 1:
+        stsz = struct.pack(">II", source.sizes[0], len(source.sizes))
+    else:
+        stsz = struct.pack(">II", 0, len(source.sizes)) + _be(source.sizes)
+    children.append(_full_box("stsz", stsz))
+    width = 8 if large else 4
+    children.append(
+        _full_box(
+            "co64" if large else "stco",
+            struct.pack(">I", len(chunks)) + bytes(width * len(chunks)),
+        )
+    )
+    stbl.children = children
+
+
+def _fill_offsets(moov: _Box, inputs: list[_Input], order: list[_Chunk], at: int):
+    """chunk 按 order 的顺序从 at 开始放，把位置填进各轨道的 stco / co64"""
+    positions: dict[int, list[int]] = {i.track_id: [] for i in inputs}
+    for chunk in order:
+        positions[chunk.source.track_id].append(at)
+        at += chunk.size
+    for trak, source in zip(moov.findall("trak"), inputs):
+        stbl = trak.get("mdia/minf/stbl")
+        if (box := stbl.find("co64")) is not None:
+            struct.pack_into(
+                f">{len(positions[source.track_id])}Q",
+                box.data,
+                8,
+                *positions[source.track_id],
+            )
+        else:
+            box = stbl.get("stco")
+            struct.pack_into(
+                f">{len(positions[source.track_id])}I",
+                box.data,
+                8,
+                *positions[source.track_id],
+            )
+
+
+def _metadata_box(metadata: dict[str, str]) -> Optional[_Box]:
+    items = []
+    for key, value in metadata.items():
+        if kind := _ILST_KEYS.get(key.lower()):
+            # 类型 1 是 UTF-8 文本，后面 4 字节是 locale
+            data = _Box("data", struct.pack(">II", 1, 0) + value.encode("utf-8"))
+            items.append(_Box(kind, data.encode()))
+    if not items:
+        return None
+    hdlr = _full_box("hdlr", struct.pack(">I4s4sII", 0, b"mdir", b"appl", 0, 0) + b"\0")
+    ilst = _Box("ilst", b"".join(i.encode() for i in items))
+    meta = _full_box("meta", hdlr.encode() + ilst.encode())
+    return _Box("udta", meta.encode())
+
+
+def _rebuild_elst(elst: _Box, i: _Input, timescale: int):
+    """分片文件的编辑列表只管 moov 里那部分（多半是 0），拼平之后按整个轨道重新算
+
+    开头的空编辑（media_time 为 -1）是延迟，换算到新的时间刻度留着；
+    正常的编辑只留第一个的 media_time，时长是从它开始到轨道结束"""
+    fmt = ">Qqhh" if elst.data[0] == 1 else ">Iihh"
+    size = struct.calcsize(fmt)
+    entries = [
+        struct.unpack_from(fmt, elst.data, 8 + n * size)
+        for n in range(_get(elst, (4, 4)))
+    ]
+    edits = [
+        (d * timescale // i.movie_timescale, -1, rate, fraction)
+        for d, media_time, rate, fraction in entries
+        if media_time == -1
+    ]
+    if media := [e for e in entries if e[1] != -1]:
+        _, media_time, rate, fraction = media[0]
+        duration = max(i.duration - media_time, 0) * timescale // i.timescale
+        edits.append((duration, media_time, rate, fraction))
+    if elst.data[0] == 0:
+        # 装不下时按规范写成全 1
+        edits = [(min(d, 0xFFFFFFFF), *rest) for d, *rest in edits]
+    elst.data = bytearray(
+        elst.data[:4]
+        + struct.pack(">I", len(edits))
+        + b"".join(struct.pack(fmt, *e) for e in edits)
+    )
+
+
+def _build_moov(
+    inputs: list[_Input],
+    chunks: dict[int, list[_Chunk]],
+    metadata: Optional[dict[str, str]],
+    large: bool,
+) -> _Box:
+    assert inputs[0].moov is not None
+    mvhd = copy.deepcopy(inputs[0].moov.get("mvhd"))
+    timescale = inputs[0].movie_timescale
+    duration = max(i.duration * timescale // i.timescale for i in inputs)
+    _put(mvhd, _field(mvhd, 16, 24), duration)
+    struct.pack_into(">I", mvhd.data, len(mvhd.data) - 4, len(inputs) + 1)
+    traks = []
+    for i in inputs:
+        assert i.moov is not None
+        trak = copy.deepcopy(i.moov.get("trak"))
+        tkhd = trak.get("tkhd")
+        _put(tkhd, _field32(tkhd, 12, 20), i.track_id)
+        _put(tkhd, _field(tkhd, 20, 28), i.duration * timescale // i.timescale)
+        mdhd = trak.get("mdia/mdhd")
+        _put(mdhd, _field(mdhd, 16, 24), i.duration)
+        if (edts := trak.find("edts")) is not None and (
+            elst := edts.find("elst")
+        ) is not None:
+            _rebuild_elst(elst, i, timescale)
+        _build_stbl(i, trak.get("mdia/minf/stbl"), chunks[i.track_id], large)
+        traks.append(trak)
+    children = [mvhd, *traks]
+    if metadata and (udta := _metadata_box(metadata)):
+        children.append(udta)
+    return _Box("moov", children=children)
+
+
+def supports(au_file: Optional[str], vi_file: str, output_file: str) -> bool:
+    """粗略判断能不能用 mux，真正能不能还要看文件内容，不能时 mux 抛出 MuxError"""
+    if os.path.splitext(output_file)[1].lower() not in (".mp4", ".m4v"):
+        return False
+    # flac 之类的放不进 mp4，本来也是走 mkv
+    return not any(
+        f and os.path.splitext(f)[1].lower() == ".flac" for f in (au_file, vi_file)
+    )
+
+
+def mux(
+    vi_file: str,
+    au_file: Optional[str],
+    output_file: str,
+    metadata: Optional[dict[str, str]] = None,
+    hook: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+):
+    """把 DASH 的视频流和音频流（都是 fMP4）合成一个普通的 mp4，相当于 ffmpeg -c copy
+
+    先把各输入的 moof 读一遍建好样本表，moov 放在最前面，样本按时间交错着写进一个 mdat，
+    每个输入的样本数据只读一遍；出错时删掉写了一半的输出；
+    hook(已写的样本字节, 样本总字节) 在每个 chunk 写完后调用"""
+    with contextlib.ExitStack() as stack:
+        inputs = [
+            _Input(stack.enter_context(open(f, "rb")), i + 1)
+            for i, f in enumerate(filter(None, (vi_file, au_file)))
+        ]
+        chunks = {i.track_id: i.chunks() for i in inputs}
+        order = list(heapq.merge(*chunks.values(), key=lambda c: c.time))
+        total = sum(c.size for c in order)
+        ftyp = _Box("ftyp", b"isom" + struct.pack(">I", 512) + b"isomiso2mp41")
+        # 超过 4GiB 时 mdat 头和 chunk 偏移都要用 64 位的
+        mdat = (
+            struct.pack(">I4sQ", 1, b"mdat", total + 16)
+            if total + 8 > 0xFFFFFFFF
+            else struct.pack(">I4s", total + 8, b"mdat")
+        )
+        large = False
+        while True:
+            moov = _build_moov(inputs, chunks, metadata, large)
+            data_at = len(ftyp.encode()) + len(moov.encode()) + len(mdat)
+            if large or data_at + total <= 0xFFFFFFFF:
+                break
+            large = True
+        _fill_offsets(moov, inputs, order, data_at)
+        try:
+            with open(output_file, "wb") as out:
+                out.write(ftyp.encode())
+                out.write(moov.encode())
+                out.write(mdat)
+                written = 0
+                for chunk in order:
+                    chunk.source.copy_to(out, chunk.offset, chunk.size)
+                    written += chunk.size
+                    if hook:
+                        hook(written, total)
+            if hook:
+                hook(total, total)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(output_file)
+            raise
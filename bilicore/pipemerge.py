@@ -0,0 +1,206 @@
+import os
+import logging
+import threading
+import subprocess
+import contextlib
+from typing import Any, Callable, Optional
+
+from bilicore.utils import ffmpeg_command, merge_args, priority_options
+
+__all__ = ["PipeFeeder", "StreamMerger", "supported"]
+
+
+def supported() -> bool:
+    """要把管道的文件描述符传给 ffmpeg，目前只有 POSIX 上可以"""
+    return os.name == "posix"
+
+
+class PipeFeeder(threading.Thread):
+    """把正在下载的文件按顺序写进管道
+
+    下载器通过 advance 报告临时文件开头已经连续写好的字节数，这里跟在后面读，
+    读的是刚写进去的数据，基本都在页缓存里；finish 之后读到文件末尾就关掉管道
+
+    filepath 是下载完成后的文件名，下载中读的是旁边的 .download 临时文件"""
+
+    READ_SIZE = 2**20
+
+    def __init__(self, filepath: str, fd: int) -> None:
+        super().__init__(daemon=True)
+        self._filepath = filepath
+        self._fd = fd
+        self._cond = threading.Condition()
+        self._prefix = 0
+        self._finished = False
+        self._cancelled = False
+        self.fed = 0
+        self.complete = False
+        self.exception: Optional[Exception] = None
+
+    def advance(self, size: int):
+        with self._cond:
+            if size < self._prefix:
+                # 下载器从头重来了，已经写进管道的收不回来
+                self.exception = RuntimeError(f"stream restarted at byte {size}")
+                self._cancelled = True
+            self._prefix = max(self._prefix, size)
+            self._cond.notify()
+
+    def finish(self):
+        """文件已经下完了"""
+        with self._cond:
+            self._finished = True
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify()
+
+    def _open(self):
+        # 下完之后临时文件会被改名，已经打开的不受影响
+        try:
+            return open(self._filepath + ".download", "rb", buffering=0)
+        except FileNotFoundError:
+            return open(self._filepath, "rb", buffering=0)
+
+    def _feed(self, fp, end: Optional[int]):
+        """把 fp 里 [fed, end) 的部分写进管道，end 为 None 时一直读到文件末尾"""
+        view = memoryview(bytearray(self.READ_SIZE))
+        while end is None or self.fed < end:
+            size = self.READ_SIZE if end is None else end - self.fed
+            if not (n := fp.readinto(view[: min(size, self.READ_SIZE)])):
+                if end is None:
+                    return
+                raise RuntimeError(f"unexpected end of file at byte {self.fed}")
+            chunk = view[:n]
+            while chunk:
+                chunk = chunk[os.write(self._fd, chunk) :]
+            self.fed += n
+
+    def run(self):
+        fp = None
+        try:
+            while True:
+                with self._cond:
+                    while not (
+                        self._cancelled or self._finished or self._prefix > self.fed
+                    ):
+                        self._cond.wait()
+                    if self._cancelled:
+                        return
+                    end = None if self._finished else self._prefix
+                if fp is None:
+                    fp = self._open()
+                self._feed(fp, end)
+                if end is None:
+                    self.complete = True
+                    return
+        except Exception as e:  # pylint: disable=W0718
+            # 多半是 ffmpeg 先退出了，管道断了
+            self.exception = e
+        finally:
+            if fp is not None:
+                fp.close()
+            os.close(self._fd)
+
+
+class StreamMerger:
+    """边下载边合流，ffmpeg 从管道里读各条流，下完不用再把临时文件整个读一遍再合并
+
+    临时文件照常写，续传和校验都不受影响；合流失败时返回 False，临时文件还在，
+    可以再用 merge_avfile 合一次。ffmpeg 先写到旁边的 .part 文件，成功后才改名；
+    ffmpeg 以 nice 值 nice 运行，None 时用当前线程的设置（见 utils.set_ffmpeg_nice）"""
+
+    def __init__(
+        self,
+        au_file: Optional[str],
+        vi_file: str,
+        output_file: str,
+        cover_image: Optional[str] = None,
+        metadata: Optional[dict[str, str]] = None,
+        nice: Optional[int] = None,
+    ) -> None:
+        self._au_file = au_file
+        self._vi_file = vi_file
+        self._output_file = output_file
+        root, ext = os.path.splitext(output_file)
+        # 扩展名留给 ffmpeg 认输出格式
+        self._partfile = root + ".part" + ext
+        self._cover_image = cover_image
+        self._metadata = metadata
+        self._nice = nice
+        self._feeders: dict[str, PipeFeeder] = {}
+        self._process: Optional[subprocess.Popen] = None
+
+    def hook_for(self, file: str) -> Callable[[int], Any]:
+        """给下载 file 的下载器用的 prefix_hook"""
+        return self._feeders[file].advance
+
+    def start(self):
+        pipes = {
+            file: os.pipe() for file in filter(None, (self._vi_file, self._au_file))
+        }
+        args = merge_args(
+            self._au_file and f"pipe:{pipes[self._au_file][0]}",
+            f"pipe:{pipes[self._vi_file][0]}",
+            self._partfile,
+            self._cover_image,
+            self._metadata,
+        )
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._partfile)
+        # 和后处理队列里的 ffmpeg 一样降低优先级
+        cmd, options = priority_options(ffmpeg_command(*args), self._nice)
+        logging.debug("streaming into: %s", cmd)
+        try:
+            self._process = subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=[read for read, _ in pipes.values()],
+                **options,
+            )
+        except OSError:
+            for _, write in pipes.values():
+                os.close(write)
+            raise
+        finally:
+            # 读的一端交给 ffmpeg 了，这边留着的话 ffmpeg 等不到 EOF
+            for read, _ in pipes.values():
+                os.close(read)
+        for file, (_, write) in pipes.items():
+            self._feeders[file] = feeder = PipeFeeder(file, write)
+            feeder.start()
+
+    def finish(self) -> bool:
+        """所有流都下完之后调用，等 ffmpeg 写完，返回是否合流成功"""
+        for feeder in self._feeders.values():
+            feeder.finish()
+        for feeder in self._feeders.values():
+            feeder.join()
+        assert self._process is not None
+        returncode = self._process.wait()
+        errors = [f.exception for f in self._feeders.values() if not f.complete]
+        if returncode == 0 and not errors:
+            os.replace(self._partfile, self._output_file)
+            return True
+        logging.warning(
+            "stream merge failed (ffmpeg returned %d): %s", returncode, errors
+        )
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._partfile)
+        return False
+
+    def cancel(self):
+        """下载出错时调用，掐掉 ffmpeg，删掉不完整的输出"""
+        for feeder in self._feeders.values():
+            feeder.cancel()
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+        for feeder in self._feeders.values():
+            feeder.join()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._partfile)
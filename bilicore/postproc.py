@@ -0,0 +1,63 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from bilicore.utils import set_ffmpeg_nice
+
+__all__ = ["PostProcessor", "processor"]
+
+
+class PostProcessor:
+    """合流、转码这类吃 CPU 的收尾工作的队列，和下载用的线程池分开
+
+    下载线程把收尾工作丢进来就可以去下一个任务了；默认线程数等于 CPU 核数，
+    在这里启动的 ffmpeg 以 nice 值 NICE 运行，不跟前台抢 CPU"""
+
+    NICE = 10
+
+    def __init__(self, workers: Optional[int] = None, nice: Optional[int] = None):
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers = 1
+        self._nice = self.NICE
+        self.configure(workers, nice)
+
+    def configure(self, workers: Optional[int] = None, nice: Optional[int] = None):
+        """workers 为 None 时等于 CPU 核数，nice 为 None 时用 NICE，0 就是不降低优先级
+
+        已经在跑的工作不受影响，之后提交的用新设置"""
+        with self._lock:
+            self._workers = max(workers or os.cpu_count() or 1, 1)
+            self._nice = self.NICE if nice is None else nice
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def nice(self) -> int:
+        return self._nice
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._workers,
+                    thread_name_prefix="bilicore-postproc",
+                    initializer=set_ffmpeg_nice,
+                    initargs=(self._nice,),
+                )
+            return self._executor.submit(func, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+processor = PostProcessor()
@@ -0,0 +1,122 @@
+import re
+import time
+import threading
+from typing import Optional
+
+__all__ = [
+    "limiter",
+    "TokenBucket",
+    "RateLimiter",
+    "parse_size",
+    "parse_rate",
+    "parse_host_rate",
+]
+
+_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30}
+
+
+def parse_size(text: str) -> int:
+    """把 `4M`、`512k` 这样的字符串转换成字节数"""
+    return int(parse_rate(text))
+
+
+def parse_rate(text: str) -> float:
+    """把 `20M`、`512k`、`1.5G` 这样的字符串转换成字节每秒"""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)(?:i?[bB])?\s*", text)
+    if not m:
+        raise ValueError(f"invalid rate: {text!r}")
+    return float(m.group(1)) * _UNITS[m.group(2).upper()]
+
+
+def parse_host_rate(text: str) -> tuple[str, float]:
+    """把 `host=5M` 这样的字符串转换成 (主机, 字节每秒)"""
+    host, sep, rate = text.partition("=")
+    if not (sep and host.strip()):
+        raise ValueError(f"invalid host rate: {text!r}")
+    return host.strip(), parse_rate(rate)
+
+
+class TokenBucket:
+    """令牌桶，rate 为 None 时不限速
+
+    取令牌时允许欠账，欠多少就让调用方睡多久，这样大块的请求也不会饿死"""
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self._lock = threading.Lock()
+        self._rate: Optional[float] = None
+        self._burst = 0.0
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.set_rate(rate, burst)
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def set_rate(self, rate: Optional[float], burst: Optional[float] = None):
+        """修改速率，下载进行中也可以改"""
+        with self._lock:
+            self._rate = rate if rate and rate > 0 else None
+            # 默认允许一秒的突发
+            self._burst = burst if burst else (self._rate or 0)
+            self._tokens = min(self._tokens, self._burst)
+            self._last = time.monotonic()
+
+    def reserve(self, size: int) -> float:
+        """取走 size 个令牌，返回需要等待的秒数"""
+        if self._rate is None:
+            return 0
+        with self._lock:
+            if (rate := self._rate) is None:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= size
+            return -self._tokens / rate if self._tokens < 0 else 0
+
+
+class RateLimiter:
+    """全局限速加上按主机的限速，所有下载线程共用一个"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._global = TokenBucket()
+        self._hosts: dict[str, TokenBucket] = {}
+
+    @property
+    def rate(self):
+        return self._global.rate
+
+    def set_rate(self, rate: Optional[float]):
+        """设置总速率，字节每秒，None 为不限速"""
+        self._global.set_rate(rate)
+
+    def set_host_rate(self, host: str, rate: Optional[float]):
+        """设置某个主机的速率，字节每秒，None 为不限速"""
+        with self._lock:
+            if rate is None:
+                self._hosts.pop(host, None)
+            elif host in self._hosts:
+                self._hosts[host].set_rate(rate)
+            else:
+                self._hosts[host] = TokenBucket(rate)
+
+    def host_rates(self) -> dict[str, Optional[float]]:
+        with self._lock:
+            return {h: b.rate for h, b in self._hosts.items()}
+
+    def reserve(self, size: int, host: Optional[str] = None) -> float:
+        """收到了 size 个字节，返回需要等待的秒数"""
+        wait = self._global.reserve(size)
+        if host and (bucket := self._hosts.get(host)):
+            wait = max(wait, bucket.reserve(size))
+        return wait
+
+    def consume(self, size: int, host: Optional[str] = None):
+        """收到了 size 个字节，超速时在这里睡一会"""
+        if (wait := self.reserve(size, host)) > 0:
+            time.sleep(wait)
+
+
+limiter = RateLimiter()
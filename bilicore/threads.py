@@ -1,15 +1,28 @@
 from typing import Literal, Optional, Any, Callable
 import os
+import time
+import logging
 import threading
 import functools
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
+
+import requests
 
 from biliapis.utils import remove_none
 from biliapis import APIContainer, bilicodes
 from biliapis import subtitle
+from biliapis.constants import CDN_TIMEOUT
 from bilicore.downloader import download_common
+from bilicore import aio, hostrank, pipemerge
 from bilicore.parser import select_quality
-from bilicore.utils import filename_escape, merge_avfile, convert_audio
+from bilicore.postproc import PostProcessor
+from bilicore.utils import (
+    filename_escape,
+    merge_avfile,
+    convert_audio,
+    ProgressNotifier,
+)
 
 # 写得最史的地方
 
@@ -22,8 +35,41 @@ class ThreadProgressMixin:
         self.__progress_name = ""
         self.__report_lock = threading.Lock()
         self.__exceptions: list[Exception] = []
+        self.__notifier: Optional[ProgressNotifier] = None
+        self.__postproc: Optional[PostProcessor] = None
+        self.__post_future: Optional[Future] = None
+        self.__stage_times: dict[str, float] = {}
+        self.__prepare_lock = threading.Lock()
+        self.__prepared: Optional[bool] = None
         self._report_progress(0, 0, "pending")
 
+    def set_notifier(self, notifier: Optional[ProgressNotifier]):
+        """进度有变化时通知 notifier"""
+        self.__notifier = notifier
+
+    def set_postproc(self, postproc: Optional[PostProcessor]):
+        """设置之后，ffmpeg 之类的收尾工作交给 postproc 的队列，线程本身下完就结束，
+        不设置的话在线程里直接做"""
+        self.__postproc = postproc
+
+    @property
+    def postproc(self) -> Optional[PostProcessor]:
+        return self.__postproc
+
+    @property
+    def post_pending(self) -> bool:
+        """还有交给队列的收尾工作没做完"""
+        return (future := self.__post_future) is not None and not future.done()
+
+    def join_post(self, timeout: Optional[float] = None):
+        """等交给队列的收尾工作结束"""
+        if (future := self.__post_future) is not None:
+            wait([future], timeout)
+
+    def _notify(self):
+        if notifier := self.__notifier:
+            notifier.notify()
+
     def _report_progress(
         self,
         curr: Optional[int] = None,
@@ -31,25 +77,30 @@ class ThreadProgressMixin:
         pgr_text: Optional[str] = None,
         pgr_name: Optional[str] = None,
     ):
-        with self.__report_lock:
-            if isinstance(curr, int):
-                self.__curr = curr
-            if isinstance(total, int):
-                self.__total = total
-            if isinstance(pgr_text, str):
-                self.__progress_text = pgr_text
-            if isinstance(pgr_name, str):
-                self.__progress_name = pgr_name
+        # 字节数每个数据块都会更新，单纯赋值就行，不加锁
+        if isinstance(curr, int):
+            self.__curr = curr
+        if isinstance(total, int):
+            self.__total = total
+        if isinstance(pgr_text, str) or isinstance(pgr_name, str):
+            with self.__report_lock:
+                if isinstance(pgr_text, str):
+                    self.__progress_text = pgr_text
+                if isinstance(pgr_name, str):
+                    self.__progress_name = pgr_name
+        self._notify()
 
     def _report_exception(self, exc: Exception):
         with self.__report_lock:
             self.__exceptions.append(exc)
+        self._notify()
 
     def observe(self):
+        curr, total = self.__curr, self.__total
         with self.__report_lock:
             return (
-                self.__curr,
-                self.__total,
+                curr,
+                total,
                 (
                     (f"{self.__progress_name} - " if self.__progress_name else "")
                     + f"{self.__progress_text}"
@@ -61,16 +112,50 @@ class ThreadProgressMixin:
         with self.__report_lock:
             return self.__exceptions.copy()
 
+    @property
+    def stage_times(self) -> dict[str, float]:
+        """各阶段的用时，秒"""
+        with self.__report_lock:
+            return self.__stage_times.copy()
+
+    @contextlib.contextmanager
+    def _stage(self, name: str, total: int = 0):
+        """一个阶段：进度从 0 开始重新算，结束时记下用时"""
+        self._report_progress(curr=0, total=total, pgr_text=name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            with self.__report_lock:
+                self.__stage_times[name] = self.__stage_times.get(name, 0) + elapsed
+            logging.info("%s: %s took %.2fs", self.__progress_name, name, elapsed)
+
     def _progress_hook(
         self,
         curr: Optional[int] = None,
         total: Optional[int] = None,
-        offset: int = 0,
     ):
         if curr:
-            self._report_progress(curr=curr + offset)
+            self._report_progress(curr=curr)
         if total:
-            self._report_progress(total=total + offset)
+            self._report_progress(total=total)
+
+    def _progress_hooks(
+        self, count: int
+    ) -> list[Callable[[Optional[int], Optional[int]], Any]]:
+        """给同时进行的 count 个下载各发一个 hook，汇报的是它们加起来的进度"""
+        currs, totals = [0] * count, [0] * count
+
+        def hook(i: int, curr: Optional[int] = None, total: Optional[int] = None):
+            # 每个 hook 只写自己那一格，求和时读到的最多是旧一点的值
+            if curr:
+                currs[i] = curr
+            if total:
+                totals[i] = total
+            self._report_progress(curr=sum(currs), total=sum(totals))
+
+        return [functools.partial(hook, i) for i in range(count)]
 
     def _run_wrapped(self, worker: Callable[[], Any]):
         # 这个写法有点傻逼的
@@ -80,23 +165,109 @@ class ThreadProgressMixin:
         except Exception as e:
             self._report_exception(e)
             self._report_progress(pgr_text="errored")
+        finally:
+            self._notify()
+
+    def prepare(self) -> bool:
+        """先把不占带宽的准备工作（取信息、选流、字幕封面这些）做掉，返回还需不需要下载
+
+        流水线里由单独的线程池在下载前调用，只会做一次；没调用过的话 run 时先做。
+        出错时异常记进 exceptions，返回 False"""
+        with self.__prepare_lock:
+            if self.__prepared is None:
+                self.__prepared = False
+                try:
+                    self._report_progress(pgr_text="collecting data")
+                    self.__prepared = self._prepare()
+                except Exception as e:
+                    self._report_exception(e)
+                    self._report_progress(pgr_text="errored")
+                finally:
+                    self._notify()
+            return self.__prepared
+
+    def _prepare(self) -> bool:
+        return True
+
+    def _post_process(self, func: Callable[[], Any]):
+        """做收尾工作，设置了 postproc 时排进它的队列就返回"""
+        if (postproc := self.__postproc) is None:
+            func()
+            return
+        self._report_progress(pgr_text="waiting for post-processing")
+        self.__post_future = postproc.submit(self._run_post, func)
+
+    def _run_post(self, func: Callable[[], Any]):
+        try:
+            func()
+        except Exception as e:
+            self._report_exception(e)
+            self._report_progress(pgr_text="errored")
+        finally:
+            self._notify()
 
 
 class ThreadUtilsMixin:
+    # 预检时估出来的还要下载的字节数，排任务顺序用，没估过或估不出来为 None
+    estimated_size: Optional[int] = None
+
+    @property
+    def temp_files(self) -> list[str]:
+        """准备阶段定下来的临时文件"""
+        plan: dict[str, Any] = getattr(self, "_plan", {})
+        return [f for k, f in plan.items() if k.endswith("tmpfile") and f]
+
+    @staticmethod
+    def _pick_dlopts(options: dict[str, Any]) -> dict[str, Any]:
+        """从线程的选项里挑出交给 _dstream 的下载选项"""
+        return remove_none(
+            {
+                "threadnum": options.get("max_connections"),
+                "min_range_size": options.get("min_range_size"),
+                "multi_mirror": options.get("multi_mirror"),
+                "engine": options.get("engine"),
+                "buffer_size": options.get("buffer_size"),
+                "trust_etag": options.get("verify_etag"),
+                "stall_speed": options.get("stall_speed"),
+                "stall_timeout": options.get("stall_timeout"),
+            }
+        )
+
     @staticmethod
     def _dstream(
         urls: list[str],
         file: str,
         hook: Callable[[Optional[int], Optional[int]], Any],
         apis: APIContainer,
+        multi_mirror: bool = False,
+        engine: Literal["thread", "asyncio"] = "thread",
+        **dlopts,
     ):
+        # asyncio 引擎的连接都在一个共用的事件循环上，不再一条连接占一个线程
+        download = aio.download_common if engine == "asyncio" else download_common
+        # 快的镜像排前面
+        urls = hostrank.rank_urls(
+            urls, session=apis.session, headers=apis.DEFAULT_HEADERS
+        )
+        if multi_mirror and len(urls) > 1:
+            # 各个镜像同时下载不同的部分，镜像间的切换交给下载器
+            download(
+                urls[0],
+                file,
+                session=apis.session,
+                hook_func=hook,
+                mirrors=urls[1:],
+                **dlopts,
+            )
+            return
         for i, u in enumerate(urls):
             try:
-                download_common(
+                download(
                     u,
                     file,
                     session=apis.session,
                     hook_func=hook,
+                    **dlopts,
                 )
             except Exception:
                 if i + 1 == len(urls):
@@ -104,9 +275,32 @@ class ThreadUtilsMixin:
             else:
                 return
 
+    @staticmethod
+    def _stream_size(
+        urls: list[str], apis: APIContainer, fallback: Optional[int] = None
+    ) -> Optional[int]:
+        """向 CDN 问文件大小，都问不到时返回 fallback"""
+        for url in urls:
+            try:
+                resp = apis.session.head(
+                    url,
+                    headers=apis.DEFAULT_HEADERS,
+                    timeout=CDN_TIMEOUT,
+                    allow_redirects=True,
+                )
+                resp.raise_for_status()
+            except requests.RequestException as e:
+                logging.debug("unable to get size of %s: %s", url, e)
+                continue
+            if (length := resp.headers.get("Content-Length", "")).isdigit():
+                return int(length)
+        return fallback
+
     @staticmethod
     def _dfile(url, file, apis: APIContainer):
-        data = apis.session.get(url, headers=apis.DEFAULT_HEADERS).content
+        data = apis.session.get(
+            url, headers=apis.DEFAULT_HEADERS, timeout=CDN_TIMEOUT
+        ).content
         with open(file, "wb+") as fp:
             fp.write(data)
 
@@ -122,6 +316,16 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         "subtitle_format",
         "need_cover",
         "no_metadata",
+        "stream_merge",
+        # 传输选项
+        "max_connections",
+        "min_range_size",
+        "multi_mirror",
+        "engine",
+        "buffer_size",
+        "verify_etag",
+        "stall_speed",
+        "stall_timeout",
         # 预处理数据
         "stream_data",
         "video_data",
@@ -131,6 +335,8 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         "pindex",
         "ptitle",
     )
+    # 预检时取到的流过了这么久就重新取，流地址是会过期的，秒
+    STREAM_TTL = 20 * 60
 
     def __init__(
         self,
@@ -152,6 +358,7 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         self._savedir = savedir
 
         options = {k: v for k, v in options.items() if k in self.VALID_OPTIONS}
+        self._options = options
         self._audio_only = bool(options.get("audio_only", False))
         self._vq: str | int = options.get("video_quality", "max")
         self._vc: Literal["avc", "hevc"] = options.get("video_codec", "avc")
@@ -160,78 +367,118 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         self._sf: Literal["vtt", "srt", "lrc"] = options.get("subtitle_format", "vtt")
         self._need_cover: bool = bool(options.get("need_cover", False))
         self._need_metadata: bool = not bool(options.get("no_metadata", False))
+        self._stream_merge: bool = bool(options.get("stream_merge", False))
+        self._dlopts = self._pick_dlopts(options)
 
         self._video_data: Optional[dict[str, Any]] = options.get("video_data")
         self._streams: Optional[dict[str, Any]] = options.get("stream_data")
+        # 传进来的流也是刚取的，一样会过期
+        self._streams_expire: Optional[float] = (
+            None if self._streams is None else time.monotonic() + self.STREAM_TTL
+        )
         self._player_info: Optional[dict[str, Any]] = options.get("player_info")
 
         self._correct_title: Optional[str] = options.get("title")
         self._correct_pindex: Optional[int] = options.get("pindex")
         self._correct_ptitle: Optional[str] = options.get("ptitle")
+        # 准备阶段的结果，下载阶段用
+        self._plan: dict[str, Any] = {}
 
     def run(self):
         self._run_wrapped(self._worker)
 
-    def _worker(self):
-        self._report_progress(pgr_text="collecting data")
+    @property
+    def job_key(self) -> tuple:
+        """区分任务的键，键相同的是同一个任务"""
+        return ("video", self._id.get("bvid") or self._id.get("avid"), self._cid)
+
+    @property
+    def job_args(self) -> dict[str, Any]:
+        """重新创建这个任务的参数（apis 除外），已经取到的信息也带上，省得再取一次；
+        流地址会过期，不带"""
+        return remove_none(
+            {
+                "cid": self._cid,
+                **self._id,
+                "savedir": self._savedir,
+                **{k: v for k, v in self._options.items() if k != "stream_data"},
+                "video_data": self._video_data,
+                "player_info": self._player_info,
+            }
+        )
+
+    def estimate(self) -> tuple[Optional[int], Optional[float]]:
+        """预检用：估计还要下载的字节数（估不出来为 None，文件已存在的为 0）
+        和 CDN 记录下来的速度
+
+        取到的视频信息和流会留给之后的下载，估出来的大小记进 estimated_size"""
+        vdata, pindex, vstream, astream = self._resolve()
+        aqid = -1 if astream is None else astream["id"]
+        if (astream is None and self._audio_only) or os.path.isfile(
+            self._final_file(vdata, pindex, vstream["id"], aqid)
+        ):
+            self.estimated_size = 0
+            return 0, None
+        assert self._streams is not None
+        duration = self._streams["dash"].get("duration")
+        sizes, urls = [], []
+        for stream in (astream,) if self._audio_only else (astream, vstream):
+            if stream is None:
+                continue
+            urls.append([stream["base_url"]] + stream["backup_url"])
+            sizes.append(
+                self._stream_size(
+                    urls[-1],
+                    self._apis,
+                    fallback=(
+                        int(stream["bandwidth"] * duration / 8)
+                        if duration and stream.get("bandwidth")
+                        else None
+                    ),
+                )
+            )
+        self.estimated_size = None if None in sizes else sum(sizes)
+        return self.estimated_size, hostrank.speed_of(u for us in urls for u in us)
+
+    def _resolve(
+        self,
+    ) -> tuple[dict[str, Any], int, dict[str, Any], Optional[dict[str, Any]]]:
+        """取视频信息和流，选好画质，返回 (视频信息, 分P序号, 视频流, 音频流)"""
         if self._video_data is None:
             self._video_data = self._apis.video.get_video_detail(**self._id)
         vdata = self._video_data
         cidlist = [p["cid"] for p in vdata["pages"]]
         if self._cid not in cidlist:
             raise ValueError("wrong cid")
-        cid = self._cid
-        pindex = cidlist.index(cid)
-        self._report_progress(
-            pgr_name="{bvid} P{p}".format(
-                bvid=vdata["bvid"],
-                p=pindex + 1 if self._correct_pindex is None else self._correct_pindex,
+        if self._streams_expire is not None and time.monotonic() > self._streams_expire:
+            self._streams = self._streams_expire = None
+        if self._streams is None:
+            self._streams = self._apis.video.get_stream_dash(
+                self._cid, bvid=vdata["bvid"]
             )
-        )
-        bvid = vdata["bvid"]
-        player_info = self._player_info or self._apis.video.get_player_info(
-            cid=cid, bvid=bvid
-        )
-        if _ := player_info.get("subtitle", {}).get("subtitles", []):
-            subtitles = _
-        else:
-            subtitles = []
-        streams = self._streams or self._apis.video.get_stream_dash(cid, bvid=bvid)
+            self._streams_expire = time.monotonic() + self.STREAM_TTL
         vstream, astream = select_quality(
-            streams, aq=self._aq, vq=self._vq, enc=self._vc
+            self._streams, aq=self._aq, vq=self._vq, enc=self._vc
         )
-        # 处理没有音轨的情况
-        no_audio = astream is None
-        if no_audio and self._audio_only:
-            self._report_progress(pgr_text="terminated: no audio stream to download")
-            return
+        return vdata, cidlist.index(self._cid), vstream, astream
+
+    def _final_file(
+        self, vdata: dict[str, Any], pindex: int, vqid: int, aqid: int
+    ) -> str:
         title = vdata["title"] if self._correct_title is None else self._correct_title
         ptitle = (
             vdata["pages"][pindex]["part"]
             if self._correct_ptitle is None
             else self._correct_ptitle
         )
-        vqid = vstream["id"]
-        aqid = -1 if no_audio else astream["id"]
         is_lossless = aqid == 30251
-        # 生成文件名
-        vtmpfile = os.path.join(self._savedir, f"{bvid}_{cid}_{vqid}_videostream.m4v")
-        atmpfile = (
-            ""
-            if no_audio
-            else os.path.join(
-                self._savedir,
-                f"{bvid}_{cid}_{aqid}_videostream"
-                + (".flac" if is_lossless else ".m4a"),
-            )
-        )
-        finalfile = os.path.join(
+        return os.path.join(
             self._savedir,
             filename_escape(
                 (
                     f"{title}"
                     + (
-                        (f"_P{pindex+1}" if len(cidlist) > 1 else "")
+                        (f"_P{pindex+1}" if len(vdata["pages"]) > 1 else "")
                         if self._correct_pindex is None
                         else f"_P{self._correct_pindex}"
                     )
@@ -251,9 +498,51 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
                 )
             ),
         )
+
+    def _worker(self):
+        if self.prepare():
+            self._transfer()
+
+    def _prepare(self) -> bool:
+        vdata, pindex, vstream, astream = self._resolve()
+        cid = self._cid
+        self._report_progress(
+            pgr_name="{bvid} P{p}".format(
+                bvid=vdata["bvid"],
+                p=pindex + 1 if self._correct_pindex is None else self._correct_pindex,
+            )
+        )
+        bvid = vdata["bvid"]
+        if self._player_info is None:
+            self._player_info = self._apis.video.get_player_info(cid=cid, bvid=bvid)
+        player_info = self._player_info
+        if _ := player_info.get("subtitle", {}).get("subtitles", []):
+            subtitles = _
+        else:
+            subtitles = []
+        # 处理没有音轨的情况
+        no_audio = astream is None
+        if no_audio and self._audio_only:
+            self._report_progress(pgr_text="terminated: no audio stream to download")
+            return False
+        vqid = vstream["id"]
+        aqid = -1 if no_audio else astream["id"]
+        is_lossless = aqid == 30251
+        # 生成文件名
+        vtmpfile = os.path.join(self._savedir, f"{bvid}_{cid}_{vqid}_videostream.m4v")
+        atmpfile = (
+            ""
+            if no_audio
+            else os.path.join(
+                self._savedir,
+                f"{bvid}_{cid}_{aqid}_videostream"
+                + (".flac" if is_lossless else ".m4a"),
+            )
+        )
+        finalfile = self._final_file(vdata, pindex, vqid, aqid)
         if os.path.isfile(finalfile):
             self._report_progress(pgr_text="skipped: file already exists")
-            return
+            return False
         # 封面
         coverfile: Optional[str] = None
         if self._need_cover:
@@ -272,53 +561,145 @@ class SingleVideoThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
                         subfile.format(lan=sub["lan"]),
                         self._sf,
                     )
-        vurls = [vstream["base_url"]] + vstream["backup_url"]
-        self._report_progress(pgr_text="audio stream")
+        # 音轨和视频轨同时下载，整体耗时约等于较大的那一个
+        streams = []
         if not no_audio:
-            aurls = [astream["base_url"]] + astream["backup_url"]
-            self._dstream(aurls, atmpfile, self._progress_hook, apis=self._apis)
+            streams.append(([astream["base_url"]] + astream["backup_url"], atmpfile))
+        if not self._audio_only:
+            streams.append(([vstream["base_url"]] + vstream["backup_url"], vtmpfile))
+        self._plan = {
+            "streams": streams,
+            "no_audio": no_audio,
+            "is_lossless": is_lossless,
+            "aqid": aqid,
+            "atmpfile": atmpfile,
+            "vtmpfile": vtmpfile,
+            "finalfile": finalfile,
+            "metadata": (
+                self._generate_metadict(vdata, pindex) if self._need_metadata else None
+            ),
+            "cover_image": coverfile if self._need_cover else None,
+            "duration": vdata["pages"][pindex].get("duration"),
+        }
+        return True
+
+    def _transfer(self):
+        if self._streams_expire is not None and time.monotonic() > self._streams_expire:
+            # 在队列里等得太久，流地址已经过期了，重新准备一遍
+            logging.info("streams of cid %s expired, resolve again", self._cid)
+            if not self._prepare():
+                return
+        plan = self._plan
+        streams, no_audio, aqid = plan["streams"], plan["no_audio"], plan["aqid"]
+        is_lossless, duration = plan["is_lossless"], plan["duration"]
+        atmpfile, vtmpfile = plan["atmpfile"], plan["vtmpfile"]
+        finalfile = plan["finalfile"]
+        metadata, cover_image = plan["metadata"], plan["cover_image"]
+        # 边下边合流
+        merger: Optional[pipemerge.StreamMerger] = None
+        if self._stream_merge and not self._audio_only:
+            if pipemerge.supported():
+                merger = pipemerge.StreamMerger(
+                    (None if no_audio else atmpfile),
+                    vtmpfile,
+                    finalfile,
+                    metadata=metadata,
+                    cover_image=cover_image,
+                    nice=self.postproc.nice if self.postproc else None,
+                )
+                try:
+                    merger.start()
+                except OSError as e:
+                    # 多半是没装 ffmpeg，下完再合
+                    logging.warning("failed to start stream merge: %s", e)
+                    merger = None
+            else:
+                logging.warning("stream merge is not supported here, merge later")
+        try:
+            with self._stage("audio stream" if self._audio_only else "streaming"):
+                self._dstreams(
+                    streams,
+                    prefix_hooks=(
+                        [merger.hook_for(f) for _, f in streams] if merger else None
+                    ),
+                )
+        except BaseException:
+            if merger:
+                merger.cancel()
+            raise
+        # 吃 CPU 的收尾工作交给后处理队列，下载的这个线程可以去下一个任务了
+
         # 仅音轨的分岔
-        if self._audio_only:
-            self._report_progress(pgr_text="converting")
-            convert_audio(
-                atmpfile,
-                finalfile,
-                quality=(
-                    None
-                    if is_lossless
-                    else bilicodes.stream_dash_audio_quality.get(aqid, "192k").lower()
-                ),
-                metadata=(
-                    self._generate_metadict(vdata, pindex)
-                    if self._need_metadata
-                    else None
-                ),
-                cover_image=(coverfile if self._need_cover else None),
-            )
+        def convert():
+            with self._stage("converting"):
+                convert_audio(
+                    atmpfile,
+                    finalfile,
+                    quality=(
+                        None
+                        if is_lossless
+                        else bilicodes.stream_dash_audio_quality.get(
+                            aqid, "192k"
+                        ).lower()
+                    ),
+                    metadata=metadata,
+                    cover_image=cover_image,
+                    hook=self._progress_hook,
+                    duration=duration,
+                )
             os.remove(atmpfile)
             self._report_progress(pgr_text="done")
-            return
+
         # 普通视频的分岔
-        vhook = functools.partial(
-            self._progress_hook,
-            offset=(os.path.getsize(atmpfile) if os.path.isfile(atmpfile) else 0),
-        )
-        self._report_progress(pgr_text="video stream")
-        self._dstream(vurls, vtmpfile, vhook, apis=self._apis)
-        self._report_progress(pgr_text="merging")
-        merge_avfile(
-            (None if no_audio else atmpfile),
-            vtmpfile,
-            finalfile,
-            metadata=(
-                self._generate_metadict(vdata, pindex) if self._need_metadata else None
-            ),
-            cover_image=(coverfile if self._need_cover else None),
-        )
-        if not no_audio:
-            os.remove(atmpfile)
-        os.remove(vtmpfile)
-        self._report_progress(pgr_text="done")
+        def merge():
+            with self._stage("merging"):
+                # 边下边合流没成功的话，临时文件都还在，照常再合一次
+                if merger is None or not merger.finish():
+                    merge_avfile(
+                        (None if no_audio else atmpfile),
+                        vtmpfile,
+                        finalfile,
+                        metadata=metadata,
+                        cover_image=cover_image,
+                        hook=self._progress_hook,
+                        duration=duration,
+                    )
+            if not no_audio:
+                os.remove(atmpfile)
+            os.remove(vtmpfile)
+            self._report_progress(pgr_text="done")
+
+        self._post_process(convert if self._audio_only else merge)
+
+    def _dstreams(
+        self,
+        streams: list[tuple[list[str], str]],
+        prefix_hooks: Optional[list[Callable[[int], Any]]] = None,
+    ):
+        """同时下载几条流，[(urls, file), ...]，进度合在一起汇报；
+        prefix_hooks 和 streams 一一对应，见 download_common
+
+        等所有流都结束后再抛出第一个出错的异常，已下好的部分留给下次续传"""
+        dlopts = [
+            self._dlopts | ({"prefix_hook": hook} if hook else {})
+            for hook in (prefix_hooks or [None] * len(streams))
+        ]
+        if len(streams) == 1:
+            urls, file = streams[0]
+            self._dstream(
+                urls, file, self._progress_hook, apis=self._apis, **dlopts[0]
+            )
+            return
+        hooks = self._progress_hooks(len(streams))
+        with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+            futures = [
+                executor.submit(
+                    self._dstream, urls, file, hook, apis=self._apis, **opts
+                )
+                for (urls, file), hook, opts in zip(streams, hooks, dlopts)
+            ]
+        for future in futures:
+            future.result()
 
     def _generate_metadict(
         self,
@@ -355,10 +736,20 @@ class SingleAudioThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         "quality",
         "need_lyrics",
         "need_cover",
-        "no_metadata"
+        "no_metadata",
+        # 传输选项
+        "max_connections",
+        "min_range_size",
+        "multi_mirror",
+        "engine",
+        "buffer_size",
+        "verify_etag",
+        "stall_speed",
+        "stall_timeout",
         # 预处理数据
         "audio_data",
     )
+    STREAM_TTL = SingleVideoThread.STREAM_TTL
 
     def __init__(self, apis: APIContainer, auid: int, savedir: str, **options) -> None:
         super().__init__(daemon=True)
@@ -367,32 +758,79 @@ class SingleAudioThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
         self._auid = auid
         self._savedir = savedir
         options = {k: v for k, v in options.items() if k in self.VALID_OPTIONS}
+        self._options = options
         self._quality: Optional[Literal[0, 1, 2, 3]] = options.get("quality", 3)
         self._need_lrc = bool(options.get("need_lyrics", False))
         self._need_cover = bool(options.get("need_cover", False))
         self._need_metadata = not bool(options.get("no_metadata", False))
+        self._dlopts = self._pick_dlopts(options)
         self._info: Optional[dict[str, Any]] = options.get("audio_data")
+        self._stream: Optional[dict[str, Any]] = None
+        self._stream_expire = 0.0
+        self._plan: dict[str, Any] = {}
+
+    @property
+    def job_key(self) -> tuple:
+        return ("audio", self._auid)
+
+    @property
+    def job_args(self) -> dict[str, Any]:
+        """同 SingleVideoThread.job_args"""
+        return remove_none(
+            {
+                "auid": self._auid,
+                "savedir": self._savedir,
+                **self._options,
+                "audio_data": self._info,
+            }
+        )
+
+    def estimate(self) -> tuple[Optional[int], Optional[float]]:
+        """同 SingleVideoThread.estimate"""
+        info, stream = self._resolve()
+        if os.path.isfile(self._final_file(info, stream)):
+            self.estimated_size = 0
+        else:
+            self.estimated_size = stream.get("size") or self._stream_size(
+                stream["cdns"], self._apis
+            )
+        return self.estimated_size, hostrank.speed_of(stream["cdns"])
+
+    def _resolve(self) -> tuple[dict[str, Any], dict[str, Any]]:
+        if not self._info:
+            self._info = self._apis.audio.get_info(self._auid)
+        if self._stream is None or time.monotonic() > self._stream_expire:
+            self._stream = self._apis.audio.get_stream(
+                auid=self._info["id"], quality=self._quality
+            )
+            self._stream_expire = time.monotonic() + self.STREAM_TTL
+        return self._info, self._stream
+
+    def _final_file(self, info: dict[str, Any], stream: dict[str, Any]) -> str:
+        return os.path.join(
+            self._savedir,
+            filename_escape(
+                "{title}".format(**info)
+                + ("_" + bilicodes.stream_audio_quality.get(stream["type"], ""))
+                + (".flac" if stream["type"] == 3 else ".mp3")
+            ),
+        )
 
     def _worker(self):
-        self._report_progress(pgr_text="collecting data")
-        info = self._info if self._info else self._apis.audio.get_info(self._auid)
+        if self.prepare():
+            self._transfer()
+
+    def _prepare(self) -> bool:
+        info, stream = self._resolve()
         auid = info["id"]
         self._report_progress(pgr_name=f"au{auid}")
-        stream = self._apis.audio.get_stream(auid=auid, quality=self._quality)
         is_lossless = stream["type"] == 3
         tmpfile = os.path.join(
             self._savedir,
             "au{sid}_{type}_{size}".format(**stream)
             + (".flac" if is_lossless else ".m4a"),
         )
-        finalfile = os.path.join(
-            self._savedir,
-            filename_escape(
-                "{title}".format(**info)
-                + ("_" + bilicodes.stream_audio_quality.get(stream["type"], ""))
-                + (".flac" if is_lossless else ".mp3")
-            ),
-        )
+        finalfile = self._final_file(info, stream)
         if (lrc_url := info.get("lyric")) and self._need_lrc:
             self._report_progress(pgr_text="lyrics")
             self._dfile(lrc_url, finalfile + ".lrc", self._apis)
@@ -403,31 +841,56 @@ class SingleAudioThread(threading.Thread, ThreadUtilsMixin, ThreadProgressMixin)
             self._dfile(cover, coverfile, self._apis)
         if os.path.isfile(finalfile):
             self._report_progress(pgr_text="skipped")
+            return False
+        self._plan = {
+            "is_lossless": is_lossless,
+            "tmpfile": tmpfile,
+            "finalfile": finalfile,
+            "coverfile": coverfile,
+        }
+        return True
+
+    def _transfer(self):
+        if time.monotonic() > self._stream_expire and not self._prepare():
+            # 同 SingleVideoThread._transfer，流地址过期了要重新准备
             return
+        info, stream = self._info, self._stream
+        assert info is not None and stream is not None
+        plan = self._plan
+        is_lossless, tmpfile = plan["is_lossless"], plan["tmpfile"]
+        finalfile, coverfile = plan["finalfile"], plan["coverfile"]
+        with self._stage("downloading"):
+            self._dstream(
+                stream["cdns"],
+                tmpfile,
+                self._progress_hook,
+                apis=self._apis,
+                **self._dlopts,
+            )
 
-        self._report_progress(pgr_text="downloading")
-        self._dstream(
-            stream["cdns"],
-            tmpfile,
-            self._progress_hook,
-            apis=self._apis,
-        )
-        self._report_progress(pgr_text="converting")
-        convert_audio(
-            tmpfile,
-            finalfile,
-            quality=(
-                None
-                if is_lossless
-                else bilicodes.stream_audio_quality.get(stream["type"], "320k")[
-                    :4
-                ].lower()
-            ),
-            metadata=(self._generate_metadict(info) if self._need_metadata else None),
-            cover_image=(coverfile if self._need_metadata else None),
-        )
-        os.remove(tmpfile)
-        self._report_progress(pgr_text="done")
+        def convert():
+            with self._stage("converting"):
+                convert_audio(
+                    tmpfile,
+                    finalfile,
+                    quality=(
+                        None
+                        if is_lossless
+                        else bilicodes.stream_audio_quality.get(
+                            stream["type"], "320k"
+                        )[:4].lower()
+                    ),
+                    metadata=(
+                        self._generate_metadict(info) if self._need_metadata else None
+                    ),
+                    cover_image=(coverfile if self._need_metadata else None),
+                    hook=self._progress_hook,
+                    duration=info.get("duration"),
+                )
+            os.remove(tmpfile)
+            self._report_progress(pgr_text="done")
+
+        self._post_process(convert)
 
     def _generate_metadict(self, audio_info: dict[str, Any]) -> dict[str, str]:
         auid = audio_info["id"]
@@ -457,23 +920,39 @@ class SingleMangaChapterThread(threading.Thread, ThreadUtilsMixin, ThreadProgres
         self._epid = epid
         self._savedir = savedir
         options = {k: v for k, v in options.items() if k in self.VALID_OPTIONS}
+        self._options = options
         self._create_childfolder = bool(options.get("create_childfolder", True))
         self._ep_data: Optional[dict[str, Any]] = options.get("ep_data")
 
+    @property
+    def job_key(self) -> tuple:
+        return ("manga", self._epid)
+
+    @property
+    def job_args(self) -> dict[str, Any]:
+        """同 SingleVideoThread.job_args"""
+        return remove_none(
+            {
+                "epid": self._epid,
+                "savedir": self._savedir,
+                **self._options,
+                "ep_data": self._ep_data,
+            }
+        )
+
     def _worker(self):
         self._report_progress(pgr_text="collecting data", pgr_name=f"ep{self._epid}")
-        epinfo = (
-            self._ep_data
-            if self._ep_data
-            else self._apis.manga.get_episode_info(epid=self._epid)
-        )
+        if not self._ep_data:
+            self._ep_data = self._apis.manga.get_episode_info(epid=self._epid)
+        epinfo = self._ep_data
+        savedir = self._savedir
         if self._create_childfolder:
-            self._savedir = os.path.join(
-                self._savedir,
+            savedir = os.path.join(
+                savedir,
                 filename_escape("{short_title}_{title}_{comic_title}".format(**epinfo)),
             )
-            if not os.path.isdir(self._savedir):
-                os.mkdir(self._savedir)
+            if not os.path.isdir(savedir):
+                os.mkdir(savedir)
         index = self._apis.manga.get_image_index(self._epid)
         paths = [i["path"] for i in index["images"]]
         tokens = self._apis.manga.get_image_token(*paths)
@@ -490,7 +969,7 @@ class SingleMangaChapterThread(threading.Thread, ThreadUtilsMixin, ThreadProgres
                 executor.submit(
                     self._dfile,
                     url,
-                    os.path.join(self._savedir, "%03d.jpg") % (i + 1),
+                    os.path.join(savedir, "%03d.jpg") % (i + 1),
                     self._apis,
                 )
                 for i, url in enumerate(urls)
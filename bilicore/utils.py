@@ -4,6 +4,11 @@ from typing import Callable, Iterable, Mapping, Any, Optional, Union
 import functools
 import subprocess
 import logging
+import shutil
+import time
+import os
+
+from bilicore import mp4mux
 
 _FN_REPMAP = {
     "/": "／",
@@ -18,14 +23,102 @@ _FN_REPMAP = {
 }
 
 
-def call_ffmpeg(*args, check=True):
-    cmd = ["ffmpeg", "-loglevel", "quiet", "-nostdin", "-hide_banner"]
-    cmd.extend(args)
+# 当前线程启动的 ffmpeg 用的 nice 值，后处理队列的线程会设置它
+_ffmpeg_nice = threading.local()
+
+
+def set_ffmpeg_nice(nice: Optional[int]):
+    """之后当前线程里 call_ffmpeg 启动的 ffmpeg 都以这个 nice 值运行，
+    Windows 上换算成对应的优先级类"""
+    _ffmpeg_nice.value = nice
+
+
+def priority_options(
+    cmd: list[str], nice: Optional[int] = None
+) -> tuple[list[str], dict[str, Any]]:
+    """按 nice 值降低 cmd 的优先级，返回 (新的命令, 要传给 Popen 的参数)，
+    nice 为 None 时用当前线程的设置（见 set_ffmpeg_nice）"""
+    if nice is None:
+        nice = getattr(_ffmpeg_nice, "value", None)
+    if not nice:
+        return cmd, {}
+    if os.name == "nt":
+        if nice < 0:
+            flag = subprocess.ABOVE_NORMAL_PRIORITY_CLASS
+        elif nice < 15:
+            flag = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        else:
+            flag = subprocess.IDLE_PRIORITY_CLASS
+        return cmd, {"creationflags": flag}
+    # preexec_fn 在多线程下不安全，借用 nice 命令
+    if shutil.which("nice"):
+        return ["nice", "-n", str(nice), *cmd], {}
+    return cmd, {}
+
+
+def ffmpeg_command(*args) -> list[str]:
+    return ["ffmpeg", "-loglevel", "quiet", "-nostdin", "-hide_banner", *args]
+
+
+def call_ffmpeg(
+    *args, check=True, progress: Optional[Callable[[dict[str, str]], Any]] = None
+):
+    """progress 给了的话，ffmpeg 每汇报一次进度（-progress 输出的一组 key=value）
+    就用这组值调用一次"""
+    if progress is None:
+        cmd, options = priority_options(ffmpeg_command(*args))
+        logging.debug("executing: %s", cmd)
+        p = subprocess.run(cmd, capture_output=True, text=True, check=check, **options)
+        return p.returncode
+    cmd, options = priority_options(
+        ffmpeg_command("-progress", "pipe:1", "-nostats", *args)
+    )
     logging.debug("executing: %s", cmd)
-    p = subprocess.run(cmd, capture_output=True, text=True, check=check)
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        **options,
+    ) as p:
+        assert p.stdout is not None
+        block: dict[str, str] = {}
+        for line in p.stdout:
+            key, _, value = line.strip().partition("=")
+            block[key] = value
+            # 每组以 progress=continue 或 progress=end 结尾
+            if key == "progress":
+                progress(block)
+                block = {}
+    if check and p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
     return p.returncode
 
 
+def ffmpeg_progress(
+    hook: Callable[[Optional[int], Optional[int]], Any],
+    input_files: Iterable[Optional[str]],
+    duration: Optional[float] = None,
+) -> Callable[[dict[str, str]], Any]:
+    """把 ffmpeg 的进度换算成 hook(已处理字节, 输入总字节)，和下载的进度用同一个单位
+
+    知道时长时按输出的时间占比算；不知道的话按输出的大小算，只对不转码的合流准"""
+    total = sum(os.path.getsize(f) for f in input_files if f)
+
+    def callback(block: dict[str, str]):
+        if block.get("progress") == "end":
+            curr = total
+        elif duration and (us := block.get("out_time_us", "")).isdigit():
+            curr = int(int(us) / 1e6 / duration * total)
+        elif (size := block.get("total_size", "")).isdigit():
+            curr = int(size)
+        else:
+            return
+        hook(min(curr, total), total)
+
+    return callback
+
+
 def check_ffmpeg():
     try:
         return call_ffmpeg("-h", check=False) == 0
@@ -33,14 +126,14 @@ def check_ffmpeg():
         return False
 
 
-def merge_avfile(
+def merge_args(
     au_file: Optional[str],
     vi_file: str,
     output_file: str,
     cover_image: Optional[str] = None,
     metadata: Optional[dict[str, str]] = None,
-) -> int:
-    """调用ffmpeg进行合流，并能添加元数据"""
+) -> list[str]:
+    """合流要传给 ffmpeg 的参数，输入也可以是 pipe:N 这样的管道"""
     args = ["-i", vi_file]
     if au_file:
         args.extend(["-i", au_file])
@@ -63,7 +156,34 @@ def merge_avfile(
             args.extend(["-metadata", f"{key}={value}"])
 
     args.append(output_file)
-    return call_ffmpeg(*args)
+    return args
+
+
+def merge_avfile(
+    au_file: Optional[str],
+    vi_file: str,
+    output_file: str,
+    cover_image: Optional[str] = None,
+    metadata: Optional[dict[str, str]] = None,
+    hook: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+    duration: Optional[float] = None,
+) -> int:
+    """调用ffmpeg进行合流，并能添加元数据
+
+    常见的 mp4 输出直接用内置的 mp4mux 拼，不启动 ffmpeg；封面、flac 等交给 ffmpeg
+    hook(已处理字节, 输入总字节) 汇报进度，duration 是时长（秒），知道的话进度更准"""
+    if not cover_image and mp4mux.supports(au_file, vi_file, output_file):
+        try:
+            mp4mux.mux(vi_file, au_file, output_file, metadata, hook=hook)
+            return 0
+        except mp4mux.MuxError as e:
+            logging.warning("built-in muxer failed, fall back to ffmpeg: %s", e)
+    return call_ffmpeg(
+        *merge_args(au_file, vi_file, output_file, cover_image, metadata),
+        progress=(
+            ffmpeg_progress(hook, (au_file, vi_file), duration) if hook else None
+        ),
+    )
 
 
 def convert_audio(
@@ -72,6 +192,8 @@ def convert_audio(
     quality: Optional[str] = None,
     metadata: Optional[dict[str, str]] = None,
     cover_image: Optional[str] = None,
+    hook: Optional[Callable[[Optional[int], Optional[int]], Any]] = None,
+    duration: Optional[float] = None,
 ):
     """
     转换音频文件格式，且能添加元数据和封面图片
@@ -81,6 +203,8 @@ def convert_audio(
     :param output_file: 输出文件路径
     :param metadata: 包含元数据的字典
     :param cover_image: 封面图片文件路径
+    :param hook: 进度回调，hook(已处理字节, 输入总字节)
+    :param duration: 音频时长（秒），给了的话进度按时间算
     """
     args = ["-i", input_file]
 
@@ -104,7 +228,10 @@ def convert_audio(
             args.extend(["-metadata", f"{key}={value}"])
 
     args.append(output_file)
-    return call_ffmpeg(*args)
+    return call_ffmpeg(
+        *args,
+        progress=ffmpeg_progress(hook, [input_file], duration) if hook else None,
+    )
 
 
 def filename_escape(text: str):
@@ -113,6 +240,32 @@ def filename_escape(text: str):
     return text
 
 
+class ProgressNotifier:
+    """进度变化的通知
+
+    报告方每次有变化就调 notify()，只有等待方处理完上一次变化之后才会真的去 set，
+    不会每个数据块都抢一次锁；等待方用 wait() 在有变化或超时时醒来，
+    两次醒来之间至少隔 min_interval 秒"""
+
+    def __init__(self, min_interval: float = 0) -> None:
+        self._event = threading.Event()
+        self._min_interval = min_interval
+        self._last = 0.0
+
+    def notify(self):
+        if not self._event.is_set():
+            self._event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等到有变化或超时，返回是否有变化"""
+        if (delay := self._last + self._min_interval - time.monotonic()) > 0:
+            time.sleep(delay)
+        changed = self._event.wait(timeout)
+        self._event.clear()
+        self._last = time.monotonic()
+        return changed
+
+
 class ThreadWithReturn(threading.Thread):
     def __init__(
         self,
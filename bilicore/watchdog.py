@@ -0,0 +1,185 @@
+import time
+import socket
+import logging
+import threading
+import contextlib
+from typing import Optional
+
+import requests
+
+__all__ = ["StallError", "ThroughputMeter", "Watch", "Watchdog", "watchdog"]
+
+
+class StallError(ConnectionError):
+    """连接的速度低于下限太久，被看门狗掐掉了"""
+
+
+class ThroughputMeter:
+    """按 interval 秒一段统计速度，连续 grace 秒低于 floor 字节每秒就算卡住
+
+    idle 的时候（限速等待、暂停）不计入"""
+
+    def __init__(self, floor: float, grace: float, interval: float = 1.0) -> None:
+        self.floor = floor
+        self.grace = grace
+        self.interval = interval
+        self.received = 0
+        self.idle = False
+        self._last_time = time.monotonic()
+        self._last_received = 0
+        self._below_since: Optional[float] = None
+
+    def feed(self, size: int):
+        self.received += size
+
+    def describe(self) -> str:
+        return f"stalled below {self.floor:.0f} B/s for {self.grace:.0f}s"
+
+    def skip(self, seconds: float):
+        """刚刚有 seconds 秒是空闲的，不计入统计"""
+        self._last_time += seconds
+
+    def check(self, now: Optional[float] = None) -> bool:
+        """返回是否已经卡住"""
+        now = time.monotonic() if now is None else now
+        if (elapsed := now - self._last_time) < self.interval:
+            return False
+        rate = (self.received - self._last_received) / elapsed
+        self._last_time, self._last_received = now, self.received
+        if self.idle or self.floor <= 0 or rate >= self.floor:
+            self._below_since = None
+            return False
+        if self._below_since is None:
+            # 从上一段的开头算起
+            self._below_since = now - elapsed
+        return now - self._below_since >= self.grace
+
+
+def _socket_of(raw) -> Optional[socket.socket]:
+    """urllib3 响应底下的 socket：保持连接时还在连接对象上，
+    服务器要关掉连接时 http.client 把它交给了响应自己的 fp"""
+    if (sock := getattr(getattr(raw, "connection", None), "sock", None)) is not None:
+        return sock
+    fp = getattr(getattr(raw, "_fp", None), "fp", None)
+    return getattr(getattr(fp, "raw", None), "_sock", None)
+
+
+class Watch(ThroughputMeter):
+    """看门狗盯着的一条连接"""
+
+    def __init__(self, resp: requests.Response, floor: float, grace: float) -> None:
+        super().__init__(floor, grace)
+        self._resp = resp
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stalled = False
+
+    @contextlib.contextmanager
+    def pause(self):
+        """这段时间里没有数据不算卡住"""
+        self.idle = True
+        try:
+            yield
+        finally:
+            self.idle = False
+
+    def abort(self) -> bool:
+        """从别的线程掐断连接，正在阻塞读取的线程会因此抛出异常，返回是否掐断了
+
+        阻塞读取的线程拿着响应的锁，这里 close 会跟着卡住，只能直接 shutdown 底下的 socket；
+        响应由读取的线程自己关。已经读完或者不再盯着的响应，连接可能已经还回连接池给别人用了，
+        不能碰"""
+        with self._lock:
+            raw = self._resp.raw
+            if self._closed or raw.closed:
+                return False
+            if (sock := _socket_of(raw)) is None:
+                logging.warning("can't find the socket of a stalled connection")
+                return False
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError as e:
+                logging.warning("failed to abort stalled connection: %s", e)
+                return False
+            self.stalled = True
+            return True
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+
+    def is_stalled(self) -> bool:
+        """等正在进行的 abort 做完再看"""
+        with self._lock:
+            return self.stalled
+
+
+class Watchdog:
+    """盯着各条下载连接的速度，低于下限太久的连接会被掐掉，
+    由下载线程按出错处理：把剩下的范围重新请求，有别的镜像时换一个
+
+    所有连接共用一个后台线程，第一次用到时启动"""
+
+    # 默认：连续 20 秒低于 16KiB/s 算卡住
+    FLOOR = 16 * 2**10
+    GRACE = 20.0
+    INTERVAL = 1.0
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._watches: set[Watch] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def _loop(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            with self._lock:
+                watches = list(self._watches)
+            for w in watches:
+                if not w.stalled and w.check():
+                    logging.warning(
+                        "connection stalled below %d B/s for %.0fs, aborting",
+                        w.floor,
+                        w.grace,
+                    )
+                    w.abort()
+
+    @contextlib.contextmanager
+    def watch(
+        self,
+        resp: requests.Response,
+        floor: Optional[float] = None,
+        grace: Optional[float] = None,
+    ):
+        """在 with 块里盯着 resp
+
+        被掐掉后块里抛出的异常会换成 StallError；掐断后读到的数据可能只是少了一截而没有报错，
+        这种情况在退出时也会抛出 StallError"""
+        w = Watch(
+            resp,
+            self.FLOOR if floor is None else floor,
+            self.GRACE if grace is None else grace,
+        )
+        with self._lock:
+            self._watches.add(w)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._loop, daemon=True, name="bilicore-watchdog"
+                )
+                self._thread.start()
+        try:
+            yield w
+        except Exception as e:
+            if w.is_stalled():
+                raise StallError(w.describe()) from e
+            raise
+        else:
+            if w.is_stalled():
+                raise StallError(w.describe())
+        finally:
+            w.close()
+            with self._lock:
+                self._watches.discard(w)
+
+
+watchdog = Watchdog()
@@ -0,0 +1,65 @@
+import time
+import threading
+from typing import Optional
+
+from bilicore.threads import ThreadProgressMixin
+
+
+class FakeJob(threading.Thread, ThreadProgressMixin):
+    """测试用的任务线程，不联网：准备 prepare 秒，再下载 download 秒，
+    post 不为 None 时下完再收尾 post 秒（设置了 postproc 就排进它的队列）
+
+    fail 给了的话准备时抛出 ValueError(fail)；job_name 用在 job_args 和 temp_files 里；
+    post_thread 记下收尾是在哪个线程做的。子类可以改 _prepare / _transfer 插入别的动作"""
+
+    def __init__(
+        self,
+        prepare: float = 0,
+        download: float = 0,
+        post: Optional[float] = None,
+        fail: Optional[str] = None,
+        job_name: str = "",
+    ) -> None:
+        super().__init__(daemon=True)
+        ThreadProgressMixin.__init__(self)
+        self._prepare_time = prepare
+        self._download = download
+        self._post = post
+        self._fail = fail
+        self.job_name = job_name
+        self.post_thread = ""
+
+    @property
+    def job_args(self):
+        return {"name": self.job_name, "savedir": "."}
+
+    @property
+    def temp_files(self):
+        return [self.job_name + ".m4v"]
+
+    def run(self):
+        self._run_wrapped(self._worker)
+
+    def _prepare(self) -> bool:
+        time.sleep(self._prepare_time)
+        if self._fail is not None:
+            raise ValueError(self._fail)
+        return True
+
+    def _transfer(self):
+        time.sleep(self._download)
+
+    def _worker(self):
+        if not self.prepare():
+            return
+        self._transfer()
+        if self._post is None:
+            self._report_progress(pgr_text="done")
+            return
+
+        def finish():
+            self.post_thread = threading.current_thread().name
+            time.sleep(self._post)
+            self._report_progress(pgr_text="done")
+
+        self._post_process(finish)
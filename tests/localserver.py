@@ -0,0 +1,157 @@
+import os
+import re
+import gzip
+import base64
+import hashlib
+import threading
+import time
+from typing import Literal, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    server: "LocalServer"
+
+    def log_message(self, *args):  # pylint: disable=W0221
+        pass
+
+    @property
+    def protocol_version(self):  # pylint: disable=W0236
+        return "HTTP/1.1" if self.server.keepalive else "HTTP/1.0"
+
+    def setup(self):
+        super().setup()
+        with self.server.counter_lock:
+            self.server.connection_count += 1
+
+    def _parse_range(self, size: int):
+        if not (rng := self.headers.get("Range")):
+            return None
+        m = re.match(r"bytes=(\d+)-(\d*)", rng)
+        if not m:
+            return None
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+        return start, min(end, size - 1)
+
+    def _send_head(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None
+        if self._gzipped():
+            # 压缩过的响应体不支持 Range
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+            body = gzip.compress(data)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return body
+        rng = self._parse_range(len(data)) if self.server.accept_ranges else None
+        if rng:
+            start, end = rng
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            body = data[start : end + 1]
+        else:
+            self.send_response(200)
+            body = data
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if (md5 := self.server.md5s.get(self.path)) is not None:
+            self.send_header("ETag", f'"{md5.hex()}"')
+            if not rng:
+                self.send_header("Content-MD5", base64.b64encode(md5).decode())
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        return body
+
+    def _gzipped(self) -> bool:
+        if self.server.gzip == "force":
+            return True
+        accept = self.headers.get("Accept-Encoding", "")
+        return self.server.gzip == "accept" and "gzip" in accept
+
+    def do_HEAD(self):  # pylint: disable=C0103
+        self._send_head()
+
+    def do_GET(self):  # pylint: disable=C0103
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.counter_lock:
+            self.server.get_count += 1
+        with self.server.counter_lock:
+            stall = self.server.stall_count > 0
+            self.server.stall_count -= stall
+            reset = self.server.reset_count > 0
+            self.server.reset_count -= reset
+        if (body := self._send_head()) is not None:
+            if reset:
+                # 发一部分之后直接断开
+                self.wfile.write(body[: self.server.reset_after])
+                with self.server.counter_lock:
+                    self.server.sent_bytes += min(len(body), self.server.reset_after)
+                self.close_connection = True
+                return
+            if stall:
+                # 发一部分之后就不动了，直到服务器关闭
+                self.wfile.write(body[: self.server.stall_after])
+                self.wfile.flush()
+                self.server.closing.wait()
+                return
+            self.wfile.write(body)
+            with self.server.counter_lock:
+                self.server.sent_bytes += len(body)
+
+
+class LocalServer(ThreadingHTTPServer):
+    """测试用的本地文件服务器，支持 Range"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        accept_ranges: bool = True,
+        delay: float = 0,
+        keepalive: bool = False,
+        send_md5: bool = False,
+        gzip_mode: Optional[Literal["accept", "force"]] = None,
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), _RangeHandler)
+        self.accept_ranges = accept_ranges
+        self.delay = delay
+        self.keepalive = keepalive
+        self.send_md5 = send_md5
+        # accept: 客户端接受 gzip 时才压缩；force: 不管请求头总是压缩
+        self.gzip = gzip_mode
+        # 响应头里给出的 md5，改了 files 之后不会跟着变，用来模拟内容损坏
+        self.md5s: dict[str, bytes] = {}
+        self.files: dict[str, bytes] = {}
+        self.get_count = 0
+        self.sent_bytes = 0
+        self.connection_count = 0
+        # 前 stall_count 个 GET 请求只发 stall_after 字节就卡住
+        self.stall_count = 0
+        self.stall_after = 0
+        self.closing = threading.Event()
+        # 前 reset_count 个 GET 请求只发 reset_after 字节就断开
+        self.reset_count = 0
+        self.reset_after = 0
+        self.counter_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def add_file(self, name: str, size: int) -> tuple[str, bytes]:
+        data = os.urandom(size)
+        self.files["/" + name] = data
+        if self.send_md5:
+            self.md5s["/" + name] = hashlib.md5(data).digest()
+        return f"http://127.0.0.1:{self.server_port}/{name}", data
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.closing.set()
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,197 @@
+import os
+import logging
+import sys
+import socket
+import threading
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import aio, downloader  # pylint: disable=C0413,E0611
+from bilicore.integrity import StreamDigest  # pylint: disable=C0413
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_aio_download(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 3 * 2**20 + 123)
+        calls = []
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(
+            url,
+            filepath,
+            hook_func=lambda x, y: calls.append((x, y)),
+            threadnum=4,
+            min_range_size=2**18,
+        )
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+    assert not os.path.exists(filepath + ".download")
+    assert calls[-1] == (len(data), len(data))
+
+
+def test_aio_bad_mirror(tmp_path):
+    with LocalServer() as server, LocalServer() as bad:
+        url, data = server.add_file("a.bin", 2**20)
+        # 大小不一样的文件，下载器应该放弃这个镜像
+        bad_url, _ = bad.add_file("a.bin", 2**20 + 1)
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(
+            url, filepath, threadnum=4, min_range_size=2**16, mirrors=[bad_url]
+        )
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_aio_journal_resume(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 4 * 2**20)
+        filepath = str(tmp_path / "a.bin")
+        tmpfilepath = filepath + ".download"
+        # 假装上次下完了前后两段
+        with open(tmpfilepath, "wb") as fp:
+            fp.write(data[: 2**20] + bytes(2 * 2**20) + data[3 * 2**20 :])
+        downloader.RangeJournal(tmpfilepath, len(data)).save(
+            [(0, 2**20 - 1), (3 * 2**20, 4 * 2**20 - 1)]
+        )
+        aio.download_common(url, filepath, threadnum=2, min_range_size=2**20)
+        assert server.sent_bytes == 2 * 2**20
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+    assert not os.path.exists(tmpfilepath + downloader.RangeJournal.SUFFIX)
+
+
+def test_aio_journal_off_loop(tmp_path, monkeypatch):
+    threads = []
+    save = downloader.RangeJournal.save
+
+    def record(self, done):
+        threads.append(threading.current_thread().name)
+        save(self, done)
+
+    monkeypatch.setattr(downloader.RangeJournal, "save", record)
+    monkeypatch.setattr(aio.AsyncEngine, "JOURNAL_INTERVAL", 0.05)
+    with LocalServer(delay=0.3) as server:
+        url, data = server.add_file("a.bin", 2**20)
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(url, filepath, threadnum=2, min_range_size=2**18)
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+    # 存进度要 fsync，不能在事件循环的线程里做
+    assert threads and "bilicore-aio" not in threads
+
+
+def test_aio_no_range(tmp_path):
+    with LocalServer(accept_ranges=False) as server:
+        url, data = server.add_file("a.bin", 2**20 + 7)
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(url, filepath)
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_aio_http_error(tmp_path):
+    with LocalServer() as server:
+        url = f"http://127.0.0.1:{server.server_port}/missing.bin"
+        with pytest.raises(requests.HTTPError):
+            aio.download_common(url, str(tmp_path / "missing.bin"))
+
+
+
+@pytest.mark.parametrize("accept_ranges", [True, False])
+def test_aio_writes_off_loop(tmp_path, monkeypatch, accept_ranges):
+    writes = []
+    write_all = downloader.write_all
+
+    def record(fp, data):
+        writes.append((threading.current_thread().name, len(data)))
+        write_all(fp, data)
+
+    monkeypatch.setattr(aio, "write_all", record)
+    with LocalServer(accept_ranges=accept_ranges) as server:
+        url, data = server.add_file("a.bin", 2**20 + 7)
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(
+            url, filepath, threadnum=2, min_range_size=2**18, buffer_size=2**16
+        )
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+    # 写文件不能在事件循环的线程里做，一次写的不超过 buffer_size
+    assert writes and all(name != "bilicore-aio" for name, _ in writes)
+    assert max(size for _, size in writes) <= 2**16
+
+
+def test_aio_single_resume(tmp_path):
+    engine = aio.get_engine()
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 2**20)
+        filepath = str(tmp_path / "a.bin")
+        # 上次下了一部分，这次中途还断了一次
+        with open(filepath + ".download", "wb") as fp:
+            fp.write(data[:1000])
+        server.reset_count, server.reset_after = 1, 2**16
+        reporter = aio._Reporter(None, 1)  # pylint: disable=W0212
+        engine.run(
+            engine._download_single(  # pylint: disable=W0212
+                url, filepath, {}, reporter, StreamDigest(), (0, 10), 2**16
+            )
+        )
+        assert server.get_count == 2
+        assert server.sent_bytes == len(data) - 1000
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_aio_range_ignored(tmp_path):
+    with LocalServer(accept_ranges=False) as server:
+        url, data = server.add_file("a.bin", 2**20)
+        filepath = str(tmp_path / "a.bin")
+        # 服务器不理会 Range 时从头下，不能接在旧的后面
+        with open(filepath + ".download", "wb") as fp:
+            fp.write(b"x" * 1000)
+        aio.download_common(url, filepath)
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+
+
+@pytest.mark.parametrize("mode", ["accept", "force"])
+def test_aio_gzip(tmp_path, mode):
+    with LocalServer(gzip_mode=mode) as server:
+        url, _ = server.add_file("a.bin", 0)
+        data = server.files["/a.bin"] = os.urandom(2**10) * 2**10
+        filepath = str(tmp_path / "a.bin")
+        aio.download_common(url, filepath, threadnum=4, min_range_size=2**16)
+    with open(filepath, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_aio_header_timeout(monkeypatch):
+    monkeypatch.setattr(aio.AsyncHTTPClient, "READ_TIMEOUT", 0.5)
+    closing = threading.Event()
+    with socket.create_server(("127.0.0.1", 0)) as sock:
+
+        def serve():
+            conn, _ = sock.accept()
+            with conn:
+                # 状态行之后就不动了
+                conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n")
+                closing.wait(5)
+
+        threading.Thread(target=serve, daemon=True).start()
+        engine = aio.get_engine()
+        url = f"http://127.0.0.1:{sock.getsockname()[1]}/a.bin"
+
+        async def get():
+            return await engine.client.request("GET", url)
+
+        try:
+            with pytest.raises(TimeoutError):
+                engine.run(get())
+        finally:
+            closing.set()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
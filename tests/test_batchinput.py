@@ -0,0 +1,80 @@
+import io
+import os
+import sys
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicli import utils  # pylint: disable=C0413
+from bilicli.app import App, SourceError  # pylint: disable=C0413
+from bilicli.core import CliCore  # pylint: disable=C0413
+from fakejob import FakeJob  # pylint: disable=C0413
+
+
+class KeyedJob(FakeJob):
+    ran: list[tuple] = []
+
+    def __init__(self, *key) -> None:
+        super().__init__()
+        self.job_key = key
+
+    def run(self):
+        KeyedJob.ran.append(self.job_key)
+        self._report_progress(pgr_text="done")
+
+
+def test_read_sources(tmp_path, monkeypatch):
+    path = tmp_path / "list.txt"
+    path.write_text("BV1xx\n\n# 注释\n  au123  \nBV1xx\n", encoding="utf-8")
+    assert utils.read_sources(f"@{path}") == ["BV1xx", "au123"]
+    monkeypatch.setattr(sys, "stdin", io.StringIO("ep1\nep2\n"))
+    assert utils.read_sources("@-") == ["ep1", "ep2"]
+
+
+def test_batch_process(monkeypatch, capsys):
+    # 不需要登录和接口，跳过 App 的初始化
+    app = App.__new__(App)
+    CliCore.__init__(app, None)  # type: ignore
+    # 每个输入展开成几个任务，BV1 和 BV2 有一个分P是重复的
+    listing = {
+        "BV1": [("video", "BV1", 1), ("video", "BV1", 2)],
+        "BV2": [("video", "BV1", 2), ("video", "BV2", 3)],
+        "ep1": [("manga", 1)],
+    }
+    seen = []
+
+    def process(source, savedir, options):
+        seen.append((source, options["yes"]))
+        if source not in listing:
+            raise SourceError("unknown source...")
+        unit = "it" if source.startswith("ep") else "B"
+        # 批量时不会真的下载
+        assert (
+            app._run_batch(  # pylint: disable=W0212
+                [KeyedJob(*key) for key in listing[source]], savedir, options, unit=unit
+            )
+            is None
+        )
+
+    monkeypatch.setattr(app, "_process_source", process)
+    asked = []
+    monkeypatch.setattr(utils, "ask_confirm", lambda yes: asked.append(yes) or True)
+    KeyedJob.ran = []
+    app._batch_process(  # pylint: disable=W0212
+        ["BV1", "bad", "BV2", "ep1"], ".", {"no_preflight": True, "yes": False}
+    )
+    out = capsys.readouterr().out
+    assert "4 job(s) from 4 source(s), 1 duplicate(s) skipped" in out
+    assert "unknown source..." in out
+    # 每个输入不单独确认，最后只确认一次
+    assert all(yes for _, yes in seen)
+    assert asked == [False]
+    assert sorted(KeyedJob.ran) == sorted(
+        [("video", "BV1", 1), ("video", "BV1", 2), ("video", "BV2", 3), ("manga", 1)]
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicli import daemon  # pylint: disable=C0413
+
+
+@pytest.fixture
+def server():
+    calls = []
+
+    def run(source, savedir, options):
+        calls.append((source, savedir, options))
+        if source == "bad":
+            raise ValueError("unknown source...")
+        return [RuntimeError("x")] if source == "flaky" else []
+
+    d = daemon.Daemon(run, port=0)
+    d.session = requests.Session()
+    d.session.headers[daemon.TOKEN_HEADER] = d.token
+    thread = threading.Thread(target=d.serve, daemon=True)
+    thread.start()
+    yield d, calls
+    d.shutdown()
+    thread.join()
+
+
+def _wait(session: requests.Session, url: str, job_id: int):
+    for _ in range(100):
+        job = session.get(f"{url}/{job_id}", timeout=5).json()
+        if job["state"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError
+
+
+def test_jobs(server):
+    d, calls = server
+    url = f"http://127.0.0.1:{d.port}/jobs"
+    session = d.session
+    ids = []
+    for source in ("BV1xx", "bad", "flaky"):
+        resp = session.post(url, json={"input": source, "output": "/tmp"}, timeout=5)
+        assert resp.status_code == 202
+        ids.append(resp.json()["id"])
+    states = [_wait(session, url, i) for i in ids]
+    assert [job["state"] for job in states] == ["done", "failed", "failed"]
+    assert states[1]["errors"] == ["unknown source..."]
+    # 一个接一个，不用确认
+    assert [c[0] for c in calls] == ["BV1xx", "bad", "flaky"]
+    assert all(c[1] == "/tmp" and c[2]["yes"] for c in calls)
+    assert len(session.get(url, timeout=5).json()) == 3
+    assert session.get(f"{url}/999", timeout=5).status_code == 404
+    assert session.post(url, json={"input": "x"}, timeout=5).status_code == 400
+    json_type = {"Content-Type": "application/json"}
+    assert session.post(url, data=b"{", headers=json_type, timeout=5).status_code == 400
+    # 进程级的选项一个任务改不了
+    resp = session.post(
+        url, json={"input": "x", "output": "/tmp", "limit_rate": 1}, timeout=5
+    )
+    assert resp.status_code == 400 and "--limit-rate" in resp.json()["error"]
+
+
+def test_rejected(server):
+    d, calls = server
+    url = f"http://127.0.0.1:{d.port}/jobs"
+    job = {"input": "BV1xx", "output": "/tmp"}
+    # 没有 token
+    assert requests.post(url, json=job, timeout=5).status_code == 403
+    assert requests.get(url, timeout=5).status_code == 403
+    headers = {daemon.TOKEN_HEADER: "wrong"}
+    assert requests.get(url, headers=headers, timeout=5).status_code == 403
+    # 网页不经预检就能发的 text/plain
+    resp = d.session.post(
+        url,
+        data=json.dumps(job),
+        headers={"Content-Type": "text/plain"},
+        timeout=5,
+    )
+    assert resp.status_code == 415
+    # DNS rebinding 过来的请求 Host 是别的域名
+    resp = d.session.post(
+        url, json=job, headers={"Host": f"evil.example:{d.port}"}, timeout=5
+    )
+    assert resp.status_code == 403
+    assert d.session.get(url, headers={"Host": f"localhost:{d.port}"}).ok
+    assert not calls and not d.jobs()
+
+def test_token_file(tmp_path):
+    path = str(tmp_path / "daemon.token")
+    d = daemon.Daemon(lambda *_: [], port=0, token_file=path)
+    with open(path, encoding="utf-8") as fp:
+        assert fp.read() == d.token
+    if os.name != "nt":
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    thread = threading.Thread(target=d.serve, daemon=True)
+    thread.start()
+    d.shutdown()
+    thread.join()
+    assert not os.path.exists(path)
+
+
+def test_client(server, capsys, tmp_path):
+    d, calls = server
+    token_file = str(tmp_path / "daemon.token")
+    with open(token_file, "w", encoding="utf-8") as fp:
+        fp.write(d.token)
+    (tmp_path / "list.txt").write_text("BV2xx\nBV3xx\n", encoding="utf-8")
+    args = argparse.Namespace(
+        client=True,
+        daemon_port=d.port,
+        input="BV1xx",
+        output=str(tmp_path),
+        dry_run=False,
+        debug=True,
+        max_worker=4,
+        index=None,
+    )
+    daemon.client_main(args, token_file)
+    assert "queued" in capsys.readouterr().out
+    _wait(d.session, f"http://127.0.0.1:{d.port}/jobs", 1)
+    ((_, savedir, options),) = calls
+    assert savedir == str(tmp_path)
+    # 客户端自己的选项不发过去
+    assert options["max_worker"] == 4
+    assert "debug" not in options and "index" not in options
+    # 列表在客户端读，每个输入一个任务
+    args.input = f"@{tmp_path / 'list.txt'}"
+    daemon.client_main(args, token_file)
+    _wait(d.session, f"http://127.0.0.1:{d.port}/jobs", 3)
+    assert [c[0] for c in calls] == ["BV1xx", "BV2xx", "BV3xx"]
+    assert capsys.readouterr().out.count("queued") == 2
+    args.input = None
+    daemon.client_main(args, token_file)
+    assert capsys.readouterr().out.count("done") == 3
+    args.limit_rate = 2**20
+    args.input = "BV1xx"
+    daemon.client_main(args, token_file)
+    assert "--limit-rate" in capsys.readouterr().out
+    daemon.client_main(args, str(tmp_path / "missing.token"))
+    assert "not running" in capsys.readouterr().out
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import mp4mux, utils  # pylint: disable=C0413,E0611
+from test_mp4mux import make_fmp4  # pylint: disable=C0413
+from fakejob import FakeJob  # pylint: disable=C0413
+
+# 假的 ffmpeg：按 -progress 的格式吐几组进度，最后写出输出文件
+FAKE_FFMPEG = """#!{python}
+import sys
+for i in range(1, 5):
+    print("total_size=%d" % (i * 100))
+    print("out_time_us=%d" % (i * 1000000))
+    print("progress=%s" % ("end" if i == 4 else "continue"), flush=True)
+open(sys.argv[-1], "wb").close()
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    if os.name == "nt":
+        pytest.skip("needs POSIX")
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    path = bindir / "ffmpeg"
+    path.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_ffmpeg_progress(tmp_path):
+    path = str(tmp_path / "a.m4a")
+    with open(path, "wb") as fp:
+        fp.write(bytes(1000))
+    calls = []
+    # 知道时长时按时间算
+    callback = utils.ffmpeg_progress(lambda *a: calls.append(a), [path, None], 8)
+    callback({"out_time_us": "2000000", "total_size": "100", "progress": "continue"})
+    callback({"out_time_us": "N/A", "total_size": "300", "progress": "continue"})
+    callback({"progress": "continue"})
+    callback({"progress": "end"})
+    assert calls == [(250, 1000), (300, 1000), (1000, 1000)]
+
+
+def test_call_ffmpeg_progress(tmp_path, fake_ffmpeg):
+    inputs = []
+    for name in ("v.m4v", "a.m4a"):
+        inputs.append(str(tmp_path / name))
+        with open(inputs[-1], "wb") as fp:
+            fp.write(bytes(500))
+    calls = []
+    output = str(tmp_path / "out.mkv")
+    utils.merge_avfile(
+        inputs[1], inputs[0], output, hook=lambda *a: calls.append(a), duration=4
+    )
+    assert os.path.isfile(output)
+    assert calls == [(250, 1000), (500, 1000), (750, 1000), (1000, 1000)]
+
+
+def test_mux_progress(tmp_path):
+    vfile, afile = str(tmp_path / "v.m4v"), str(tmp_path / "a.m4a")
+    make_fmp4(vfile, 90000, [bytes(3000)] * 4, 180000)
+    make_fmp4(afile, 48000, [bytes(500)] * 8, 48000)
+    calls = []
+    mp4mux.mux(vfile, afile, str(tmp_path / "out.mp4"), hook=lambda *a: calls.append(a))
+    # 按样本数据算，不算各种 box
+    total = 4 * 3000 + 8 * 500
+    assert len(calls) == 4 + 8 + 1
+    assert [c for c, _ in calls] == sorted(c for c, _ in calls)
+    assert calls[-1] == (total, total)
+
+
+class StagedJob(FakeJob):
+    def _worker(self):
+        with self._stage("downloading", total=10):
+            time.sleep(0.1)
+        with self._stage("merging"):
+            self._progress_hook(5, 10)
+
+
+def test_stage_times():
+    job = StagedJob()
+    job.start()
+    job.join()
+    times = job.stage_times
+    assert set(times) == {"downloading", "merging"}
+    assert times["downloading"] >= 0.1
+    # 新阶段的进度从 0 开始
+    assert job.observe()[:3] == (5, 10, "merging")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
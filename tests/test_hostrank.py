@@ -0,0 +1,57 @@
+import os
+import logging
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import hostrank  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+@pytest.fixture(name="ranking")
+def fixture_ranking(tmp_path, monkeypatch):
+    ranking = hostrank.HostRanking(str(tmp_path / "hostrank.json"))
+    monkeypatch.setattr(hostrank, "ranking", ranking)
+    return ranking
+
+
+def test_probe_and_persist(ranking, tmp_path):
+    with LocalServer(delay=0.3) as slow, LocalServer() as fast:
+        slow_url, data = slow.add_file("f.bin", 2**17)
+        fast.files["/f.bin"] = data
+        fast_url = slow_url.replace(str(slow.server_port), str(fast.server_port))
+        dead_url = "http://127.0.0.1:1/f.bin"
+        urls = [slow_url, dead_url, fast_url]
+        assert hostrank.rank_urls(urls) == [fast_url, slow_url, dead_url]
+        # 只取了开头 64KiB
+        assert fast.sent_bytes == 2**16
+    ranking.save()
+    # 两个主机都是 127.0.0.1，只剩一条记录
+    reloaded = hostrank.HostRanking(str(tmp_path / "hostrank.json"))
+    assert reloaded.get("127.0.0.1") is not None
+
+
+def test_sort_by_record(ranking):
+    ranking.update("a.example", latency=0.1, speed=100)
+    ranking.update("b.example", latency=0.1, speed=1000)
+    urls = ["https://a.example/x", "https://b.example/x"]
+    assert ranking.known(urls)
+    # 都有记录时直接排序，不测速
+    assert hostrank.rank_urls(urls) == urls[::-1]
+    assert ranking.sort(["https://c.example/x", *urls]) == [
+        "https://b.example/x",
+        "https://c.example/x",
+        "https://a.example/x",
+    ]
+
+
+def test_uninitialized(monkeypatch):
+    monkeypatch.setattr(hostrank, "ranking", None)
+    urls = ["http://127.0.0.1:1/a", "http://127.0.0.1:1/b"]
+    assert hostrank.rank_urls(urls) == urls
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
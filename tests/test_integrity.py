@@ -0,0 +1,114 @@
+import os
+import base64
+import hashlib
+import logging
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import aio, downloader, integrity  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_expected_digests():
+    data = b"hello"
+    md5 = hashlib.md5(data)
+    headers = {"Content-MD5": base64.b64encode(md5.digest()).decode()}
+    assert integrity.expected_digests(headers) == {"md5": md5.hexdigest()}
+    sha = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    headers = {"Digest": f"sha-256={sha}, unknown=abc"}
+    assert integrity.expected_digests(headers) == {
+        "sha256": hashlib.sha256(data).hexdigest()
+    }
+    # ETag 默认不认
+    headers = {"ETag": f'"{md5.hexdigest().upper()}"'}
+    assert integrity.expected_digests(headers) == {}
+    assert integrity.expected_digests(headers, trust_etag=True) == {
+        "md5": md5.hexdigest()
+    }
+    assert integrity.expected_digests({"ETag": "W/" + headers["ETag"]}, True) == {}
+    assert integrity.expected_digests({"ETag": '"abc-3"'}, True) == {}
+
+
+def test_stream_digest(tmp_path):
+    data = os.urandom(3 * 2**20 + 11)
+    path = str(tmp_path / "a.bin")
+    with open(path, "wb") as fp:
+        fp.write(data)
+    digest = integrity.StreamDigest({"md5": hashlib.md5(data).hexdigest()})
+    assert digest.update(0, data[:100])
+    # 乱序写入的部分不参与，留到最后读回来
+    assert not digest.update(2**20, data[2**20 : 2**20 + 100])
+    assert digest.update(100, data[100:200])
+    assert digest.pos == 200
+    digest.verify(path, len(data))
+    digest = integrity.StreamDigest({"md5": hashlib.md5(b"other").hexdigest()})
+    with pytest.raises(integrity.IntegrityError):
+        digest.verify(path, len(data))
+
+
+@pytest.mark.parametrize("download", [downloader.download_common, aio.download_common])
+@pytest.mark.parametrize("accept_ranges", [True, False])
+def test_verified_download(tmp_path, download, accept_ranges):
+    with LocalServer(accept_ranges=accept_ranges, send_md5=True) as server:
+        url, data = server.add_file("a.bin", 3 * 2**20 + 5)
+        path = str(tmp_path / "a.bin")
+        download(url, path, threadnum=4, min_range_size=2**18)
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+@pytest.mark.parametrize("download", [downloader.download_common, aio.download_common])
+@pytest.mark.parametrize("accept_ranges", [True, False])
+def test_corrupted_download(tmp_path, download, accept_ranges):
+    with LocalServer(accept_ranges=accept_ranges, send_md5=True) as server:
+        url, data = server.add_file("a.bin", 2**20)
+        # 内容变了，但响应头里的 md5 还是原来的
+        server.files["/a.bin"] = data[:1000] + bytes(1) + data[1001:]
+        path = str(tmp_path / "a.bin")
+        with pytest.raises(integrity.IntegrityError):
+            download(url, path, threadnum=4, min_range_size=2**18)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + ".download")
+
+
+def test_verify_holes(tmp_path):
+    path = str(tmp_path / "a.bin.download")
+    with open(path, "wb") as fp:
+        fp.truncate(100)
+    # 预分配过大小，大小对得上，但中间有一段没写过
+    with pytest.raises(integrity.IntegrityError, match="10 bytes never written"):
+        downloader.verify_file(path, 100, done=[(0, 49), (60, 99)])
+    downloader.verify_file(path, 100, done=[(0, 59), (50, 99)])
+
+
+def test_journal_validator(tmp_path):
+    path = str(tmp_path / "b.bin.download")
+    with open(path, "wb") as fp:
+        fp.truncate(100)
+    downloader.RangeJournal(path, 100, validator='"v1"').save([(0, 9)])
+    assert downloader.RangeJournal(path, 100, validator='"v1"').load() == [(0, 9)]
+    # 远端文件变了，不能接着用
+    assert downloader.RangeJournal(path, 100, validator='"v2"').load() is None
+
+
+def test_resume_verified(tmp_path):
+    with LocalServer(send_md5=True) as server:
+        url, data = server.add_file("c.bin", 4 * 2**20)
+        path = str(tmp_path / "c.bin")
+        tmppath = path + ".download"
+        with open(tmppath, "wb") as fp:
+            fp.write(data[: 2**20] + bytes(3 * 2**20))
+        downloader.RangeJournal(
+            tmppath, len(data), validator=f'"{hashlib.md5(data).hexdigest()}"'
+        ).save([(0, 2**20 - 1)])
+        downloader.download_common(url, path, threadnum=2, min_range_size=2**20)
+        assert server.sent_bytes == 3 * 2**20
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
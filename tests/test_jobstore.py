@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+import logging
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import jobstore, threads  # pylint: disable=C0413,E0611
+from bilicli import core  # pylint: disable=C0413
+from bilicli.core import CliCore  # pylint: disable=C0413
+from bilicli.utils import run_threads  # pylint: disable=C0413
+from fakejob import FakeJob  # pylint: disable=C0413
+
+
+def make_job(name: str, fail=None) -> FakeJob:
+    return FakeJob(download=0.05, post=0.05, fail=fail, job_name=name)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = jobstore.JobStore(str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(jobstore, "store", store)
+    return store
+
+
+def expire(store: jobstore.JobStore):
+    with store._connect() as conn:  # pylint: disable=W0212
+        conn.execute("UPDATE jobs SET lease = ?", (time.time() - 1,))
+
+
+def test_store(store):
+    ids = store.add_batch("BV1xx", [("A", {"cid": 1}), ("B", {"cid": 2})])
+    store.update(ids[0], "transferring", args={"cid": 1, "x": "中"}, files=["a"])
+    store.update(ids[1], "done")
+    with pytest.raises(ValueError):
+        store.update(ids[1], "lost")
+    jobs = store.unfinished()
+    assert [job["id"] for job in jobs] == [ids[0]]
+    assert jobs[0]["args"] == {"cid": 1, "x": "中"}
+    assert jobs[0]["files"] == ["a"]
+    assert jobs[0]["stage"] == "transferring"
+    assert store.clear_done() == 1
+    # 重新打开还在，不过要等上一个进程的租约过期
+    path = store._path  # pylint: disable=W0212
+    assert not jobstore.JobStore(path).unfinished()
+    expire(store)
+    assert len(jobstore.JobStore(path).unfinished()) == 1
+
+
+def test_video_job_args(tmp_path):
+    apis = SimpleNamespace(session=requests.Session(), DEFAULT_HEADERS={})
+    video_data = {"bvid": "BV1xx411c7mD", "pages": [{"cid": 1}]}
+    job = threads.SingleVideoThread(
+        apis,
+        1,
+        bvid=video_data["bvid"],
+        savedir=str(tmp_path),
+        video_quality="1080P",
+        video_data=video_data,
+        stream_data={"dash": {}},
+        yes=True,
+    )
+    args = job.job_args
+    # 流地址会过期，不记；不是任务的选项也不记
+    assert "stream_data" not in args and "yes" not in args
+    assert args["video_data"] == video_data
+    assert threads.SingleVideoThread(apis, **args).job_args == args
+
+
+def test_on_stage():
+    jobs = [make_job("a"), make_job("b", fail="boom")]
+    stages: dict[int, list[str]] = {0: [], 1: []}
+    run_threads(jobs, max_worker=1, on_stage=lambda i, s: stages[i].append(s))
+    assert stages[0][-1] == "done" and stages[1][-1] == "failed"
+    assert "transferring" in stages[0]
+
+
+def test_run_batch(store):
+    core = CliCore(None)  # type: ignore
+    jobs = [make_job("a"), make_job("b", fail="boom")]
+    options = {"no_preflight": True, "input": "BV1xx"}
+    core._run_batch(jobs, ".", options, max_worker=2)  # pylint: disable=W0212
+    # 做完的删掉，失败的留着下次接着下
+    (job,) = store.unfinished()
+    assert (job["kind"], job["args"]["name"]) == ("FakeJob", "b")
+    assert (job["stage"], job["error"], job["files"]) == ("failed", "boom", ["b.m4v"])
+
+
+
+def test_lease(store):
+    other = jobstore.JobStore(store._path)  # pylint: disable=W0212
+    ids = store.add_batch("BV1xx", [("A", {"cid": 1}), ("B", {"cid": 2})])
+    store.update(ids[1], "failed", error="boom")
+    # 另一个进程看不到还在做的任务，失败了的可以接手
+    assert [job["id"] for job in other.unfinished()] == [ids[1]]
+    assert other.claim(ids) == [ids[1]]
+    assert store.claim(ids) == [ids[0]]
+    assert [job["id"] for job in other.unfinished()] == [ids[1]]
+    # 进程没了，租约过期以后才能接手
+    expire(store)
+    assert other.claim(ids) == ids
+    store.renew()
+    assert [job["id"] for job in store.unfinished()] == []
+
+
+def test_give_up(store):
+    (job_id,) = store.add_batch("BV1xx", [("A", {"cid": 1})])
+    for i in range(store.MAX_ATTEMPTS):
+        store.update(job_id, "failed", error="deleted")
+        if i < store.MAX_ATTEMPTS - 1:
+            assert store.clear_done() == 0
+            assert store.claim([job_id]) == [job_id]
+    assert store.clear_done() == 1
+    assert not store.unfinished()
+
+
+class ResumedJob(FakeJob):
+    def __init__(self, _apis, name: str, savedir: str) -> None:
+        super().__init__(download=0.05, post=0.05, job_name=name)
+        self._savedir = savedir
+
+    @property
+    def job_args(self):
+        return {"name": self.job_name, "savedir": self._savedir}
+
+
+def test_resume_savedirs(store, monkeypatch, tmp_path):
+    monkeypatch.setitem(core.JOB_KINDS, "ResumedJob", ResumedJob)
+    dirs = [str(tmp_path / "a"), str(tmp_path / "b")]
+    store.add_batch(
+        "BV1xx",
+        [("ResumedJob", {"name": str(i), "savedir": dirs[i % 2]}) for i in range(4)],
+    )
+    # 上次的进程已经没了
+    expire(store)
+    cli = core.CliCore(None)  # type: ignore
+    calls = []
+    run_batch = cli._run_batch  # pylint: disable=W0212
+
+    def spy(threads, savedir, options, **kwargs):
+        calls.append((savedir, [t.job_args["savedir"] for t in threads]))
+        return run_batch(threads, savedir, options, **kwargs)
+
+    monkeypatch.setattr(cli, "_run_batch", spy)
+    cli._resume_process(yes=True, no_preflight=True)  # pylint: disable=W0212
+    assert calls == [(dirs[0], [dirs[0]] * 2), (dirs[1], [dirs[1]] * 2)]
+    assert not store.unfinished()
+
+
+def test_interrupted(store, monkeypatch, tmp_path):
+    def interrupted(threads, on_stage, **_):
+        on_stage(0, "transferring")
+        raise KeyboardInterrupt
+
+    run = core.utils.run_threads
+    monkeypatch.setattr(core.utils, "run_threads", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        CliCore(None)._run_batch(  # type: ignore # pylint: disable=W0212
+            [ResumedJob(None, "a", str(tmp_path))], ".", {"no_preflight": True}
+        )
+    # 另一个进程不用等租约过期，马上就能接着下
+    monkeypatch.setattr(core.utils, "run_threads", run)
+    monkeypatch.setitem(core.JOB_KINDS, "ResumedJob", ResumedJob)
+    other = jobstore.JobStore(store._path)  # pylint: disable=W0212
+    monkeypatch.setattr(jobstore, "store", other)
+    assert [job["stage"] for job in other.unfinished()] == ["transferring"]
+    CliCore(None)._resume_process(  # type: ignore # pylint: disable=W0212
+        yes=True, no_preflight=True
+    )
+    assert not other.unfinished()
+
+
+def test_release(store):
+    other = jobstore.JobStore(store._path)  # pylint: disable=W0212
+    ids = store.add_batch("BV1xx", [("A", {"cid": 1}), ("B", {"cid": 2})])
+    store.release(ids[:1])
+    assert other.claim(ids) == ids[:1]
+    assert not other.claim(ids[1:])
+    # 进程退出时放掉剩下的
+    store.release()
+    assert other.claim(ids[1:]) == ids[1:]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import shutil
+import struct
+import logging
+import subprocess
+from typing import Optional
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import mp4mux, utils  # pylint: disable=C0413,E0611
+
+
+def box(kind: str, *payloads: bytes) -> bytes:
+    payload = b"".join(payloads)
+    return struct.pack(">I4s", len(payload) + 8, kind.encode("latin-1")) + payload
+
+
+def full(kind: str, payload: bytes, version: int = 0, flags: int = 0) -> bytes:
+    return box(kind, struct.pack(">I", version << 24 | flags), payload)
+
+
+def make_fmp4(
+    path,
+    timescale: int,
+    fragments: list,
+    sample_duration: int,
+    first_tfdt: int = 0,
+    tfhd_duration: bool = False,
+    cto: int = 0,
+    elst: Optional[list] = None,
+):
+    """造一个最简单的 DASH fMP4，fragments 里每个元素是一个分片的样本（bytes 或者它的列表），
+    每个分片第一个样本是关键帧；tfhd_duration 时样本时长写在 tfhd 里，否则写在 trun 里；
+    cto 不为 0 时每个样本都带上这个显示时间偏移；elst 是编辑列表 [(时长, media_time), ...]"""
+    fragments = [[f] if isinstance(f, bytes) else f for f in fragments]
+    edts = (
+        box(
+            "edts",
+            full(
+                "elst",
+                struct.pack(">I", len(elst))
+                + b"".join(struct.pack(">IiI", d, t, 0x10000) for d, t in elst),
+            ),
+        )
+        if elst is not None
+        else b""
+    )
+    trak = box(
+        "trak",
+        full("tkhd", struct.pack(">IIIII", 0, 0, 7, 0, 0) + bytes(60)),
+        edts,
+        box(
+            "mdia",
+            full("mdhd", struct.pack(">IIII", 0, 0, timescale, 0) + bytes(4)),
+            full("hdlr", bytes(4) + b"vide" + bytes(13)),
+            box(
+                "minf",
+                box(
+                    "stbl",
+                    full("stsd", struct.pack(">I", 1) + box("mp4v", bytes(8))),
+                    full("stts", bytes(4)),
+                    full("stsc", bytes(4)),
+                    full("stsz", bytes(8)),
+                    full("stco", struct.pack(">I", 0)),
+                ),
+            ),
+        ),
+    )
+    moov = box(
+        "moov",
+        full("mvhd", struct.pack(">IIII", 0, 0, 1000, 0) + bytes(76) + bytes(4)),
+        trak,
+        # 默认的样本标志是非关键帧
+        box("mvex", full("trex", struct.pack(">IIIII", 7, 1, 0, 0, 0x1010000))),
+    )
+    frag_duration = sample_duration * len(fragments[0])
+    refs = b"".join(
+        struct.pack(">III", len(b"".join(f)), frag_duration, 0x90000000)
+        for f in fragments
+    )
+    sidx = full(
+        "sidx", struct.pack(">IIIIHH", 7, timescale, 0, 0, 0, len(fragments)) + refs
+    )
+    body = b""
+    tfdt = first_tfdt
+    for i, samples in enumerate(fragments):
+
+        def moof(offset: int) -> bytes:
+            trun_flags = 0x205
+            if tfhd_duration:
+                tfhd = full(
+                    "tfhd", struct.pack(">II", 7, sample_duration), flags=0x020008
+                )
+            else:
+                tfhd = full("tfhd", struct.pack(">I", 7), flags=0x020000)
+                trun_flags |= 0x100
+            if cto:
+                trun_flags |= 0x800
+            table = b""
+            for sample in samples:
+                if not tfhd_duration:
+                    table += struct.pack(">I", sample_duration)
+                table += struct.pack(">I", len(sample))
+                if cto:
+                    table += struct.pack(">i", cto)
+            # 第一个样本单独给出标志，是关键帧
+            head = struct.pack(">IiI", len(samples), offset, 0x2000000)
+            return box(
+                "moof",
+                full("mfhd", struct.pack(">I", i + 1)),
+                box(
+                    "traf",
+                    tfhd,
+                    full("tfdt", struct.pack(">Q", tfdt), version=1),
+                    full("trun", head + table, int(cto < 0), trun_flags),
+                ),
+            )
+
+        body += moof(len(moof(0)) + 8) + box("mdat", b"".join(samples))
+        tfdt += sample_duration * len(samples)
+    with open(path, "wb") as fp:
+        fp.write(box("ftyp", b"iso5", bytes(4), b"iso6mp41") + moov + sidx + body)
+
+
+def top_level(data: bytes):
+    return mp4mux._parse(data)  # pylint: disable=W0212
+
+
+def table(stbl, kind: str, fmt: str, skip: int = 8) -> list:
+    data = stbl.get(kind).data
+    return list(struct.iter_unpack(fmt, data[skip:]))
+
+
+def samples_of(data: bytes, stbl) -> list[bytes]:
+    """按 stsc / stco / stsz 把一个轨道的样本取出来"""
+    offsets = [o for (o,) in table(stbl, "stco", ">I")]
+    stsz = stbl.get("stsz").data
+    size, count = struct.unpack_from(">II", stsz, 4)
+    sizes = [size] * count if size else [s for (s,) in table(stbl, "stsz", ">I", 12)]
+    runs = table(stbl, "stsc", ">III")
+    samples, n = [], 0
+    for chunk, offset in enumerate(offsets, start=1):
+        per_chunk = [r[1] for r in runs if r[0] <= chunk][-1]
+        for _ in range(per_chunk):
+            samples.append(data[offset : offset + sizes[n]])
+            offset += sizes[n]
+            n += 1
+    return samples
+
+
+@pytest.fixture
+def streams(tmp_path):
+    vfile, afile = str(tmp_path / "v.m4v"), str(tmp_path / "a.m4a")
+    # 视频每段 2 秒两个样本，音频每段 1 秒一个样本
+    vfrags = [[os.urandom(3000 + i), os.urandom(100 + i)] for i in range(4)]
+    afrags = [os.urandom(500 + i) for i in range(8)]
+    make_fmp4(vfile, 90000, vfrags, 90000)
+    make_fmp4(afile, 48000, afrags, 48000, tfhd_duration=True)
+    return vfile, afile, vfrags, afrags
+
+
+def test_mux(tmp_path, streams):
+    vfile, afile, vfrags, afrags = streams
+    output = str(tmp_path / "out.mp4")
+    mp4mux.mux(vfile, afile, output, {"title": "标题", "subtitle": "P1"})
+    with open(output, "rb") as fp:
+        data = fp.read()
+    boxes = top_level(data)
+    # 普通的 mp4：moov 在前，不再有分片
+    assert [b.type for b in boxes] == ["ftyp", "moov", "mdat"]
+    moov = boxes[1]
+    assert moov.find("mvex") is None
+    assert [t.get("tkhd").data[12:16] for t in moov.findall("trak")] == [
+        b"\0\0\0\x01",
+        b"\0\0\0\x02",
+    ]
+    # 总时长 8 秒，mvhd 的时间刻度是 1000
+    assert struct.unpack_from(">I", moov.get("mvhd").data, 16)[0] == 8000
+    assert "标题".encode() in moov.get("udta").data
+    vstbl, astbl = (t.get("mdia/minf/stbl") for t in moov.findall("trak"))
+    assert samples_of(data, vstbl) == [s for f in vfrags for s in f]
+    assert samples_of(data, astbl) == afrags
+    assert table(vstbl, "stts", ">II") == [(8, 90000)]
+    assert table(astbl, "stts", ">II") == [(8, 48000)]
+    # 视频只有每段的第一个样本是关键帧，音频全是，不写 stss
+    assert table(vstbl, "stss", ">I") == [(1,), (3,), (5,), (7,)]
+    assert astbl.find("stss") is None
+    # 按时间交错：视频一段 2 秒，中间夹着两段音频
+    chunks = sorted(
+        [(o, "v") for (o,) in table(vstbl, "stco", ">I")]
+        + [(o, "a") for (o,) in table(astbl, "stco", ">I")]
+    )
+    assert "".join(k for _, k in chunks) == "vaa" * 4
+
+
+@pytest.mark.parametrize("cto", [3000, -3000])
+def test_composition_offsets(tmp_path, cto):
+    path, output = str(tmp_path / "v.m4v"), str(tmp_path / "out.mp4")
+    make_fmp4(path, 90000, [[b"x" * 10, b"y" * 20]] * 3, 3000, cto=cto)
+    mp4mux.mux(path, None, output)
+    with open(output, "rb") as fp:
+        moov = top_level(fp.read())[1]
+    ctts = moov.get("trak/mdia/minf/stbl/ctts")
+    # 有负数时要用有符号的版本 1
+    assert ctts.data[0] == (1 if cto < 0 else 0)
+    assert table(moov.get("trak/mdia/minf/stbl"), "ctts", ">Ii") == [(6, cto)]
+
+
+@pytest.mark.parametrize(
+    "elst, expected",
+    [
+        # 空的 moov 里时长是 0
+        ([(0, 0)], [(8000, 0)]),
+        # 开头的空编辑留着，B 帧的偏移留着，时长算到轨道结束
+        ([(500, -1), (0, 3000)], [(500, -1), ((720000 - 3000) // 90, 3000)]),
+        ([(0, 3000), (100, 9000)], [((720000 - 3000) // 90, 3000)]),
+    ],
+)
+def test_edit_list(tmp_path, elst, expected):
+    path, output = str(tmp_path / "v.m4v"), str(tmp_path / "out.mp4")
+    make_fmp4(path, 90000, [b"x" * 10] * 8, 90000, elst=elst)
+    mp4mux.mux(path, None, output)
+    with open(output, "rb") as fp:
+        moov = top_level(fp.read())[1]
+    entries = table(moov.get("trak/edts"), "elst", ">IiI")
+    assert [(d, t) for d, t, _ in entries] == expected
+
+
+def test_not_fragmented(tmp_path):
+    path = str(tmp_path / "v.m4v")
+    with open(path, "wb") as fp:
+        fp.write(box("ftyp", b"isom", bytes(4)) + box("mdat", b"xx"))
+    with pytest.raises(mp4mux.MuxError):
+        mp4mux.mux(path, None, str(tmp_path / "out.mp4"))
+    assert not os.path.exists(str(tmp_path / "out.mp4"))
+
+
+def test_discontinuous(tmp_path):
+    path = str(tmp_path / "v.m4v")
+    # 不是从 0 开始的，拼平了时间会错
+    make_fmp4(path, 90000, [b"x" * 10] * 2, 90000, first_tfdt=90000)
+    with pytest.raises(mp4mux.MuxError):
+        mp4mux.mux(path, None, str(tmp_path / "out.mp4"))
+
+
+def test_merge_avfile(tmp_path, streams, monkeypatch):
+    vfile, afile, _, _ = streams
+    calls = []
+    monkeypatch.setattr(utils, "call_ffmpeg", lambda *args, **_: calls.append(args))
+    assert utils.merge_avfile(afile, vfile, str(tmp_path / "out.mp4")) == 0
+    assert not calls
+    # 带封面、输出 mkv 的还是交给 ffmpeg
+    utils.merge_avfile(afile, vfile, str(tmp_path / "c.mp4"), cover_image="c.jpg")
+    utils.merge_avfile(afile, vfile, str(tmp_path / "out.mkv"))
+    # 内置的合不了时退回 ffmpeg
+    with open(afile, "wb") as fp:
+        fp.write(b"not mp4")
+    utils.merge_avfile(afile, vfile, str(tmp_path / "bad.mp4"))
+    assert len(calls) == 3
+
+
+def ffprobe(path: str) -> dict:
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_format", "-show_streams"]
+        + ["-of", "json", path],
+        capture_output=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+@pytest.mark.skipif(
+    not shutil.which("ffmpeg") or not shutil.which("ffprobe"),
+    reason="needs ffmpeg and ffprobe",
+)
+def test_ffmpeg_dash(tmp_path):
+    """用 ffmpeg 做和 B 站一样的 DASH 分片流，合出来的要 ffprobe 认得、时长对、能完整解码"""
+    vfile, afile = str(tmp_path / "v.m4s"), str(tmp_path / "a.m4s")
+    dash = ["-f", "mp4", "-movflags", "+frag_keyframe+empty_moov+default_base_moof"]
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc=d=6:s=320x240:r=25"]
+        + ["-c:v", "mpeg4", "-bf", "2", "-g", "25", *dash, vfile],
+        check=True,
+    )
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "sine=d=6"]
+        + ["-c:a", "aac", *dash, afile],
+        check=True,
+    )
+    output = str(tmp_path / "out.mp4")
+    mp4mux.mux(vfile, afile, output)
+    info = ffprobe(output)
+    assert sorted(s["codec_type"] for s in info["streams"]) == ["audio", "video"]
+    assert abs(float(info["format"]["duration"]) - 6) < 0.2
+    assert {s["codec_type"]: int(s["nb_frames"]) for s in info["streams"]}[
+        "video"
+    ] == 150
+    # 完整解码一遍不出错
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-xerror", "-i", output, "-f", "null", "-"],
+        check=True,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import logging
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicli import utils  # pylint: disable=C0413
+
+
+class FakeVideoApis:
+    """每次查分P要 0.2 秒，每个视频两个分P"""
+
+    def __init__(self) -> None:
+        self.calls: list[str] = []
+        self.running = self.peak = 0
+        self._lock = threading.Lock()
+
+    def get_pagelist(self, *, bvid):
+        with self._lock:
+            self.calls.append(bvid)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.2)
+        with self._lock:
+            self.running -= 1
+        return [{"cid": f"{bvid}-1"}, {"cid": f"{bvid}-2"}]
+
+
+def test_concurrent_pagelist():
+    video = FakeVideoApis()
+    apis = SimpleNamespace(video=video)
+    videos = [{"bvid": f"BV{i}"} for i in range(20)]
+    start = time.monotonic()
+    result = utils.process_videolist_to_pagelist(
+        apis, videos, set(), show_progress=False  # type: ignore
+    )
+    # 一个接一个的话要 4 秒
+    assert time.monotonic() - start < 2
+    assert 1 < video.peak <= 8
+    assert result == [(f"BV{i}", f"BV{i}-{p}") for i in range(20) for p in (1, 2)]
+
+
+def test_pages_in_listing():
+    video = FakeVideoApis()
+    apis = SimpleNamespace(video=video)
+    videos = [
+        {"bvid": "BV1", "pages": [{"cid": 11}, {"cid": 12}]},
+        {"bvid": "BV2", "cid": 21, "videos": 1},
+        # 多P视频只有第一P的 cid，还是要查
+        {"bvid": "BV3", "cid": 31, "videos": 3},
+        {"bvid": "BV4"},
+    ]
+    result = utils.process_videolist_to_pagelist(
+        apis, videos, {1, 2, 3}, show_progress=False  # type: ignore
+    )
+    assert result == [
+        ("BV1", 11),
+        ("BV1", 12),
+        ("BV2", 21),
+        ("BV3", "BV3-1"),
+        ("BV3", "BV3-2"),
+    ]
+    assert video.calls == ["BV3"]
+
+
+def test_stream_in_order():
+    video = FakeVideoApis()
+    apis = SimpleNamespace(video=video)
+    pages = utils.iter_videolist_pages(
+        apis, [{"bvid": f"BV{i}"} for i in range(40)], set(), False  # type: ignore
+    )
+    start = time.monotonic()
+    assert next(pages) == ("BV0", "BV0-1")
+    # 第一个查完就给出来，不等整个列表
+    assert time.monotonic() - start < 0.5
+    pages.close()
+    # 不要了以后排着的不再去查
+    assert len(video.calls) < 40
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
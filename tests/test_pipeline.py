@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import logging
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicli.utils import run_threads, schedule  # pylint: disable=C0413
+from fakejob import FakeJob  # pylint: disable=C0413
+
+
+class CountingJob(FakeJob):
+    """记下准备好了几个任务、开始下载的先后"""
+
+    prepared = 0
+    started: list["CountingJob"] = []
+    lock = threading.Lock()
+
+    def __init__(self, prepare: float, download: float, fail=False) -> None:
+        super().__init__(prepare, download, fail="no such video" if fail else None)
+        self.ahead = 0
+
+    def _prepare(self) -> bool:
+        super()._prepare()
+        with CountingJob.lock:
+            CountingJob.prepared += 1
+        return True
+
+    def _transfer(self):
+        # 开始下载时已经准备好的任务数
+        with CountingJob.lock:
+            self.ahead = CountingJob.prepared
+            CountingJob.started.append(self)
+        super()._transfer()
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    CountingJob.prepared = 0
+    CountingJob.started = []
+
+
+def test_overlap():
+    jobs = [CountingJob(0.3, 0.3) for _ in range(4)]
+    start = time.monotonic()
+    assert not run_threads(jobs, max_worker=1, max_prepare=1)
+    # 准备和下载同时进行：0.3 + 0.3 * 4，一个接一个的话是 2.4
+    assert time.monotonic() - start < 2.0
+    assert all(job.observe()[2] == "done" for job in jobs)
+
+
+def test_bounded_queue():
+    jobs = [CountingJob(0, 0.2) for _ in range(8)]
+    assert not run_threads(jobs, max_worker=1, max_prepare=2, queue_size=1)
+    # 准备阶段最多领先：正在下载的 1 个、队列里的 1 个、两个准备线程手里各 1 个
+    assert max(job.ahead - i for i, job in enumerate(jobs)) <= 4
+
+
+def test_prepare_failed():
+    jobs = [CountingJob(0, 0.1), CountingJob(0, 0.1, fail=True), CountingJob(0, 0.1)]
+    excs = run_threads(jobs, max_worker=2)
+    assert [str(e) for e in excs] == ["no such video"]
+    # 准备失败的不会开始下载
+    assert jobs[1].ident is None
+    assert jobs[1].observe()[2] == "errored"
+    assert jobs[0].observe()[2] == jobs[2].observe()[2] == "done"
+
+
+def test_schedule():
+    jobs = [CountingJob(0, 0) for _ in range(4)]
+    for job, size in zip(jobs, (300, None, 100, 200)):
+        job.estimated_size = size
+    assert schedule(jobs) == [0, 1, 2, 3]
+    assert schedule(jobs, "shortest") == [2, 3, 0, 1]
+    assert schedule(jobs, "longest") == [0, 3, 2, 1]
+    assert schedule(jobs, "longest", priorities=[1, 3, 2, 2]) == [1, 2, 3, 0]
+
+
+def test_run_in_order():
+    jobs = [CountingJob(0, 0.05) for _ in range(5)]
+    for job, size in zip(jobs, (3, 5, 1, 4, 2)):
+        job.estimated_size = size
+    assert not run_threads(jobs, max_worker=1, max_prepare=1, order="longest")
+    assert [job.estimated_size for job in CountingJob.started] == [5, 4, 3, 2, 1]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
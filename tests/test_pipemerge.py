@@ -0,0 +1,153 @@
+import os
+import sys
+import shutil
+import logging
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import aio, downloader, pipemerge  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+pytestmark = pytest.mark.skipif(not pipemerge.supported(), reason="needs POSIX")
+
+# 假的 ffmpeg：把 -i 给的各个管道依次读完，拼起来写进输出文件
+FAKE_FFMPEG = """#!{python}
+import os, sys
+args = sys.argv[1:]
+inputs = [args[i + 1] for i, a in enumerate(args) if a == "-i"]
+with open(args[-1], "wb") as out:
+    for name in inputs:
+        with os.fdopen(int(name.split(":")[1]), "rb") as fp:
+            out.write(fp.read())
+sys.exit({code})
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    def install(code=0):
+        bindir = tmp_path / "bin"
+        bindir.mkdir(exist_ok=True)
+        path = bindir / "ffmpeg"
+        path.write_text(FAKE_FFMPEG.format(python=sys.executable, code=code))
+        path.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+
+    return install
+
+
+def test_contiguous_size():
+    assert downloader.contiguous_size([]) == 0
+    assert downloader.contiguous_size([(5, 9)]) == 0
+    assert downloader.contiguous_size([(4, 9), (0, 3), (12, 20)]) == 10
+
+
+@pytest.mark.parametrize("download", [downloader.download_common, aio.download_common])
+def test_prefix_hook(tmp_path, download):
+    prefixes = []
+    with LocalServer() as server:
+        url, _ = server.add_file("a.bin", 2**20)
+        download(
+            url,
+            str(tmp_path / "a.bin"),
+            threadnum=4,
+            min_range_size=2**16,
+            prefix_hook=prefixes.append,
+        )
+    assert prefixes == sorted(prefixes)
+    assert prefixes[-1] == 2**20
+
+
+def test_feeder(tmp_path):
+    data = os.urandom(2**20)
+    path = str(tmp_path / "a.bin")
+    read, write = os.pipe()
+    feeder = pipemerge.PipeFeeder(path, write)
+    feeder.start()
+    received = bytearray()
+    reader = threading.Thread(
+        target=lambda: received.extend(os.fdopen(read, "rb").read())
+    )
+    reader.start()
+    # 预分配好的临时文件，只有前缀部分是写好的
+    with open(path + ".download", "wb") as fp:
+        fp.truncate(len(data))
+        fp.write(data[: 2**19])
+    feeder.advance(2**19)
+    with open(path + ".download", "r+b") as fp:
+        fp.seek(2**19)
+        fp.write(data[2**19 :])
+    os.rename(path + ".download", path)
+    feeder.finish()
+    feeder.join()
+    reader.join()
+    assert feeder.complete
+    assert bytes(received) == data
+
+
+@pytest.mark.parametrize("code", [0, 1])
+def test_stream_merge(tmp_path, fake_ffmpeg, code):
+    fake_ffmpeg(code)
+    output = str(tmp_path / "out.mp4")
+    with LocalServer() as server:
+        vurl, vdata = server.add_file("v.m4v", 2**20)
+        aurl, adata = server.add_file("a.m4a", 2**18)
+        vpath, apath = str(tmp_path / "v.m4v"), str(tmp_path / "a.m4a")
+        merger = pipemerge.StreamMerger(apath, vpath, output)
+        merger.start()
+        for url, path in ((vurl, vpath), (aurl, apath)):
+            downloader.download_common(
+                url, path, min_range_size=2**16, prefix_hook=merger.hook_for(path)
+            )
+        assert merger.finish() == (code == 0)
+    assert not os.path.exists(str(tmp_path / "out.part.mp4"))
+    if code == 0:
+        with open(output, "rb") as fp:
+            assert fp.read() == vdata + adata
+    else:
+        # 失败时临时文件还在，可以再合一次
+        assert not os.path.exists(output)
+        assert os.path.isfile(vpath) and os.path.isfile(apath)
+
+
+def test_stream_merge_cancel(tmp_path, fake_ffmpeg):
+    fake_ffmpeg()
+    vpath = str(tmp_path / "v.m4v")
+    merger = pipemerge.StreamMerger(None, vpath, str(tmp_path / "out.mp4"))
+    merger.start()
+    merger.hook_for(vpath)(0)
+    merger.cancel()
+    assert not os.path.exists(str(tmp_path / "out.mp4"))
+    assert not os.path.exists(str(tmp_path / "out.part.mp4"))
+
+
+
+@pytest.mark.skipif(not shutil.which("nice"), reason="needs nice command")
+def test_stream_merge_nice(tmp_path, fake_ffmpeg, monkeypatch):
+    fake_ffmpeg()
+    commands = []
+    popen = pipemerge.subprocess.Popen
+
+    def spy(cmd, **kwargs):
+        commands.append(cmd)
+        return popen(cmd, **kwargs)
+
+    monkeypatch.setattr(pipemerge.subprocess, "Popen", spy)
+    vpath, output = str(tmp_path / "v.m4v"), str(tmp_path / "out.mp4")
+    with open(vpath, "wb") as fp:
+        fp.write(b"v" * 100)
+    # 和后处理队列里的 ffmpeg 一样降低优先级
+    merger = pipemerge.StreamMerger(None, vpath, output, nice=5)
+    merger.start()
+    merger.hook_for(vpath)(100)
+    assert merger.finish()
+    assert commands[0][:4] == ["nice", "-n", "5", "ffmpeg"]
+    with open(output, "rb") as fp:
+        assert fp.read() == b"v" * 100
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,54 @@
+import os
+import logging
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from biliapis import factory  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_route():
+    session = factory.default_session()
+    adp = session.get_adapter("https://api.bilibili.com/x/web-interface/nav")
+    assert isinstance(adp, factory.RoutingAdapter)
+    assert adp.route("https://api.bilibili.com/x") is adp.api_adapter
+    assert adp.route("https://b23.tv/abc") is adp.api_adapter
+    assert adp.route("https://upos-sz-mirrorcos.bilivideo.com/a.m4s") is adp.cdn_adapter
+    assert adp.route("https://i0.hdslb.com/a.jpg") is adp.cdn_adapter
+    assert adp.route("https://notbilibili.com/") is adp.cdn_adapter
+
+
+def test_configure_pools():
+    session = requests.Session()
+    factory.configure_pools(session, api_connections=12, cdn_connections=64)
+    adp = session.get_adapter("https://example.com/")
+    assert adp.api_adapter.poolmanager.connection_pool_kw["maxsize"] == 12
+    assert adp.cdn_adapter.poolmanager.connection_pool_kw["maxsize"] == 64
+    assert not adp.cdn_adapter.poolmanager.connection_pool_kw["block"]
+    # 登录信息是 pickle 存下来的，连接池配置要能跟着保存和恢复
+    adp = pickle.loads(pickle.dumps(session)).get_adapter("https://example.com/")
+    assert adp.cdn_adapter.poolmanager.connection_pool_kw["maxsize"] == 64
+
+
+def test_per_host_cap():
+    session = factory.default_session()
+    factory.configure_pools(session, cdn_connections=16, per_host=2)
+    with LocalServer(delay=0.2) as server:
+        url, data = server.add_file("a.bin", 1024)
+        started = time.monotonic()
+        with ThreadPoolExecutor(6) as executor:
+            results = list(executor.map(lambda _: session.get(url).content, range(6)))
+        # 同时最多 2 条连接，6 个请求至少要排 3 轮
+        assert time.monotonic() - started >= 0.6
+    assert all(r == data for r in results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import shutil
+import logging
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import utils  # pylint: disable=C0413,E0611
+from bilicore.postproc import PostProcessor, processor  # pylint: disable=C0413
+from bilicli.utils import run_threads  # pylint: disable=C0413
+from fakejob import FakeJob  # pylint: disable=C0413
+
+
+@pytest.mark.skipif(
+    os.name == "nt" or not shutil.which("nice"), reason="needs nice command"
+)
+def test_ffmpeg_nice(monkeypatch):
+    commands = []
+
+    def run(cmd, **_):
+        commands.append(cmd)
+        return utils.subprocess.CompletedProcess(cmd, 0)
+
+    monkeypatch.setattr(utils.subprocess, "run", run)
+    utils.call_ffmpeg("-h")
+    PostProcessor(workers=1, nice=5).submit(utils.call_ffmpeg, "-h").result()
+    PostProcessor(workers=1, nice=0).submit(utils.call_ffmpeg, "-h").result()
+    assert [cmd[0] for cmd in commands] == ["ffmpeg", "nice", "ffmpeg"]
+    assert commands[1][:4] == ["nice", "-n", "5", "ffmpeg"]
+
+
+def test_inline_without_postproc():
+    job = FakeJob(download=0, post=0)
+    job.start()
+    job.join()
+    # 没有设置队列时在线程里直接做完
+    assert job.post_thread == job.name
+    assert not job.post_pending
+
+
+def test_run_threads_overlap():
+    processor.configure(workers=4)
+    jobs = [FakeJob(download=0.3, post=0.5) for _ in range(3)]
+    start = time.monotonic()
+    assert not run_threads(jobs, max_worker=1)
+    # 收尾和下一个任务的下载同时进行：0.3 * 3 + 0.5，一个接一个的话是 2.4
+    assert time.monotonic() - start < 2.0
+    for job in jobs:
+        assert job.post_thread.startswith("bilicore-postproc")
+        assert job.observe()[2] == "done"
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
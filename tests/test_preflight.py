@@ -0,0 +1,95 @@
+import os
+import sys
+import logging
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import threads  # pylint: disable=C0413,E0611
+from bilicli import utils  # pylint: disable=C0413
+from localserver import LocalServer  # pylint: disable=C0413
+
+VIDEO_DATA = {"bvid": "BV1xx411c7mD", "title": "t", "pages": [{"cid": 1, "part": "t"}]}
+
+
+def _stream_data(aurl: str, vurl: str) -> dict:
+    return {
+        "accept_quality": [80],
+        "dash": {
+            "duration": 8,
+            "video": [
+                {
+                    "id": 80,
+                    "codecs": "avc1.640032",
+                    "height": 1080,
+                    "bandwidth": 2000,
+                    "base_url": vurl,
+                    "backup_url": [],
+                }
+            ],
+            "audio": [
+                {"id": 30280, "bandwidth": 1000, "base_url": aurl, "backup_url": []}
+            ],
+        },
+    }
+
+
+def _job(tmp_path, aurl: str, vurl: str):
+    apis = SimpleNamespace(session=requests.Session(), DEFAULT_HEADERS={})
+    return threads.SingleVideoThread(
+        apis,
+        1,
+        bvid=VIDEO_DATA["bvid"],
+        savedir=str(tmp_path),
+        video_data=VIDEO_DATA,
+        stream_data=_stream_data(aurl, vurl),
+    )
+
+
+class FakeJob:
+    def __init__(self, size) -> None:
+        self.size = size
+
+    def estimate(self):
+        if isinstance(self.size, Exception):
+            raise self.size
+        return self.size, 100.0
+
+
+def test_estimate(tmp_path):
+    with LocalServer() as server:
+        aurl, _ = server.add_file("a.m4a", 2**18)
+        vurl, _ = server.add_file("v.m4v", 2**20)
+        job = _job(tmp_path, aurl, vurl)
+        assert job.estimate()[0] == 2**18 + 2**20
+        # 问不到大小时按码率和时长算
+        missing = vurl.replace("v.m4v", "missing.m4v")
+        assert _job(tmp_path, aurl, missing).estimate()[0] == 2**18 + 2000
+        # 已经下好的不用再下
+        finalfile = job._final_file(VIDEO_DATA, 0, 80, 30280)  # pylint: disable=W0212
+        with open(finalfile, "wb"):
+            pass
+        assert job.estimate()[0] == 0
+
+
+def test_preflight(tmp_path, monkeypatch):
+    jobs = [FakeJob(300), FakeJob(None), FakeJob(500), FakeJob(ValueError("x"))]
+    monkeypatch.setattr(utils, "free_space", lambda _: 2000)
+    assert utils.preflight(jobs, str(tmp_path), show_progress=False) == jobs
+    # 放不下时留下放得下的，要留出最大那个任务合流的空间
+    monkeypatch.setattr(utils, "free_space", lambda _: 1000)
+    kept = utils.preflight(jobs, str(tmp_path), yes=True, show_progress=False)
+    assert kept == [jobs[0], jobs[1], jobs[3]]
+    monkeypatch.setattr(utils, "free_space", lambda _: 100)
+    assert not utils.preflight(jobs, str(tmp_path), yes=True, show_progress=False)
+
+
+def test_free_space(tmp_path):
+    assert utils.free_space(str(tmp_path / "not" / "yet")) > 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
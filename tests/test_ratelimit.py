@@ -0,0 +1,51 @@
+import os
+import logging
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import ratelimit, downloader  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_parse_rate():
+    assert ratelimit.parse_rate("20M") == 20 * 2**20
+    assert ratelimit.parse_rate("512k") == 512 * 2**10
+    assert ratelimit.parse_rate("1.5GB") == 1.5 * 2**30
+    assert ratelimit.parse_rate("100") == 100
+    assert ratelimit.parse_host_rate("a.com=1M") == ("a.com", 2**20)
+    with pytest.raises(ValueError):
+        ratelimit.parse_rate("fast")
+    with pytest.raises(ValueError):
+        ratelimit.parse_host_rate("1M")
+
+
+def test_token_bucket():
+    bucket = ratelimit.TokenBucket()
+    assert bucket.reserve(2**30) == 0
+    bucket.set_rate(1000)
+    # 桶一开始是空的，欠多少等多久
+    assert bucket.reserve(500) == pytest.approx(0.5, abs=0.05)
+    bucket.set_rate(None)
+    assert bucket.reserve(2**30) == 0
+
+
+def test_limited_download(tmp_path, monkeypatch):
+    limiter = ratelimit.RateLimiter()
+    monkeypatch.setattr(downloader, "limiter", limiter)
+    limiter.set_rate(2**20)
+    with LocalServer() as server:
+        url, data = server.add_file("r.bin", 2**20)
+        path = str(tmp_path / "r.bin")
+        start = time.monotonic()
+        downloader.download_common(url, path, threadnum=4, min_range_size=2**18)
+        assert time.monotonic() - start > 0.8
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
@@ -0,0 +1,63 @@
+import os
+import logging
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import aio, downloader  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_backoff():
+    backoff = downloader.Backoff(base=1, cap=4, max_tries=4)
+    delays = [backoff.next() for _ in range(4)]
+    assert [0.5 <= d / c <= 1 for d, c in zip(delays, [1, 2, 4, 4])] == [True] * 4
+    assert backoff.next() is None
+    # 有进展就重新计数
+    assert backoff.next(progressed=True) is not None
+
+
+@pytest.mark.parametrize("download", [downloader.download_common, aio.download_common])
+def test_range_reset(tmp_path, download):
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 2**20)
+        server.reset_count, server.reset_after = 3, 2**17
+        path = str(tmp_path / "a.bin")
+        download(url, path, threadnum=1, min_range_size=2**20)
+        # 每次断开都从断开的地方接着请求，没有重复下载
+        assert server.get_count == 4
+        assert server.sent_bytes == 2**20
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_single_reset(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("b.bin", 2**20)
+        server.reset_count, server.reset_after = 2, 2**17
+        path = str(tmp_path / "b.bin")
+        thread = downloader.DownloadThread(url, path)
+        thread.start()
+        thread.join()
+        assert thread.exception is None
+        assert server.sent_bytes == 2**20
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+def test_reset_not_resumable(tmp_path):
+    with LocalServer(accept_ranges=False) as server:
+        url, _ = server.add_file("c.bin", 2**20)
+        server.reset_count, server.reset_after = 1, 2**17
+        path = str(tmp_path / "c.bin")
+        thread = downloader.DownloadThread(url, path)
+        thread.start()
+        thread.join()
+        assert isinstance(thread.exception, downloader.RESET_ERRORS)
+        assert server.get_count == 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
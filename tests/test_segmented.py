@@ -0,0 +1,267 @@
+import os
+import logging
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import downloader  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_calculate_ranges():
+    ranges = downloader.MultiThreadDownloader.calculate_ranges(100, 4)
+    assert ranges == [(0, 24), (25, 49), (50, 74), (75, 99)]
+    ranges = downloader.MultiThreadDownloader.calculate_ranges(
+        100, 8, min_size=40, offset=10
+    )
+    assert ranges == [(10, 59), (60, 109)]
+
+
+def _write(splitter: downloader.RangeSplitter, seg: downloader.RangeSegment, n: int):
+    size = splitter.advance(seg, n)
+    seg.done += size
+    return size
+
+
+def test_merge_ranges():
+    assert downloader.merge_ranges([(5, 9), (0, 3), (4, 4), (20, 30), (25, 26)]) == [
+        (0, 9),
+        (20, 30),
+    ]
+    assert downloader.missing_ranges([(0, 9), (20, 29)], 40) == [(10, 19), (30, 39)]
+    assert downloader.missing_ranges([], 10) == [(0, 9)]
+
+
+def test_splitter_steal():
+    splitter = downloader.RangeSplitter([(0, 99)], min_size=15)
+    first = splitter.acquire()
+    assert first is not None
+    assert _write(splitter, first, 20) == 20
+    # 剩下 80 字节，对半切走后一半
+    second = splitter.acquire()
+    assert second is not None
+    assert (second.pos, second.end) == (60, 99)
+    assert first.end == 59
+    assert _write(splitter, first, 100) == 40
+    splitter.release(first)
+    third = splitter.acquire()
+    assert third is not None and (third.pos, third.end) == (80, 99)
+    # 已经不够切了
+    assert splitter.acquire() is None
+    assert splitter.remaining() == 40
+
+
+def test_splitter_requeue():
+    splitter = downloader.RangeSplitter([(0, 99)], min_size=60)
+    seg = splitter.acquire()
+    assert seg is not None
+    _write(splitter, seg, 30)
+    # 认领了但没写进去的部分也要放回去
+    splitter.advance(seg, 10)
+    assert splitter.finished() == [(0, 29)]
+    splitter.release(seg)
+    seg = splitter.acquire()
+    assert seg is not None and (seg.pos, seg.end) == (30, 99)
+
+
+def test_mirror_pool():
+    pool = downloader.MirrorPool(["a", "b"])
+    # 没测过速的优先
+    assert {pool.pick(), pool.pick()} == {"a", "b"}
+    pool.report("a", 1000, 1)
+    pool.report("b", 100, 1)
+    # a 快十倍，多给它几个连接
+    picks = [pool.pick() for _ in range(5)]
+    assert picks.count("a") == 5
+    for u in picks:
+        pool.report(u, 0, 0)
+    for _ in range(downloader.MirrorPool.MAX_FAILURES):
+        pool.pick()
+        pool.report("a", 0, 1, failed=True)
+    assert pool.pick() == "b"
+    pool.report("b", 0, 0, failed=True)
+    assert pool.available()
+
+
+def test_segmented_download(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 5 * 2**20 + 123)
+        path = str(tmp_path / "a.bin")
+        downloader.download_common(url, path, threadnum=4)
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+        assert not os.path.exists(path + ".download")
+
+
+def test_progress_hook(tmp_path):
+    calls = []
+    with LocalServer() as server:
+        url, _ = server.add_file("h.bin", 3 * 2**20)
+        path = str(tmp_path / "h.bin")
+        downloader.download_common(
+            url, path, threadnum=3, hook_func=lambda x, y: calls.append((x, y))
+        )
+    assert calls and calls[-1] == (3 * 2**20, 3 * 2**20)
+    assert all(a <= b for (a, _), (b, _) in zip(calls, calls[1:]))
+
+
+def test_small_min_range(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("s.bin", 2**20 + 7)
+        path = str(tmp_path / "s.bin")
+        downloader.download_common(url, path, threadnum=6, min_range_size=2**16)
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+
+
+def test_multi_mirror(tmp_path):
+    with LocalServer() as server1, LocalServer() as server2, LocalServer() as bad:
+        url1, data = server1.add_file("m.bin", 4 * 2**20)
+        server2.files["/m.bin"] = data
+        url2 = url1.replace(str(server1.server_port), str(server2.server_port))
+        # 这个镜像上的文件对不上，应该被弃用
+        bad.files["/m.bin"] = data + b"x"
+        url3 = url1.replace(str(server1.server_port), str(bad.server_port))
+        path = str(tmp_path / "m.bin")
+        downloader.download_common(
+            url1, path, threadnum=4, min_range_size=2**18, mirrors=[url2, url3]
+        )
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+        assert server1.sent_bytes and server2.sent_bytes
+
+
+def test_resume_single_prefix(tmp_path):
+    with LocalServer() as server:
+        url, data = server.add_file("b.bin", 3 * 2**20)
+        path = str(tmp_path / "b.bin")
+        with open(path + ".download", "wb") as fp:
+            fp.write(data[:1000])
+        downloader.download_common(url, path, threadnum=4)
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+
+
+def test_resume_from_journal(tmp_path):
+    with LocalServer() as server:
+        size = 4 * 2**20
+        url, data = server.add_file("d.bin", size)
+        path = str(tmp_path / "d.bin")
+        tmppath = path + ".download"
+        # 模拟上次中断：写完了头尾两段，中间是空洞
+        done = [(0, 2**20 - 1), (3 * 2**20, size - 1)]
+        with open(tmppath, "wb") as fp:
+            fp.truncate(size)
+            for start, end in done:
+                fp.seek(start)
+                fp.write(data[start : end + 1])
+        downloader.RangeJournal(tmppath, size).save(done)
+        d = downloader.MultiThreadDownloader(
+            url, path, threadnum=2, min_range_size=2**20
+        )
+        d.start()
+        d.join()
+        assert d.exception is None and not d.child_exceptions
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+        assert not os.path.exists(tmppath + downloader.RangeJournal.SUFFIX)
+        # 只补了中间缺的 2 MiB
+        assert server.sent_bytes == 2 * 2**20
+        assert d.observe()["size_local"] == size
+
+
+def test_journal_rejects_mismatch(tmp_path):
+    path = str(tmp_path / "e.bin.download")
+    with open(path, "wb") as fp:
+        fp.truncate(100)
+    journal = downloader.RangeJournal(path, 100)
+    journal.save([(0, 9)])
+    assert journal.load() == [(0, 9)]
+    assert downloader.RangeJournal(path, 200).load() is None
+
+
+def test_no_range_support(tmp_path):
+    with LocalServer(accept_ranges=False) as server:
+        url, data = server.add_file("c.bin", 300000)
+        path = str(tmp_path / "c.bin")
+        downloader.download_common(url, path, threadnum=4)
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+
+
+def test_receive_buffer_adapt():
+    buffer = downloader.ReceiveBuffer(max_size=2**20)
+    assert buffer.size == buffer.MIN_SIZE
+    buffer._got = buffer.size  # pylint: disable=W0212
+    buffer._adapt(0.01)  # pylint: disable=W0212
+    assert buffer.size == 2 * buffer.MIN_SIZE
+    for _ in range(10):
+        buffer._got = buffer.size  # pylint: disable=W0212
+        buffer._adapt(0.01)  # pylint: disable=W0212
+    assert buffer.size == 2**20
+    buffer._adapt(10)  # pylint: disable=W0212
+    assert buffer.size == 2**19
+
+
+class SlowRaw:
+    """每次 recv 只来 1KiB，花 0.05 秒"""
+
+    def __init__(self, total: int) -> None:
+        self.left = total
+
+    def readinto(self, view) -> int:
+        time.sleep(0.05)
+        n = min(len(view), 2**10, self.left)
+        self.left -= n
+        return n
+
+
+def test_receive_buffer_slow():
+    buffer = downloader.ReceiveBuffer(max_size=2**21)
+    buffer.size = 2**21
+    resp = SimpleNamespace(headers={}, raw=SlowRaw(2**20))
+    start = time.monotonic()
+    chunk = buffer.readinto(resp)  # type: ignore
+    # 读满 2MiB 要好几分钟，到时间就先交出读到的
+    assert time.monotonic() - start < 1
+    assert 0 < len(chunk) < 2**20
+
+
+def test_connection_reuse(tmp_path):
+    session = requests.Session()
+    with LocalServer(keepalive=True) as server:
+        url, data = server.add_file("f.bin", 2**20 + 5)
+        for name in ("f1.bin", "f2.bin"):
+            path = str(tmp_path / name)
+            downloader.download_common(
+                url, path, session=session, threadnum=1, buffer_size=2**16
+            )
+            with open(path, "rb") as fp:
+                assert fp.read() == data
+        # 绕过 urllib3 读完之后，连接要还回池子里
+        assert server.connection_count == 1
+
+
+
+@pytest.mark.parametrize("mode", ["accept", "force"])
+def test_gzip_body(tmp_path, mode):
+    with LocalServer(gzip_mode=mode) as server:
+        url, _ = server.add_file("f.bin", 0)
+        # 好压缩的内容，压缩后和原文件大小差得远
+        data = server.files["/f.bin"] = os.urandom(2**10) * 2**10
+        path = str(tmp_path / "f.bin")
+        downloader.download_common(url, path, threadnum=4, min_range_size=2**16)
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+        if mode == "accept":
+            # 请求时说了不要压缩，照样分段下
+            assert server.get_count > 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
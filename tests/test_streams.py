@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import sys
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import threads  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def _job(tmp_path):
+    apis = SimpleNamespace(session=requests.Session(), DEFAULT_HEADERS={})
+    return threads.SingleVideoThread(
+        apis, 1, avid=1, savedir=str(tmp_path), max_connections=1
+    )
+
+
+def test_progress_hooks(tmp_path):
+    job = _job(tmp_path)
+    ahook, vhook = job._progress_hooks(2)  # pylint: disable=W0212
+    ahook(None, 100)
+    vhook(None, 300)
+    ahook(40, None)
+    vhook(60, None)
+    assert job.observe()[:2] == (100, 400)
+
+
+def test_streams_in_parallel(tmp_path):
+    with LocalServer(delay=0.5) as server:
+        aurl, adata = server.add_file("a.m4a", 2**18)
+        vurl, vdata = server.add_file("v.m4v", 2**20)
+        apath, vpath = str(tmp_path / "a.m4a"), str(tmp_path / "v.m4v")
+        job = _job(tmp_path)
+        start = time.monotonic()
+        job._dstreams(  # pylint: disable=W0212
+            [([aurl], apath), ([vurl], vpath)]
+        )
+        # 两条流各自的请求都要等 0.5 秒，一条接一条的话至少 1 秒
+        assert time.monotonic() - start < 0.9
+    for path, data in ((apath, adata), (vpath, vdata)):
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+    assert job.observe()[:2] == (2**18 + 2**20,) * 2
+
+
+def test_streams_error(tmp_path):
+    with LocalServer() as server:
+        vurl, vdata = server.add_file("v.m4v", 2**18)
+        missing = vurl.replace("v.m4v", "missing.m4a")
+        vpath = str(tmp_path / "v.m4v")
+        job = _job(tmp_path)
+        with pytest.raises(requests.HTTPError):
+            job._dstreams(  # pylint: disable=W0212
+                [([missing], str(tmp_path / "a.m4a")), ([vurl], vpath)]
+            )
+    # 另一条流不受影响
+    with open(vpath, "rb") as fp:
+        assert fp.read() == vdata
+
+
+
+def test_streams_expired(tmp_path):
+    def dash(url: str) -> dict:
+        video = {"id": 80, "codecs": "avc1", "height": 1080, "bandwidth": 2000}
+        audio = {"id": 30280, "bandwidth": 1000}
+        return {
+            "accept_quality": [80],
+            "dash": {
+                "duration": 8,
+                "video": [{**video, "base_url": url + ".m4v", "backup_url": []}],
+                "audio": [{**audio, "base_url": url + ".m4a", "backup_url": []}],
+            },
+        }
+
+    fetched = []
+
+    def get_stream_dash(cid, bvid):
+        fetched.append(cid)
+        return dash("http://new")
+
+    apis = SimpleNamespace(
+        session=requests.Session(),
+        DEFAULT_HEADERS={},
+        video=SimpleNamespace(get_stream_dash=get_stream_dash),
+    )
+    video_data = {"bvid": "BV1xx", "title": "t", "pages": [{"cid": 1, "part": "t"}]}
+    job = threads.SingleVideoThread(
+        apis,
+        1,
+        bvid="BV1xx",
+        savedir=str(tmp_path),
+        video_data=video_data,
+        stream_data=dash("http://old"),
+        player_info={},
+        no_metadata=True,
+    )
+    assert job.prepare()
+    urls = []
+
+    def dstreams(streams, **_):
+        urls.extend(u for us, _ in streams for u in us)
+        raise RuntimeError("stop")
+
+    job._dstreams = dstreams  # pylint: disable=W0212
+    # 在队列里等的时间超过了流地址的有效期
+    job._streams_expire = time.monotonic() - 1  # pylint: disable=W0212
+    with pytest.raises(RuntimeError):
+        job._transfer()  # pylint: disable=W0212
+    assert fetched == [1]
+    assert urls == ["http://new.m4a", "http://new.m4v"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()
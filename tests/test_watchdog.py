@@ -0,0 +1,95 @@
+import os
+import logging
+import sys
+import time
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from bilicore import aio, downloader, watchdog  # pylint: disable=C0413,E0611
+from localserver import LocalServer  # pylint: disable=C0413
+
+
+def test_meter():
+    meter = watchdog.ThroughputMeter(floor=100, grace=3, interval=1)
+    start = time.monotonic()
+    meter.feed(1000)
+    assert not meter.check(start + 1)
+    # 连续低于下限，到 grace 秒时才算卡住
+    assert not meter.check(start + 2)
+    assert not meter.check(start + 3)
+    assert meter.check(start + 4.5)
+    meter.feed(1000)
+    assert not meter.check(start + 5.5)
+    # 空闲的时候不算
+    meter.idle = True
+    for i in range(10):
+        assert not meter.check(start + 6.5 + i)
+
+
+def test_pick_avoid():
+    pool = downloader.MirrorPool(["a", "b"])
+    assert pool.pick(avoid="a") == "b"
+    assert pool.pick(avoid="b") == "a"
+    pool = downloader.MirrorPool(["a"])
+    # 只有一个可选时还是要用
+    assert pool.pick(avoid="a") == "a"
+
+
+@pytest.mark.parametrize("download", [downloader.download_common, aio.download_common])
+def test_stalled_range(tmp_path, download):
+    with LocalServer() as server:
+        url, data = server.add_file("a.bin", 2**20)
+        server.stall_count, server.stall_after = 1, 2**16
+        path = str(tmp_path / "a.bin")
+        started = time.monotonic()
+        download(
+            url,
+            path,
+            threadnum=1,
+            min_range_size=2**20,
+            stall_speed=2**16,
+            stall_timeout=1,
+        )
+        assert time.monotonic() - started < 10
+        # 卡住的那段只重新请求了剩下的部分
+        assert server.get_count == 2
+        assert server.sent_bytes == 2**20 - 2**16
+    with open(path, "rb") as fp:
+        assert fp.read() == data
+
+
+@pytest.mark.parametrize("keepalive", [False, True])
+def test_abort(keepalive):
+    with LocalServer(keepalive=keepalive) as server, requests.Session() as session:
+        url, _ = server.add_file("a.bin", 2**20)
+        with session.get(url, stream=True) as resp:
+            w = watchdog.Watch(resp, 1, 1)
+            resp.raw.read(2**10)
+            assert w.abort() and w.stalled
+            with pytest.raises(Exception):
+                resp.raw.read()
+        # 读完了的响应，连接已经可以给别人用了，不能再掐
+        with session.get(url, stream=True) as resp:
+            w = watchdog.Watch(resp, 1, 1)
+            resp.raw.read()
+            assert not w.abort() and not w.stalled
+        with session.get(url, stream=True) as resp:
+            w = watchdog.Watch(resp, 1, 1)
+            w.close()
+            assert not w.abort() and not w.stalled
+
+
+def test_stalled_single(tmp_path):
+    with LocalServer(accept_ranges=False) as server:
+        url, _ = server.add_file("b.bin", 2**20)
+        server.stall_count, server.stall_after = 1, 2**16
+        path = str(tmp_path / "b.bin")
+        with pytest.raises(watchdog.StallError):
+            downloader.download_common(url, path, stall_speed=2**16, stall_timeout=1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    pytest.main()